@@ -494,6 +494,13 @@ CREATE TABLE message_chain_embeddings_hegemmav2 (
     FOREIGN KEY (chat_id, last_message_id) REFERENCES message_chain(chat_id, last_message_id)
 );
 
+CREATE TABLE message_embeddings (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    embedding VECTOR(768),
+    PRIMARY KEY (chat_id, message_id)
+);
+
 CREATE TABLE reactions (
     chat_id BIGINT NOT NULL,
     message_id BIGINT NOT NULL,
@@ -539,6 +546,142 @@ CREATE TABLE configurations_partition_4 PARTITION OF configurations FOR VALUES W
 CREATE TABLE configurations_partition_5 PARTITION OF configurations FOR VALUES WITH (MODULUS 7, REMAINDER 5);
 CREATE TABLE configurations_partition_6 PARTITION OF configurations FOR VALUES WITH (MODULUS 7, REMAINDER 6);
 
+-- per-chat summary of messages, maintained by the writer in the same transaction as every batch
+-- so startup never has to aggregate over messages. The committed contiguous range is [0, chats.top_message_id].
+CREATE TABLE chat_watermarks (
+    chat_id BIGINT NOT NULL,
+    min_message_id BIGINT,
+    max_message_id BIGINT,
+    ongoing_min_message_id BIGINT, -- lowest stored message_id above chats.top_message_id (where an interrupted backfill resumes)
+    message_count BIGINT NOT NULL DEFAULT 0 CHECK (message_count >= 0),
+    max_date TIMESTAMP,
+    last_fetch TIMESTAMP,
+    PRIMARY KEY (chat_id)
+);
+
+-- message id ranges (min_id, max_id) of a backfill, fetched newest first by MessageFetch/main_multi.py.
+-- offset_id is moved down in the same transaction as the messages above it, so a restart resumes every
+-- range exactly where its committed messages end. Rows are deleted when chats.top_message_id moves past them.
+CREATE TABLE fetch_shards (
+    chat_id BIGINT NOT NULL,
+    min_id BIGINT NOT NULL,
+    max_id BIGINT NOT NULL,
+    offset_id BIGINT NOT NULL, -- the next fetch returns messages below it
+    done BOOLEAN NOT NULL DEFAULT FALSE,
+    session TEXT,
+    updated_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (chat_id, min_id)
+);
+
+-- counters of a message at increasing ages, written by MessageRefresh/main.py. stage is the index
+-- (from 1) of the refresh age the sample was taken for, so a message is due again once it is older than
+-- the next age. Only counters are stored - the message itself stays in messages.
+CREATE TABLE engagement_samples (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    sampled_at TIMESTAMP NOT NULL,
+    stage SMALLINT NOT NULL,
+    views INTEGER,
+    forwards INTEGER,
+    reactions_vote_count INTEGER,
+    poll_vote_count INTEGER,
+    PRIMARY KEY (chat_id, message_id, sampled_at)
+);
+
+-- engagement_samples compacted by common/backend/engagement_store.py: one row per message holding its whole
+-- trajectory as delta-encoded arrays (t: seconds after posted_at), so a growth curve is one row instead of a row
+-- per sample and the small deltas compress well once a trajectory gets long.
+-- stage is the highest engagement_samples.stage folded in.
+CREATE TABLE engagement_series (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    posted_at TIMESTAMP NOT NULL,
+    stage SMALLINT NOT NULL DEFAULT 0,
+    last_sampled_at TIMESTAMP,
+    t INTEGER[] NOT NULL DEFAULT '{}',
+    views INTEGER[] NOT NULL DEFAULT '{}',
+    forwards INTEGER[] NOT NULL DEFAULT '{}',
+    reactions INTEGER[] NOT NULL DEFAULT '{}',
+    PRIMARY KEY (chat_id, message_id, posted_at)
+) PARTITION BY RANGE (posted_at);
+
+DO $$
+BEGIN
+  FOR partition_year IN 2013..2040 LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS engagement_series_%s PARTITION OF engagement_series FOR VALUES FROM (''%s-01-01'') TO (''%s-01-01'')',
+      partition_year,
+      partition_year,
+      partition_year+1
+    );
+  END LOOP;
+END;
+$$;
+
+-- growth of every chat per time bucket, added to while compacting (each sample is counted exactly once).
+-- views/forwards/reactions are the increases since the previous sample of each message, samples the number of them
+CREATE TABLE engagement_rollups (
+    granularity granularity_type NOT NULL,
+    chat_id BIGINT NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 0,
+    views BIGINT NOT NULL DEFAULT 0,
+    forwards BIGINT NOT NULL DEFAULT 0,
+    reactions BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, chat_id, bucket)
+) PARTITION BY LIST (granularity);
+
+CREATE TABLE engagement_rollups_1m PARTITION OF engagement_rollups FOR VALUES IN ('1m');
+CREATE TABLE engagement_rollups_60m PARTITION OF engagement_rollups FOR VALUES IN ('60m');
+CREATE TABLE engagement_rollups_1d PARTITION OF engagement_rollups FOR VALUES IN ('1d');
+
+-- hype scores of common/hype.py. sender_id is messages.sender_id, or the chat for unsigned channel posts
+CREATE TABLE message_hype (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    sender_id BIGINT NOT NULL,
+    hype REAL NOT NULL,
+    chat_z REAL, -- against the other messages of the chat in the scored window
+    sender_z REAL, -- against the previous messages of the sender (NULL while there are too few)
+    scored_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+
+-- running count, mean and sum of squared deviations (Welford) of the hype of every sender's scored messages
+CREATE TABLE sender_hype_stats (
+    sender_id BIGINT NOT NULL,
+    n BIGINT NOT NULL CHECK (n >= 0),
+    mean DOUBLE PRECISION NOT NULL,
+    m2 DOUBLE PRECISION NOT NULL CHECK (m2 >= 0),
+    updated_at TIMESTAMP,
+    PRIMARY KEY (sender_id)
+);
+
+-- events of EventDetect/main.py: a cluster of messages (chat_ids[i], message_ids[i]) of the sliding window.
+-- Rewritten while the event grows, and left as it was once its messages leave the window
+CREATE TABLE detected_events (
+    event_id UUID NOT NULL,
+    source TEXT NOT NULL, -- the embeddings table clustered
+    centroid vector,
+    chat_ids BIGINT[] NOT NULL,
+    message_ids BIGINT[] NOT NULL,
+    size INTEGER NOT NULL,
+    first_at TIMESTAMP,
+    last_at TIMESTAMP,
+    total_hype REAL, -- sum of the hype weights of the members
+    updated_at TIMESTAMP,
+    PRIMARY KEY (event_id)
+);
+
+-- embeddings by model and text (blake2b-128 of the NFKC, whitespace-collapsed text), see common/embedding_cache.py
+CREATE TABLE embedding_cache (
+    model TEXT NOT NULL,
+    text_hash BYTEA NOT NULL,
+    embedding vector NOT NULL,
+    created_at TIMESTAMP,
+    PRIMARY KEY (model, text_hash)
+);
+
 CREATE INDEX idx_chat ON messages (chat_id);
 CREATE INDEX idx_date ON messages (
     (date_part('year', date)),
@@ -546,6 +689,13 @@ CREATE INDEX idx_date ON messages (
     (date_part('day', date))
 );
 CREATE INDEX idx_reaction ON reactions (reaction_id);
+CREATE INDEX idx_messages_date ON messages (date);
+-- ANN indexes for cosine distance, see Pipeline/common/backend/vector_index.py. HNSW takes at most 2000 dimensions,
+-- so the 3072-dim chain embeddings are indexed as halfvec
+CREATE INDEX idx_messages_embedding_hnsw ON messages USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX idx_message_embeddings_embedding_hnsw ON message_embeddings USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX idx_message_chain_embeddings_hegemmav2_embedding_hnsw ON message_chain_embeddings_hegemmav2
+    USING hnsw ((embedding::halfvec(3072)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
 
 ALTER TABLE reactions ADD CONSTRAINT fk_reactions_message FOREIGN KEY (chat_id, message_id) REFERENCES messages (chat_id, message_id);
 ALTER TABLE polls ADD CONSTRAINT fk_polls_message FOREIGN KEY (chat_id, message_id) REFERENCES messages (chat_id, message_id);
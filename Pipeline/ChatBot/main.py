@@ -21,6 +21,7 @@ import signal
 import sys
 import os
 from common.utils import load_embedding_model, load_pyrogram_session, run_async
+from common.embedding_cache import EmbeddingCache
 import logging
 from sqlalchemy.orm import Session
 from sqlalchemy import Column
@@ -32,6 +33,8 @@ logging.basicConfig(level=logging.INFO)
 logging.info("Connecting to DB")
 db = PostgresBackend()
 config = Config()
+model = None # embedding model of /search textcos, loaded on first use
+embedding_cache = None
 
 
 logging.info("Connecting to account")
@@ -107,6 +110,8 @@ async def do_sql(q):
     def doer():
         if isinstance(q, str):
             result[0] = db.execute_query(q) or ["NO RESULTS"]
+        elif callable(q):
+            result[0] = q(db._conn)
         else:
             result[0] = db._conn.execute(q).fetchall()
         returned[0] = True
@@ -167,8 +172,9 @@ async def handle_check_command(bot, message, response_msg, text):
 		return "Please mark a message to check by replying to it"
 	return str(reply)
 
-@on_cmd("search", description="params: textcos/textlike, chat_id/chatname, after, before, limit")
+@on_cmd("search", description="params: textcos/textlike, chat_id/chatname, after, before, limit, minhype")
 async def handle_sql_embed_prev_command(bot, message, response_msg, text):
+	global model, embedding_cache
 	lines = [line.strip() for line in text.split(";;;") if line.strip()]
 	params = dict()
 	for line in lines:
@@ -178,41 +184,44 @@ async def handle_sql_embed_prev_command(bot, message, response_msg, text):
 	if "textcos" not in params and "textlike" not in params:
 		return f"No text in parameters: {lines}"
 	message_text = f"Please wait. {params}"
-	if model is None:
+	if "textcos" in params and model is None:
 		message_text += "\n\nLoading model..."
 	msg = await bot.send_message(chat_id=message.chat.id, reply_to_message_id=message.id, text=message_text)
-	if model is None:
+	if "textcos" in params and model is None:
 		model = load_embedding_model()
+		embedding_cache = EmbeddingCache(consts["SENTENCE_TRANSFORMERS_MODEL_NAME"])
 	from sqlalchemy import select
-	from sqlalchemy.orm import aliased
 	import common.backend.models as models
+	from common.backend import vector_index
 	try:
-		query = select(models.Messages)
+		chat_ids = None
 		if "chat_id" in params:
-			query = query.where(models.Messages.chat_id == params["chat_id"])
+			chat_ids = [int(params["chat_id"])]
 		if "chatname" in params:
-			chat_alias = aliased(models.Chats)
-			chat_ids_subquery = db._conn.query(chat_alias.chat_id).filter(chat_alias.title.like("%" + params["chatname"] + "%"))
-			query = query.join(models.Messages.chat_id).filter(models.Messages.chat_id.in_(chat_ids_subquery))
-		if "after" in params:
-			query = query.where(models.Messages.date > params["after"])
-		if "before" in params:
-			query = query.where(models.Messages.date < params["before"])
-		query = query.where(models.Messages.embedding != None)
+			chat_ids = select(models.Chats.chat_id).where(models.Chats.title.like("%" + params["chatname"] + "%"))
+		limit = int(params.get("limit", 10))
 		if "textcos" in params:
-			embed = model.encode(params["textcos"])
-			query = query.order_by(models.Messages.embedding.op('<->')(embed))
+			# ANN over idx_messages_embedding_hnsw, see common/backend/vector_index.py
+			embed = embedding_cache.embed([params["textcos"]], model.encode)[0]
+			query = vector_index.nearest(
+				"messages", embed, limit=limit, chat_ids=chat_ids,
+				after=params.get("after"), before=params.get("before"),
+				min_sender_z=float(params["minhype"]) if "minhype" in params else None,
+			)
 		elif "textlike" in params:
-			query = query.where(models.Messages.text.like("%" + params["textlike"] + "%"))
+			query = select(models.Messages).where(models.Messages.text.like("%" + params["textlike"] + "%"))
+			if chat_ids is not None:
+				query = query.where(models.Messages.chat_id.in_(chat_ids))
+			if "after" in params:
+				query = query.where(models.Messages.date >= params["after"])
+			if "before" in params:
+				query = query.where(models.Messages.date < params["before"])
+			query = query.limit(limit)
 		else:
 			raise ValueError("No text search method specified - should not have gotten here")
-		query = query.limit(params.get("limit", 10))
-		# we only want chat_id, date, text
-		query = query.with_only_columns(*[models.Messages.chat_id, models.Messages.date, models.Messages.text])
-		# now leftjoin with chats to obtain title (won't add any other columns):
+		# now join with chats to obtain title, and keep only title, date, text:
 		query = query.join(models.Chats, models.Chats.chat_id == models.Messages.chat_id)
 		query = query.with_only_columns(*[models.Chats.title, models.Messages.date, models.Messages.text])
-		#query = query.with_for_update()
 	except Exception as e:
 		result_str = f"Error building query: {e}"
 		await msg.edit_text(result_str)
@@ -221,7 +230,10 @@ async def handle_sql_embed_prev_command(bot, message, response_msg, text):
 	try:
 		print("Submitting")
 		await msg.edit_text("Working...")
-		results = await do_sql(query)
+		if "textcos" in params:
+			results = await do_sql(lambda conn: vector_index.search(conn, query))
+		else:
+			results = await do_sql(query)
 		result_str = "\n".join([str(row) for row in results])
 		await msg.edit_text(result_str)
 	except Exception as e:
@@ -2,57 +2,102 @@ from typing import List
 import logging
 import zmq
 import os
-import numpy as np
+import time
+import queue
+import threading
 from sqlalchemy.orm import Session
 from common.utils import create_postgres_engine
+from common.backend.pg_copy import copy_vectors
 from common.backend.models import MessageChainEmbeddingsHegemmav2 
+from common.embed_protocol import Batch, decode_batch, encode_ack, ACK_STORED, ACK_FAILED, HEADER
+from common import metrics
 logging.basicConfig(level=logging.INFO)
 
 
+WRITE_QUEUE_BATCHES = 64 # received batches waiting for the DB writer; senders hold back by credits long before this
+POLL_MS = 100
+
+ZMQ_RECEIVED_MESSAGES = metrics.counter("telelog_zmq_received_embeddings_total", "Embeddings received from MessageEmbed")
+EMBEDDINGS_STORED = metrics.counter("telelog_embeddings_stored_total", "Embeddings written to the DB", ["status"])
+EMBEDDING_STORE_SECONDS = metrics.histogram("telelog_embedding_store_seconds", "Time to store one received batch")
+WRITE_QUEUE = metrics.gauge("telelog_embed_queue_write_backlog", "Received batches waiting for the DB writer")
+
+
 class EmbeddingReceiver:
+    """
+    ROUTER end of common/embed_protocol.py. The socket thread only receives and acknowledges;
+    a writer thread stores the batches, so receiving from one sender never waits on the DB for another
+    """
     def __init__(self):
         port = os.environ["ZMQ_PORT"]
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.ROUTER)
         self.socket.bind(f"tcp://*:{port}")
         self.engine = create_postgres_engine()
+        self.received: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_BATCHES)
+        self.acks: queue.Queue = queue.Queue()
+        WRITE_QUEUE.set_function(self.received.qsize)
 
     def receive_and_process(self):
         logging.info("Receiver started. Waiting for embeddings...")
+        threading.Thread(target=self._writer, daemon=True).start()
+        while True:
+            if self.socket.poll(POLL_MS, zmq.POLLIN):
+                identity, *frames = self.socket.recv_multipart(copy=False)
+                try:
+                    batch = decode_batch(frames)
+                except Exception as e:
+                    logging.error(f"Dropping a malformed batch: {e}")
+                    self._reject(identity.bytes, frames)
+                    continue
+                ZMQ_RECEIVED_MESSAGES.inc(len(batch.keys))
+                self.received.put((identity.bytes, batch))
+            while not self.acks.empty():
+                identity, seq, status = self.acks.get()
+                self.socket.send_multipart([identity, encode_ack(seq, status)])
 
+    def _reject(self, identity: bytes, frames: List):
+        """
+        ACK_FAILED to a batch which can't be decoded, if its header at least holds a sequence number
+        """
+        try:
+            seq = HEADER.unpack(frames[0].bytes)[-1]
+        except Exception:
+            logging.error("Can't read the sequence number of the malformed batch, not acknowledging it")
+            return
+        self.socket.send_multipart([identity, encode_ack(seq, ACK_FAILED)])
+
+    def _writer(self):
         while True:
-            metadata = self.socket.recv().decode()
-            chat_id, n, message_ids = metadata.split(":")
-            message_ids = [int(x) for x in message_ids.split(",")]
-            embeddings = []
-            for i in range(n):
-                embedding_bytes = self.socket.recv()
-                embeddings.append(np.frombuffer(embedding_bytes, dtype=np.float32))
-            if len(embeddings) != len(message_ids):
-                logging.error(f"Received {len(embeddings)} embeddings and {len(message_ids)} message_ids. Skipping.")
-                continue
-            self.process_embeddings(chat_id, message_ids, embeddings)
-
-    def process_embeddings(self, chat_id: str, message_ids: List[int], embeddings: List[np.ndarray]):
+            identity, batch = self.received.get()
+            status = ACK_STORED if self.process_embeddings(batch) else ACK_FAILED
+            self.acks.put((identity, batch.seq, status))
+
+    def process_embeddings(self, batch: Batch) -> bool:
+        """
+        Upserts with binary COPY, so a batch sent again after a lost ack is harmless
+        """
+        t_start = time.time()
         try:
             with Session(self.engine) as session:
-                for message_id, embedding in zip(message_ids, embeddings):
-                    new_embedding = MessageChainEmbeddingsHegemmav2(
-                        chat_id=int(chat_id),
-                        last_message_id=message_id,
-                        embedding=embedding
-                    )
-                    session.add(new_embedding)
+                copy_vectors(session, MessageChainEmbeddingsHegemmav2, batch.keys, batch.embeddings)
                 session.commit()
-            logging.info(f"Processed and stored embeddings for chat_id: {chat_id}, message_ids: {message_ids}")
+            logging.info(f"Stored batch {batch.seq} of {len(batch.keys)} embeddings")
+            EMBEDDINGS_STORED.labels(status="stored").inc(len(batch.keys))
+            return True
         except Exception as e:
             logging.error(f"Error processing data: {e}")
+            EMBEDDINGS_STORED.labels(status="failed").inc(len(batch.keys))
+            return False
+        finally:
+            EMBEDDING_STORE_SECONDS.observe(time.time() - t_start)
 
 
 def main():
+    metrics.start_http_server()
     receiver = EmbeddingReceiver()
     receiver.receive_and_process()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
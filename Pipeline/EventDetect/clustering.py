@@ -0,0 +1,169 @@
+"""
+Incremental clustering of message embeddings over a sliding time window (README: Aggregation).
+
+Every new message is folded into the nearest micro-cluster, or opens a new one. A micro-cluster keeps the weighted
+sum of its normalized embeddings and its mass (sum of hype weights), so matching and macro-clustering work on the
+micro-clusters alone, and its members with their contributions, so messages leaving the window are subtracted
+again. Memory follows the messages of the window; micro-clusters left without members are dropped.
+
+Macro-clustering runs on the micro-cluster centroids alone: micro-clusters are linked when their centroids are
+within MACRO_SIMILARITY, and every connected component with enough messages is an event. An event is named after
+its oldest micro-cluster, so it keeps its id while it grows. A micro-cluster is named after its oldest message still
+in the window, so replaying the window after a restart gives the same ids.
+"""
+from typing import List, Dict, Tuple, Optional
+from collections import namedtuple
+import bisect
+import datetime
+import uuid
+import numpy as np
+
+
+MICRO_SIMILARITY = 0.80 # cosine similarity to a micro-cluster centroid to join it
+MACRO_SIMILARITY = 0.70 # cosine similarity between micro-cluster centroids to link them into one event
+MIN_EVENT_MESSAGES = 3
+EVENT_NAMESPACE = uuid.UUID("5d0c7a52-3a8e-4f1b-9a53-1f6f4e2b7c11") # uuid5 namespace of micro-cluster ids
+
+MessageKey = Tuple[int, int] # (chat_id, message_id)
+Event = namedtuple("Event", ["event_id", "centroid", "members", "first_at", "last_at", "total_hype"])
+Member = namedtuple("Member", ["key", "date", "mass", "contribution"]) # contribution: embedding * mass
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class MicroCluster:
+    def __init__(self, embedding: np.ndarray, key: MessageKey, date: datetime.datetime, mass: float, *, namespace: uuid.UUID = EVENT_NAMESPACE):
+        self.namespace = namespace
+        self.linear_sum = np.zeros_like(embedding)
+        self.mass = 0.0
+        self.members: List[Member] = [] # oldest first
+        self.add(embedding, key, date, mass)
+
+    @property
+    def id(self) -> uuid.UUID:
+        key = self.members[0].key
+        return uuid.uuid5(self.namespace, f"{key[0]}:{key[1]}")
+
+    @property
+    def first_at(self) -> datetime.datetime:
+        return self.members[0].date
+
+    @property
+    def last_at(self) -> datetime.datetime:
+        return self.members[-1].date
+
+    @property
+    def keys(self) -> List[MessageKey]:
+        return [m.key for m in self.members]
+
+    @property
+    def centroid(self) -> np.ndarray:
+        return normalize(self.linear_sum)
+
+    def add(self, embedding: np.ndarray, key: MessageKey, date: datetime.datetime, mass: float):
+        member = Member(key, date, mass, embedding * mass)
+        self.linear_sum += member.contribution
+        self.mass += mass
+        bisect.insort(self.members, member, key=lambda m: (m.date, m.key))
+
+    def expire(self, oldest: datetime.datetime) -> int:
+        """
+        Subtracts the members older than oldest. Returns how many there were
+        """
+        n = bisect.bisect_left([m.date for m in self.members], oldest)
+        for m in self.members[:n]:
+            self.linear_sum -= m.contribution
+            self.mass -= m.mass
+        del self.members[:n]
+        return n
+
+
+class StreamClusterer:
+    def __init__(self, window: datetime.timedelta, *, micro_similarity: float = MICRO_SIMILARITY, macro_similarity: float = MACRO_SIMILARITY, namespace: uuid.UUID = EVENT_NAMESPACE):
+        self.window = window
+        self.namespace = namespace # of the micro-cluster ids, one per source so their events never collide
+        self.micro_similarity = micro_similarity
+        self.macro_similarity = macro_similarity
+        self.micro: List[MicroCluster] = []
+        self._centroids: Optional[np.ndarray] = None # rows follow self.micro
+
+    def __len__(self) -> int:
+        return len(self.micro)
+
+    def add(self, embeddings: np.ndarray, keys: List[MessageKey], dates: List[datetime.datetime], masses: List[float]):
+        """
+        Folds a batch of messages in, oldest first
+        """
+        if not len(keys):
+            return
+        embeddings = normalize(np.asarray(embeddings, dtype=np.float32))
+        for i in sorted(range(len(keys)), key=lambda i: dates[i]):
+            x = embeddings[i]
+            best = -1
+            if self.micro:
+                similarities = self._centroids @ x
+                best = int(np.argmax(similarities))
+                if similarities[best] < self.micro_similarity:
+                    best = -1
+            if best < 0:
+                self.micro.append(MicroCluster(x.copy(), keys[i], dates[i], masses[i], namespace=self.namespace))
+                row = self.micro[-1].centroid[None, :]
+                self._centroids = row if self._centroids is None else np.vstack([self._centroids, row])
+            else:
+                self.micro[best].add(x, keys[i], dates[i], masses[i])
+                self._centroids[best] = self.micro[best].centroid
+
+    def expire(self, now: datetime.datetime) -> int:
+        """
+        Subtracts the messages which left the window from their micro-clusters and drops the micro-clusters left
+        empty. Returns how many were dropped
+        """
+        keep = []
+        for i, m in enumerate(self.micro):
+            if m.expire(now - self.window) and m.members:
+                self._centroids[i] = m.centroid
+            if m.members:
+                keep.append(i)
+        dropped = len(self.micro) - len(keep)
+        if dropped:
+            self.micro = [self.micro[i] for i in keep]
+            self._centroids = self._centroids[keep] if keep else None
+        return dropped
+
+    def events(self) -> List[Event]:
+        """
+        Connected components of the micro-cluster similarity graph with at least MIN_EVENT_MESSAGES messages
+        """
+        n = len(self.micro)
+        if not n:
+            return []
+        linked = (self._centroids @ self._centroids.T) >= self.macro_similarity
+        component = np.full(n, -1)
+        for start in range(n):
+            if component[start] >= 0:
+                continue
+            component[start] = start
+            stack = [start]
+            while stack:
+                i = stack.pop()
+                for j in np.flatnonzero(linked[i] & (component < 0)):
+                    component[j] = start
+                    stack.append(j)
+        events = []
+        for c in np.unique(component):
+            parts = [self.micro[i] for i in np.flatnonzero(component == c)]
+            members = [k for m in parts for k in m.keys]
+            if len(members) < MIN_EVENT_MESSAGES:
+                continue
+            events.append(Event(
+                event_id=min(parts, key=lambda m: (m.first_at, m.members[0].key)).id,
+                centroid=normalize(sum(m.linear_sum for m in parts)),
+                members=members,
+                first_at=min(m.first_at for m in parts),
+                last_at=max(m.last_at for m in parts),
+                total_hype=float(sum(m.mass for m in parts)),
+            ))
+        return events
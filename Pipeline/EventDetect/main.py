@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import time
+from typing import List, Dict
+import datetime
+import uuid
+import numpy as np
+from sqlalchemy import select, delete, and_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from common.utils import create_postgres_engine
+import common.backend.models as models
+from common import metrics
+from EventDetect.clustering import StreamClusterer, MessageKey, Event, EVENT_NAMESPACE
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+SOURCES = {
+    "message_embeddings": (models.MessageEmbeddings, models.MessageEmbeddings.message_id),
+    "message_chain_embeddings_hegemmav2": (models.MessageChainEmbeddingsHegemmav2, models.MessageChainEmbeddingsHegemmav2.last_message_id),
+}
+EVENT_SOURCE = os.environ.get("EVENT_SOURCE", "message_embeddings")
+EVENT_WINDOW = datetime.timedelta(hours=float(os.environ.get("EVENT_WINDOW_HOURS", 24)))
+EVENT_MIN_SENDER_Z = float(os.environ.get("EVENT_MIN_SENDER_Z", 0)) # README: hype above the sender's average
+POLL_INTERVAL = 60 # seconds
+EMBEDDING_LAG = datetime.timedelta(hours=1) # how long after posting an embedding may still show up
+
+EVENTS_DETECTED = metrics.gauge("telelog_events_detected", "Events in the current window")
+MICRO_CLUSTERS = metrics.gauge("telelog_event_micro_clusters", "Micro-clusters in the current window")
+MESSAGES_CLUSTERED = metrics.counter("telelog_event_messages_clustered_total", "Messages folded into micro-clusters")
+DETECT_SECONDS = metrics.histogram("telelog_event_detect_seconds", "Time of one poll", ["step"])
+
+
+def select_new_embeddings(since: datetime.datetime):
+    """
+    Embeddings of messages posted after since, with their hype (message_hype, see common/hype.py).
+    Messages not scored yet pass the hype filter with weight 1
+    """
+    model, message_id = SOURCES[EVENT_SOURCE]
+    sender_z = models.MessageHype.sender_z
+    return (
+        select(model.chat_id, message_id, model.embedding, models.Messages.date, sender_z)
+        .join(models.Messages, and_(models.Messages.chat_id == model.chat_id, models.Messages.message_id == message_id))
+        .outerjoin(models.MessageHype, and_(models.MessageHype.chat_id == model.chat_id, models.MessageHype.message_id == message_id))
+        .where(models.Messages.date > since)
+        .where(model.embedding.is_not(None))
+        .where(sender_z.is_(None) | (sender_z >= EVENT_MIN_SENDER_Z))
+    )
+
+
+def upsert_events(events: List[Event]):
+    rows = [
+        dict(
+            event_id=e.event_id,
+            source=EVENT_SOURCE,
+            centroid=e.centroid,
+            chat_ids=[k[0] for k in e.members],
+            message_ids=[k[1] for k in e.members],
+            size=len(e.members),
+            first_at=e.first_at,
+            last_at=e.last_at,
+            total_hype=e.total_hype,
+            updated_at=datetime.datetime.now(),
+        )
+        for e in events
+    ]
+    stmt = insert(models.DetectedEvents)
+    return stmt.on_conflict_do_update(
+        index_elements=["event_id"],
+        set_={c: stmt.excluded[c] for c in rows[0].keys() if c != "event_id"},
+    ), rows
+
+
+def delete_superseded_events(event_ids: List, since: datetime.datetime):
+    """
+    Rows of events still in the window which aren't events anymore - merged into an older one, or renamed after
+    their oldest micro-cluster expired. Events that left the window are kept
+    """
+    table = models.DetectedEvents
+    return (
+        delete(table)
+        .where(table.source == EVENT_SOURCE)
+        .where(table.last_at >= since)
+        .where(table.event_id.not_in(event_ids))
+    )
+
+
+class EventDetector:
+    def __init__(self):
+        self.engine = create_postgres_engine()
+        self.clusterer = StreamClusterer(EVENT_WINDOW, namespace=uuid.uuid5(EVENT_NAMESPACE, EVENT_SOURCE))
+        self.seen: Dict[MessageKey, datetime.datetime] = dict() # clustered messages which the next poll can return again
+        self.started = False
+
+    def poll(self):
+        now = datetime.datetime.now()
+        since = now - EMBEDDING_LAG if self.started else now - EVENT_WINDOW
+        t_start = time.time()
+        with Session(self.engine) as sess:
+            rows = [r for r in sess.execute(select_new_embeddings(since)).fetchall() if (r[0], r[1]) not in self.seen]
+        t_loaded = time.time()
+        if rows:
+            keys = [(r[0], r[1]) for r in rows]
+            # mass, README "mass-based clustering": messages further above their sender's average weigh more
+            masses = [1 + max(r[4] or 0, 0) for r in rows]
+            self.clusterer.add(np.stack([np.asarray(r[2], dtype=np.float32) for r in rows]), keys, [r[3] for r in rows], masses)
+            self.seen.update({(r[0], r[1]): r[3] for r in rows})
+            MESSAGES_CLUSTERED.inc(len(rows))
+        self.clusterer.expire(now)
+        self.seen = {k: date for k, date in self.seen.items() if date > now - EMBEDDING_LAG}
+        self.started = True
+        t_clustered = time.time()
+        events = self.clusterer.events()
+        with Session(self.engine) as sess:
+            if events:
+                stmt, values = upsert_events(events)
+                sess.execute(stmt, values)
+            sess.execute(delete_superseded_events([e.event_id for e in events], now - EVENT_WINDOW))
+            sess.commit()
+        t_written = time.time()
+        EVENTS_DETECTED.set(len(events))
+        MICRO_CLUSTERS.set(len(self.clusterer))
+        DETECT_SECONDS.labels(step="load").observe(t_loaded - t_start)
+        DETECT_SECONDS.labels(step="cluster").observe(t_clustered - t_loaded)
+        DETECT_SECONDS.labels(step="write").observe(t_written - t_clustered)
+        logging.info(f"{len(rows)} new messages, {len(self.clusterer)} micro-clusters, {len(events)} events")
+
+    def run(self):
+        logging.info(f"Detecting events in {EVENT_SOURCE} over the last {EVENT_WINDOW}")
+        while True:
+            self.poll()
+            time.sleep(POLL_INTERVAL)
+
+
+def main():
+    metrics.start_http_server()
+    EventDetector().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Embedding models behind MessageEmbed, with length-bucketed dynamic batching.
+
+embed() tokenizes all the texts it's given, sorts them by token count and cuts batches under a token budget
+(batch size times the longest text of the batch, i.e. the padded tensor), so short chains are batched together
+instead of being padded to the longest chain of a fixed batch. Embeddings come back in the order of the texts.
+
+EMBED_PRECISION picks fp32, bf16, or int8 - dynamic quantization of the Linear layers, CPU only.
+"""
+from typing import List, Dict, Optional
+import logging
+import os
+import numpy as np
+import torch
+
+
+HEGEMMA_MODEL = "yam-peleg/Hebrew-Gemma-11B-V2"
+MAX_LENGTH = 512 # tokens per text, longer texts are truncated
+EMBED_PRECISION = os.environ.get("EMBED_PRECISION", "fp32")
+EMBED_TOKEN_BUDGET = int(os.environ.get("EMBED_TOKEN_BUDGET", 16384)) # padded tokens per forward pass
+MAX_BATCH = 256 # texts per forward pass, however short
+
+
+def token_budget_batches(lengths: List[int], token_budget: int, max_batch: int = MAX_BATCH) -> List[List[int]]:
+    """
+    Indices of lengths cut into batches, shortest first, each of at most token_budget padded tokens.
+    A text longer than the budget gets a batch of its own
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        # sorted, so lengths[i] is the longest of the batch if it joins
+        if batch and ((len(batch) + 1) * lengths[i] > token_budget or len(batch) >= max_batch):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def with_precision(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    if precision == "bf16":
+        return model.to(torch.bfloat16)
+    if precision == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if precision != "fp32":
+        raise ValueError(f"Unknown precision {precision}")
+    return model
+
+
+class MessageEmbedder:
+    """
+    First-token hidden state of a transformers model (Hebrew-Gemma by default)
+    """
+    def __init__(self, model_name: str = HEGEMMA_MODEL, *, precision: str = EMBED_PRECISION, token_budget: int = EMBED_TOKEN_BUDGET, device: Optional[str] = None):
+        self.precision = precision
+        self.name = model_name if precision == "fp32" else f"{model_name}@{precision}" # embeddings differ per precision
+        self.token_budget = token_budget
+        self.device = device
+        logging.info(f"Loading {model_name} ({precision})")
+        self.tokenizer, model = self.load(model_name)
+        # the first token is the embedding - right padding keeps it the same whichever batch a text lands in
+        self.tokenizer.padding_side = "right"
+        self.model = with_precision(model.eval(), precision)
+        self.max_length = MAX_LENGTH
+
+    def load(self, model_name: str):
+        from transformers import AutoTokenizer, AutoModel
+        # int8 dynamic quantization only runs on CPU
+        device_map = "cpu" if self.precision == "int8" else (self.device or "auto")
+        dtype = torch.bfloat16 if self.precision == "bf16" else None
+        return (
+            AutoTokenizer.from_pretrained(model_name),
+            AutoModel.from_pretrained(model_name, device_map=device_map, torch_dtype=dtype),
+        )
+
+    def forward(self, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        return self.model(**inputs).last_hidden_state[:, 0, :]
+
+    def model_device(self) -> torch.device:
+        parameter = next(iter(self.model.parameters()), None)
+        return parameter.device if parameter is not None else torch.device("cpu")
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        if not texts:
+            return []
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+        device = self.model_device()
+        with torch.inference_mode():
+            for batch in token_budget_batches([len(ids) for ids in encoded["input_ids"]], self.token_budget):
+                features = {k: [v[i] for i in batch] for k, v in encoded.items()}
+                inputs = self.tokenizer.pad(features, return_tensors="pt").to(device)
+                for i, embedding in zip(batch, self.forward(inputs).float().cpu().numpy()):
+                    embeddings[i] = embedding
+        return embeddings
+
+
+class SentenceEmbedder(MessageEmbedder):
+    """
+    Pooled sentence embedding of a sentence-transformers model (SENTENCE_TRANSFORMERS_MODEL_NAME)
+    """
+    def __init__(self, model_name: Optional[str] = None, **kwargs):
+        super().__init__(model_name or os.environ["SENTENCE_TRANSFORMERS_MODEL_NAME"], **kwargs)
+        self.max_length = min(MAX_LENGTH, self.model.max_seq_length) if hasattr(self.model, "max_seq_length") else MAX_LENGTH
+
+    def load(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        device = "cpu" if self.precision == "int8" else self.device
+        model = SentenceTransformer(model_name, device=device)
+        return model.tokenizer, model
+
+    def forward(self, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        return self.model(dict(inputs))["sentence_embedding"]
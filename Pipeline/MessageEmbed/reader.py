@@ -1,5 +1,8 @@
 from typing import Optional, List, Tuple, Generator
 import logging
+import threading
+import queue
+import time
 import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine, text
@@ -7,61 +10,138 @@ from sqlalchemy.orm import Session
 
 from common.utils import create_postgres_engine
 from common.backend.models import MessageChain, MessageChainEmbeddingsHegemmav2
+from common import metrics
+
+
+PAGE_ROWS = 4096 # rows per named cursor, each page in its own transaction so no snapshot is held for long
+PREFETCH_BATCHES = 4 # batches read ahead while the model runs
+PUT_TIMEOUT = 1 # seconds between checks for a stopped consumer while the prefetch queue is full
+MIN_KEY = (-2**63, -2**63)
+
+READ_BATCH_SECONDS = metrics.histogram("telelog_embed_read_seconds", "Time to read one batch of chains to embed")
+READ_WAIT_SECONDS = metrics.counter("telelog_embed_read_wait_seconds_total", "Time the embedder waited for the reader")
+
+
+def select_unembedded(*, require_channel_responses: bool) -> str:
+    """
+    The chains without an embedding after a (chat_id, last_message_id) key, in key order. The key comparison
+    and the ORDER BY follow the primary key of message_chain, so every page starts where the previous one
+    ended instead of rescanning it, and rows embedded meanwhile can't shift the pages
+    """
+    where_channel_responses = """
+        AND (m.chat_id IN (select chat_id from hebrew_chats where type='supergroup'))
+        AND (m.sent_by_linked_chat IS TRUE)
+        AND (m.chain_len>5)
+    """ if require_channel_responses else ""
+    return f"""
+        SELECT m.chat_id, m.last_message_id, m.chain
+        FROM {MessageChain.__tablename__} m
+        WHERE (m.chat_id, m.last_message_id) > (%(chat_id)s, %(last_message_id)s)
+        {where_channel_responses}
+        AND NOT EXISTS (
+            SELECT 1 FROM {MessageChainEmbeddingsHegemmav2.__tablename__} e
+            WHERE e.chat_id = m.chat_id AND e.last_message_id = m.last_message_id AND e.embedding IS NOT NULL
+        )
+        ORDER BY m.chat_id, m.last_message_id
+        LIMIT %(limit)s
+    """
+
 
 class MessageReader:
     
     def __init__(self):
         self.engine = create_postgres_engine()
-        self.ongoing_session = None
         self.killed = False
 
+    def _read_page(self, stmt: str, after: Tuple[int, int], batch_size: int, stop: threading.Event) -> Generator[List[Tuple[int, int, str]], None, None]:
+        """
+        Runs on the reader thread, which is the only one to touch its connection
+        """
+        conn = self.engine.raw_connection()
+        try:
+            # named cursor: the page is streamed from the server batch by batch instead of loaded at once
+            cur = conn.cursor(name="message_reader")
+            cur.itersize = batch_size
+            cur.execute(stmt, dict(chat_id=after[0], last_message_id=after[1], limit=PAGE_ROWS))
+            while not (self.killed or stop.is_set()):
+                t_start = time.time()
+                rows = cur.fetchmany(batch_size)
+                READ_BATCH_SECONDS.observe(time.time() - t_start)
+                if not rows:
+                    break
+                yield [(row[0], row[1], row[2]) for row in rows]
+            cur.close()
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def _put(self, out: queue.Queue, item, stop: threading.Event) -> bool:
+        """
+        Waits for room in out unless the reader is killed or the consumer stopped. Returns whether item was put
+        """
+        while not (self.killed or stop.is_set()):
+            try:
+                out.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prefetch(self, out: queue.Queue, batch_size: int, require_channel_responses: bool, stop: threading.Event):
+        stmt = select_unembedded(require_channel_responses=require_channel_responses)
+        after = MIN_KEY
+        try:
+            while not (self.killed or stop.is_set()):
+                n = 0
+                for batch in self._read_page(stmt, after, batch_size, stop):
+                    if not self._put(out, batch, stop):
+                        return
+                    n += len(batch)
+                    after = (batch[-1][0], batch[-1][1])
+                if n < PAGE_ROWS:
+                    break
+        except Exception as e:
+            self._put(out, e, stop)
+        finally:
+            self._put(out, None, stop)
+
     def get_messages(self, *, batch_size: int = 128, require_channel_responses: bool = False) -> Generator[List[Tuple[int, int, str]], None, None]:
         """
         Generator yielding the next batch of messages.
+        Batches are read on a background thread, up to PREFETCH_BATCHES ahead of the consumer.
         
         Yields:
             List of tuples: A list of (chat_id, last_message_id, chain) tuples.
         """
         logging.info("Starting message reader")
-        with Session(self.engine) as session:
-            self.ongoing_session = session
-            offset = 0
-            where_channel_responses = f"""
-                            WHERE (chat_id IN (select chat_id from hebrew_chats where type='supergroup'))
-                            AND (sent_by_linked_chat IS TRUE)
-                            AND (chain_len>5)
-                            """ if require_channel_responses else ""
-            while not self.killed:
-
-                stmt = text(f"""
-                    SELECT m.chat_id, m.last_message_id, m.chain
-                    FROM (
-                            SELECT * FROM {MessageChain.__tablename__}
-                            {where_channel_responses}
-                    ) m
-                    LEFT JOIN {MessageChainEmbeddingsHegemmav2.__tablename__} e
-                    USING (chat_id, last_message_id)
-                    WHERE e.embedding IS NULL
-                    LIMIT :batch_size
-                    OFFSET :offset
-                """).bindparams(batch_size=batch_size, offset=offset)
-                result = session.execute(stmt)
-                messages = result.fetchall()
-                # chat_id, last_message_id, chain
-                messages = [(row[0], row[1], row[2]) for row in messages]
-
-                if not messages:
+        batches: queue.Queue = queue.Queue(maxsize=PREFETCH_BATCHES)
+        stop = threading.Event() # set once the consumer stops iterating, so the reader thread doesn't wait on it
+        thread = threading.Thread(target=self._prefetch, args=(batches, batch_size, require_channel_responses, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t_start = time.time()
+                try:
+                    batch = batches.get(timeout=PUT_TIMEOUT)
+                except queue.Empty:
+                    if self.killed or (not thread.is_alive() and batches.empty()):
+                        break # the reader thread gave up on us
+                    continue
+                finally:
+                    READ_WAIT_SECONDS.inc(time.time() - t_start)
+                if batch is None:
                     break  # No more messages to process
-
-                yield messages  # Yield the batch
-
-                offset += batch_size 
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch  # Yield the batch
+        finally:
+            stop.set()
     
     def kill(self):
+        """
+        Stops the reader thread at its next batch - it closes its own connection
+        """
         self.killed = True
-        if self.ongoing_session:
-            self.ongoing_session.close()
-            self.ongoing_session = None
     
     def __del__(self):
         self.kill()
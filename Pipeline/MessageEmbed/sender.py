@@ -1,95 +1,148 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import logging
 import numpy as np
 import zmq
-import sys
 import os
 import threading
 import queue
-from collections import defaultdict
 import time
+from common import metrics
+from common.embed_protocol import encode_batch, decode_ack, ACK_STORED
+
+
+ZMQ_CREDITS = int(os.environ.get("ZMQ_CREDITS", 8)) # batches sent and not acknowledged yet
+ZMQ_EMBED_DTYPE = os.environ.get("ZMQ_EMBED_DTYPE", "float32") # float16 halves the bytes on the wire
+ZMQ_ACK_TIMEOUT = float(os.environ.get("ZMQ_ACK_TIMEOUT", 300)) # seconds before an unacknowledged batch is sent again
+RETRY_DELAY = 10 # seconds before a batch EmbedQueue failed to store is sent again
+MAX_RESENDS = 5 # times a batch is sent again before it's dropped and logged
+OUTBOX_BATCHES = 256 # batches waiting for credit before add() blocks
+POLL_MS = 100
+
+ZMQ_SENT_MESSAGES = metrics.counter("telelog_zmq_sent_embeddings_total", "Embeddings sent to EmbedQueue")
+ZMQ_SENT_BYTES = metrics.counter("telelog_zmq_sent_bytes_total", "Bytes sent to EmbedQueue")
+ZMQ_SEND_SECONDS = metrics.histogram("telelog_zmq_send_seconds", "Time from sending a batch to its acknowledgement")
+ZMQ_RESENT = metrics.counter("telelog_zmq_resent_batches_total", "Batches sent again after a failure or a missing ack", ["reason"])
+ZMQ_DROPPED = metrics.counter("telelog_zmq_dropped_embeddings_total", "Embeddings given up on after MAX_RESENDS resends")
+SENDER_PENDING = metrics.gauge("telelog_sender_pending", "Embeddings queued in SenderQueue and not acknowledged or dropped yet")
 
 
 class SenderQueue:
+    """
+    Sends batches of embeddings to EmbedQueue from a background thread (common/embed_protocol.py).
+    add() only queues, so the model keeps running while batches wait for credit or acknowledgement
+    """
     def __init__(self):
         self.host = os.environ["ZMQ_HOST"]
         self.port = os.environ["ZMQ_PORT"]
+        self.dtype = np.dtype(ZMQ_EMBED_DTYPE)
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect(f"tcp://{self.host}:{self.port}")
-        self.lock: threading.Lock = threading.Lock()
-        self.queue: Dict[int, queue.Queue] = defaultdict(queue.Queue)
+        self.outbox: queue.Queue = queue.Queue(maxsize=OUTBOX_BATCHES)
+        self.in_flight: Dict[int, Tuple[float, float, List]] = dict() # seq -> (sent at, resend at, frames)
         self.thread = threading.Thread(target=self._runner, daemon=True)
         self.started = False
         self.killed = False
-        self.n_pending, self.n_sent, self.n_ack = 0, 0, 0
+        self._seq = 0
+        self.n_pending, self.n_sent, self.n_ack, self.n_dropped = 0, 0, 0, 0
+        SENDER_PENDING.set_function(lambda: self.n_pending - self.n_ack - self.n_dropped)
 
-    def _send(self, chat_id: int, message_ids: List[int], embeddings: List[np.ndarray]):
-        n = len(message_ids)
-        if n == 0:
-            return True
-        assert len(embeddings) == n
-        metadata = f"{chat_id}:{n}:{','.join([str(x) for x in message_ids])}"
-        metadata_bytes = metadata.encode()
-        self.socket.send(metadata_bytes)
-        
-        for i in range(n):
-            embedding = embeddings[i]
-            embedding_bytes = embedding.tobytes()
-            self.socket.send(embedding_bytes)
-            self.n_sent += 1
-            #self.n_ack += 1
-        return True
-
-    def add(self, chat_ids: List[int], message_ids: List[List[int]], embeddings: List[np.ndarray]):
+    def add(self, chat_ids: List[int], message_ids: List[int], embeddings: List[np.ndarray]):
         if self.killed:
             raise RuntimeError("Queue is dead")
+        if not len(chat_ids):
+            return
         if not self.started:
             logging.info("Starting thread")
             self.started = True
             self.thread.start()
-        with self.lock:
-            logging.info(f"Obtained lock")
-            for chat_id, message_id, embedding in zip(chat_ids, message_ids, embeddings):
-                self.queue[chat_id].put((message_id, embedding))
-                self.n_pending += 1
-    
-    def kill(self):
+        self._seq += 1
+        item = (self._seq, len(chat_ids), encode_batch(self._seq, chat_ids, message_ids, embeddings, self.dtype))
+        while True:
+            if not self.thread.is_alive():
+                raise RuntimeError("SenderQueue runner is dead")
+            try:
+                self.outbox.put(item, timeout=POLL_MS / 1000)
+                break
+            except queue.Full:
+                continue
+        self.n_pending += len(chat_ids)
+
+    def kill(self, timeout: float = ZMQ_ACK_TIMEOUT):
+        """
+        Stops once everything queued is acknowledged, or after timeout
+        """
+        if self.killed:
+            return
         self.killed = True
         logging.info("Killing SenderQueue")
-        with self.lock:
-            for q in self.queue.values():
-                q.put(None)  # Sentinel value to stop the consumer loop
-        self.thread.join()
-        logging.info("SenderQueue killed")
-    
-    def _monitor(self):
-        while not self.killed:
-            logging.info(f"Pending: {self.n_pending}, Sent: {self.n_sent}, Ack: {self.n_ack}")
-            time.sleep(5)
+        if self.started:
+            self.thread.join(timeout)
+        logging.info(f"SenderQueue killed. Pending: {self.n_pending}, Sent: {self.n_sent}, Ack: {self.n_ack}, Dropped: {self.n_dropped}")
+
+    def _send(self, socket: zmq.Socket, seq: int, frames: List):
+        socket.send_multipart(frames, copy=False)
+        now = time.time()
+        self.in_flight[seq] = (now, now + ZMQ_ACK_TIMEOUT, frames)
+        ZMQ_SENT_BYTES.inc(sum(memoryview(f).nbytes for f in frames))
+
+    def _drop(self, seq: int, n: int, frames: List):
+        """
+        Gives up on a batch and frees its credit. The keys are logged so the embeddings can be redone
+        """
+        keys = np.frombuffer(frames[1], dtype=np.int64).reshape(-1, 2)
+        logging.error(f"Dropping batch {seq} of {n} embeddings after {MAX_RESENDS} resends, keys (chat_id, message_id): {keys.tolist()}")
+        del self.in_flight[seq]
+        self.n_dropped += n
+        ZMQ_DROPPED.inc(n)
 
     def _runner(self):
-        while not self.killed:
-            with self.lock:
-                chat_ids = list(self.queue.keys())
-            for chat_id in chat_ids:
-                q = self.queue[chat_id]
-                if len(q) < 1024:
-                    continue
-                all_message_ids = []
-                all_embeddings = []
-                with self.lock:
-                    while not q.empty():
-                        message_id, embedding = q.get()
-                        all_message_ids.append(message_id)
-                        all_embeddings.append(embedding)
-                try:
-                    self._send(chat_id, all_message_ids, all_embeddings)
-                except Exception as e:
-                    logging.error(f"Error sending data: {e}")
-                    # Handle error (e.g., re-queue data, log, etc.)
-                finally:
-                    q.task_done()
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f"tcp://{self.host}:{self.port}")
+        sizes: Dict[int, int] = dict()
+        resends: Dict[int, int] = dict()
+        failed = set() # in flight, waiting RETRY_DELAY to be sent again
+        try:
+            while not (self.killed and self.outbox.empty() and not self.in_flight):
+                while len(self.in_flight) < ZMQ_CREDITS and not self.outbox.empty():
+                    seq, n, frames = self.outbox.get()
+                    sizes[seq] = n
+                    self._send(socket, seq, frames)
+                    self.n_sent += n
+                    ZMQ_SENT_MESSAGES.inc(n)
+                if socket.poll(POLL_MS, zmq.POLLIN):
+                    seq, status = decode_ack(socket.recv())
+                    if seq not in self.in_flight:
+                        continue # ack of a batch sent twice
+                    sent_at, _, frames = self.in_flight[seq]
+                    if status == ACK_STORED:
+                        del self.in_flight[seq]
+                        ZMQ_SEND_SECONDS.observe(time.time() - sent_at)
+                        self.n_ack += sizes.pop(seq)
+                        resends.pop(seq, None)
+                    elif resends.get(seq, 0) >= MAX_RESENDS:
+                        self._drop(seq, sizes.pop(seq), frames)
+                        resends.pop(seq, None)
+                    else:
+                        logging.warning(f"EmbedQueue failed to store batch {seq}, sending it again in {RETRY_DELAY}s")
+                        ZMQ_RESENT.labels(reason="failed").inc()
+                        self.in_flight[seq] = (sent_at, time.time() + RETRY_DELAY, frames)
+                        failed.add(seq)
+                for seq, (sent_at, resend_at, frames) in list(self.in_flight.items()):
+                    if time.time() > resend_at:
+                        if seq not in failed and resends.get(seq, 0) >= MAX_RESENDS:
+                            self._drop(seq, sizes.pop(seq), frames)
+                            resends.pop(seq, None)
+                            continue
+                        resends[seq] = resends.get(seq, 0) + 1
+                        if seq not in failed:
+                            logging.warning(f"No ack of batch {seq} after {ZMQ_ACK_TIMEOUT}s, sending it again")
+                            ZMQ_RESENT.labels(reason="timeout").inc()
+                        failed.discard(seq)
+                        self._send(socket, seq, frames)
+        except Exception as e:
+            logging.error(f"SenderQueue runner failed: {e}")
+        finally:
+            socket.close()
         logging.info("SenderQueue runner exited")
     
     def __del__(self):
@@ -13,6 +13,7 @@ import datetime
 import time
 from common.consts import consts
 from common.backend.config import Config
+from common import metrics
 import signal
 import sys
 from typing import Optional
@@ -194,6 +195,7 @@ async def main(*, session_name: str):
 
     started_app, started_db = False, False
 
+    metrics.start_http_server()
     logging.info("Connecting to DB")
     db = PostgresBackend()
     config = Config(project="MessageFetch")
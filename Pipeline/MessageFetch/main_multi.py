@@ -8,12 +8,15 @@ from pyrogram.enums import ChatType
 from pyrogram.types import Message, User, Chat, Dialog, ChatPreview
 from pyrogram import Client
 from pyrogram.errors import RPCError, FloodWait, Flood, UserAlreadyParticipant
-from common.backend.pg_backend import PostgresBackend
-from common.backend.base_backend import StoredDialog
+from common.backend.pg_async_backend import AsyncPostgresBackend
+from common.backend.base_backend import StoredDialog, FetchShard
 import datetime
 import time
 from common.consts import consts
 from common.backend.config import Config
+from common import metrics
+from common.rate_limit import RateGovernor
+from MessageFetch.scheduler import FetchScheduler, FetchTask, split_range
 import threading
 import signal
 import sys
@@ -28,11 +31,23 @@ logging.basicConfig(level=logging.INFO)
 SHOULD_FETCH_GROUPS = int(os.environ.get("TELEGRAM_FETCH_GROUPS", 0))
 TIME_PERIOD_FOR_GROUPS = datetime.timedelta(weeks=4)
 TRY_TO_JOIN_MISSING_CHANNELS = False
+# split channels with more missing messages than this into ranges (fetch_shards) fetched by several sessions at once (0 = off)
+FETCH_SPLIT_MESSAGES = int(os.environ.get("TELEGRAM_FETCH_SPLIT_MESSAGES", 100000))
+# ranges fetched at the same time by each session
+FETCH_TASKS_PER_SESSION = int(os.environ.get("TELEGRAM_FETCH_TASKS_PER_SESSION", 1))
+# fetch_shards.offset_id is moved down every this many messages, in the transaction committing them.
+# One get_chat_history page, so a restart never repeats a request
+SHARD_CHECKPOINT_MESSAGES = 100
 
 
 should_fetch_full = {int(x) for x in os.environ.get("TELEGRAM_FETCH_FULL", "").split(",") if x}
 
 
+MESSAGES_FETCHED = metrics.counter("telelog_messages_fetched_total", "Messages received from Telegram", ["session"])
+CHANNELS_PENDING = metrics.gauge("telelog_channels_pending", "Channels left to fetch")
+CHANNEL_FETCH_SECONDS = metrics.histogram("telelog_channel_fetch_seconds", "Time to fetch one channel", ["session", "status"], buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600))
+
+
 class StatusMessage:
     def __init__(self, app: Client, config, session_name: str, update_interval: float = 60):
         self._params = dict()
@@ -45,6 +60,7 @@ class StatusMessage:
         self._lock = asyncio.Lock()
         self._update_interval = update_interval
         self._prev_text = None
+        self._governor = RateGovernor.get(session_name)
     
     def set_params(self, **kwargs):
         self._params |= kwargs
@@ -61,7 +77,7 @@ class StatusMessage:
     async def _edit_text(self, text: str):
         if text == self._prev_text:
             return
-        await self._message.edit_text(self.text)
+        await self._governor.call(self._message.edit_text, self.text)
         self._prev_text = text
     
     async def _refresh_text(self):
@@ -91,7 +107,7 @@ class StatusMessage:
                 await self._refresh_text()
             except FloodWait as e:
                 logging.info(f"Got floodwait with {e.value}")
-                await asyncio.sleep(float(e.value))
+                await asyncio.sleep(float(e.value)) # already recorded by the governor
             except Exception as e:
                 logging.warning(f"Failed to edit message, error: {e}")
             await asyncio.sleep(self._update_interval)
@@ -107,16 +123,15 @@ class StatusMessage:
 class WorkerQueue:
 
     def __init__(self, session_names: List[str]):
-        self.db = PostgresBackend()
+        self.db = AsyncPostgresBackend()
         self.all_dialogs: Dict[int, Dialog] = dict()
-        self.lock = asyncio.Lock()
         self.session_names = session_names
         self.workers = []
-        self.offsets = self.db.get_offsets_from_ongoing_writes()
+        self.offsets: Dict[int, int] = dict()
         self.channel_counts: Dict[int, int] = defaultdict(lambda: 0)
         self.compatible_channels: Dict[str, Set[int]] = defaultdict(set) # for every worker, compatible channels
-        self.channel_busy: Dict[int, bool] = defaultdict(lambda: False)
-        self.pending: List[int] = list()
+        self.scheduler = FetchScheduler(session_names)
+        self.fetch_top: Dict[int, int] = dict() # top of the range being backfilled, per chat
         self.app: Dict[str, Client] = dict()
         self.status_msg: Dict[str, StatusMessage] = dict()
         self.stored_dialogs: Dict[int, StoredDialog] = dict()
@@ -125,6 +140,7 @@ class WorkerQueue:
         self.task = None
         self.stopped = False
         self.stop_lock = threading.Lock()
+        CHANNELS_PENDING.set_function(lambda: self.scheduler.pending_channels)
 
     async def try_join(self, session_name: str, join_links: str|int|List[str|int], timeout: float = 5) -> bool:
         app = self.app[session_name]
@@ -166,7 +182,8 @@ class WorkerQueue:
         self.compatible_channels[session_name].add(dialog.chat.id)
         self.joined_channels[session_name].add(dialog.chat.id)
 
-    async def _fetch_channel(self, session_name: str, chat_id: int) -> bool:
+    async def _fetch_channel(self, session_name: str, task: FetchTask) -> bool:
+        chat_id = task.chat_id
         dialog = self.all_dialogs[chat_id]
         app = self.app[session_name]
         status_msg = self.status_msg[session_name]
@@ -177,84 +194,123 @@ class WorkerQueue:
             success = await self.try_join(session_name, [chat_id, stored_dialog.invite_link, stored_dialog.username])
             if not success:
                 status_msg.set_params(status="failed to join")
+                await self.scheduler.failed(task, session_name)
                 return False
         status_msg.set_params(status=f"joined channel {chat_id}")
         t_start = time.time()
+        fetched = MESSAGES_FETCHED.labels(session=session_name)
+        since_checkpoint = 0
         try:
-            offset = self.offsets.get(dialog.chat.id, dialog.top_message.id)
             if dialog.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP] and dialog.chat.id not in should_fetch_full:
                 min_date = datetime.datetime.now() - TIME_PERIOD_FOR_GROUPS
             else:
                 min_date = datetime.datetime(year=1970, month=1, day=1)
-            async for row in app.get_chat_history(dialog.chat.id, offset_id=offset):
+            async for row in RateGovernor.get(session_name).chat_history(app, dialog.chat.id, offset_id=task.offset_id):
                 #if self.channel_counts[dialog.chat.id] % 1000 == 0:
                 #    logging.info(f"{session_name} fetched {self.channel_counts[dialog.chat.id]} msgs from {chat_id}")
-                if row.id <= self.id_to_max_committed_message.get(dialog.chat.id, -1):
+                if row.id <= task.min_id:
                     break
                 if row.date < min_date:
                     break
-                self.db.add_message(row)
+                await self.db.add_message(row)
+                task.advance(row.id)
                 self.channel_counts[dialog.chat.id] += 1
-            logging.info(f"{session_name} finished fetching {chat_id} in {time.time() - t_start:.2f} seconds")
-            self.db.set_top_message_id_to_db_max(dialog.chat.id)
+                fetched.inc()
+                since_checkpoint += 1
+                if since_checkpoint >= SHARD_CHECKPOINT_MESSAGES:
+                    since_checkpoint = 0
+                    await self.db.checkpoint_fetch_shard(chat_id, task.min_id, task.offset_id, session=session_name)
+            logging.info(f"{session_name} finished fetching {task} in {time.time() - t_start:.2f} seconds")
+            CHANNEL_FETCH_SECONDS.labels(session=session_name, status="done").observe(time.time() - t_start)
+            await self.db.checkpoint_fetch_shard(chat_id, task.min_id, task.offset_id, done=True, session=session_name)
+            if await self.scheduler.done(task):
+                # not past the fetched range - MessageLive may have stored newer messages above a gap
+                await self.db.set_top_message_id_to_db_max(dialog.chat.id, at_most=self.fetch_top[chat_id])
             return True
+        except FloodWait as e:
+            logging.warning(f"{session_name} got FloodWait of {e.value} seconds on {task}, handing it back")
+            await self._checkpoint_after_error(session_name, task)
+            CHANNEL_FETCH_SECONDS.labels(session=session_name, status="floodwait").observe(time.time() - t_start)
+            await self.scheduler.floodwait(task, session_name, float(e.value))
+            return False
         except Exception as e:
-            logging.warning(f"{session_name} failed to fetch {chat_id}, error: {e}")
-            self.channel_counts[dialog.chat.id] = 0
+            logging.warning(f"{session_name} failed to fetch {task}, error: {e}")
+            await self._checkpoint_after_error(session_name, task)
+            CHANNEL_FETCH_SECONDS.labels(session=session_name, status="failed").observe(time.time() - t_start)
+            await self.scheduler.failed(task, session_name)
             return False
     
+    async def _checkpoint_after_error(self, session_name: str, task: FetchTask):
+        try:
+            await self.db.checkpoint_fetch_shard(task.chat_id, task.min_id, task.offset_id, session=session_name)
+        except Exception as e:
+            logging.warning(f"{session_name} could not checkpoint {task}, a restart repeats the last page: {e}")
+
     async def _run_worker_1_gather_dialogs(self, session_name: str):
         logging.info(f"{session_name} entered gather dialogs")
         try:
-            async for dialog in self.app[session_name].get_dialogs():
+            async for dialog in RateGovernor.get(session_name).dialogs(self.app[session_name]):
                 #logging.info(f"{session_name} got dialog {dialog.chat.id}")
                 self._add_channel(session_name, dialog)
         except:
             raise
 
     async def _run_worker_2_perform_fetching_loop(self, session_name: str):
-        logging.info(f"{session_name} entered fetching loop with {len(self.pending)} pending")
-        while self.pending and self.compatible_channels[session_name]:
-            selected_chat_id = None
-            async with self.lock:
-                q = [(i,chat_id) for i, chat_id in enumerate(self.pending)]
-                for i, chat_id in q:
-                    if chat_id not in self.compatible_channels[session_name]:
-                        continue
-                    if self.channel_busy[chat_id]:
-                        continue
-                    self.channel_busy[chat_id] = True
-                    selected_chat_id = chat_id
-                    break
-            self.status_msg[session_name].set_params(selected_chat_id = selected_chat_id)
-            if selected_chat_id is None:
-                await asyncio.sleep(1)
-                continue
-            logging.info(f"{session_name} selected {selected_chat_id}")
-            success = await self._fetch_channel(session_name, selected_chat_id)
+        logging.info(f"{session_name} entered fetching loop with {self.scheduler.pending_channels} pending")
+        while True:
+            task = await self.scheduler.next_task(session_name)
+            if task is None:
+                break
+            self.status_msg[session_name].set_params(selected_chat_id = task.chat_id)
+            logging.info(f"{session_name} selected {task}")
+            success = await self._fetch_channel(session_name, task)
             logging.info(f"{session_name} finished fetch loop with success={success}")
-            async with self.lock:
-                #logging.info(f"{session_name} acquired lock")
-                if success:
-                    self.pending.remove(selected_chat_id)
-                else:
-                    self.compatible_channels[session_name].remove(selected_chat_id)
-                    self.channel_counts[selected_chat_id] = 0
-                self.channel_busy[selected_chat_id] = False
-        if self.pending:
-            async with self.lock:
-                logging.warning(f"Worker {session_name} died prematurely")
+        if not self.scheduler.finished:
+            logging.warning(f"Worker {session_name} has nothing left it can fetch, {self.scheduler.pending_channels} channels still pending")
         else:
             logging.info(f"Worker {session_name} finished")
     
+    async def _schedule(self, channels: List[int]):
+        """
+        Resumes the fetch_shards of interrupted channels and shards the rest
+        """
+        shards: Dict[int, List[FetchShard]] = await self.db.get_fetch_shards()
+        tasks: List[FetchTask] = []
+        new_shards: List[FetchShard] = []
+        for chat_id in channels:
+            sessions = [session_name for session_name in self.session_names if chat_id in self.compatible_channels[session_name]]
+            if chat_id in shards:
+                open_shards = [s for s in shards[chat_id] if not s.done]
+                self.fetch_top[chat_id] = max(s.max_id for s in shards[chat_id])
+                if not open_shards:
+                    # every shard finished, but we stopped before moving top_message_id
+                    await self.db.set_top_message_id_to_db_max(chat_id, at_most=self.fetch_top[chat_id])
+                    continue
+                logging.info(f"Resuming {len(open_shards)}/{len(shards[chat_id])} shards of {chat_id}")
+                tasks += [FetchTask(chat_id, s.offset_id, s.min_id, sessions) for s in open_shards]
+                continue
+            chat_tasks = split_range(
+                chat_id,
+                self.id_to_top_available_message[chat_id],
+                self.id_to_max_committed_message[chat_id],
+                sessions,
+                FETCH_SPLIT_MESSAGES,
+            )
+            self.fetch_top[chat_id] = max(t.offset_id for t in chat_tasks)
+            tasks += chat_tasks
+            new_shards += [FetchShard(t.chat_id, t.min_id, t.offset_id, t.offset_id, False) for t in chat_tasks]
+        await self.db.add_fetch_shards(new_shards)
+        self.scheduler.add(tasks)
+
     async def _run_worker_0_db_sync(self, barrier_1: asyncio.Barrier, barrier_2: asyncio.Barrier):
         logging.info(f"Worker 0 waiting for barrier 1")
         await barrier_1.wait()
         logging.info(f"Beginning worker 0 db sync, got {len(self.all_dialogs)} dialogs")
         assert self.all_dialogs, f"Something weird happened - we have no dialogs"
-        self.db.add_channel(list(self.all_dialogs.values()))
+        await self.db.add_channel(list(self.all_dialogs.values()))
         logging.info(f"Finished worker 0 db sync")
-        self.stored_dialogs: Dict[int, StoredDialog] = self.db.get_stored_dialogs_committed()
+        self.offsets = await self.db.get_offsets_from_ongoing_writes()
+        self.stored_dialogs: Dict[int, StoredDialog] = await self.db.get_stored_dialogs_committed()
         logging.info(f"Fetched {len(self.stored_dialogs)} stored dialogs")
         self.stored_dialogs = {
             k: v for k, v in self.stored_dialogs.items()
@@ -280,22 +336,20 @@ class WorkerQueue:
             if v > 0:
                 interesting[k] = (self.id_to_top_available_message[k], self.id_to_max_committed_message[k], v)
         print(interesting)
-        sorted_channels = sorted(self.id_to_leftovers.items(), key=lambda x: x[1], reverse=False) # sort in ascending order
-        self.all_channels = [x[0] for x in sorted_channels]
-        self.all_channels = [x for x in self.all_channels if x in self.offsets.keys()] + [x for x in self.all_channels if x not in self.offsets.keys()]
-        self.all_channels = [x for x in self.all_channels if self.id_to_leftovers[x] > 0]
-        self.pending = self.all_channels
+        self.all_channels = [x for x in self.id_to_leftovers.keys() if self.id_to_leftovers[x] > 0]
         if TRY_TO_JOIN_MISSING_CHANNELS:
             for chat_id in self.all_channels:
                 for session_name in self.session_names:
                     self.compatible_channels[session_name].add(chat_id)
+        await self._schedule(self.all_channels)
+        logging.info(f"Scheduled {self.scheduler.pending_channels} channels: {self.scheduler.stats()}")
         total_left_count: int = sum(list(self.id_to_leftovers.values()))
         logging.info(f"Total left count: {total_left_count}")
         await barrier_2.wait()
-        logging.info(f"Passed barrier 2 with pending {len(self.pending)}")
+        logging.info(f"Passed barrier 2 with pending {self.scheduler.pending_channels}")
         start_time = time.time()
         saved_count = sum(list(self.channel_counts.values()))
-        while self.pending:
+        while not self.scheduler.finished:
             saved_count = sum(list(self.channel_counts.values()))
             #saved_count_diff = max(new_saved_count-saved_count, 0)
             rate_mps = saved_count / (time.time() - start_time)
@@ -305,7 +359,7 @@ class WorkerQueue:
             logging.info(f"{saved_count}, rate {rate_mps:.2f} mps, left {left_time}")
             for session_name in self.session_names:
                 self.status_msg[session_name].set_params(
-                    pending = len(self.pending),
+                    pending = self.scheduler.pending_channels,
                     saved_count = saved_count,
                     rate_mps = rate_mps,
                     left_time = left_time
@@ -315,7 +369,7 @@ class WorkerQueue:
 
     async def _run_worker_full(self, barrier_1: asyncio.Barrier, barrier_2: asyncio.Barrier, session_name: str):
         logging.info(f"{session_name} creating app")
-        self.app[session_name] = load_pyrogram_session(session_name)
+        self.app[session_name] = load_pyrogram_session(session_name, sleep_threshold=0) # FloodWaits go through RateGovernor
         logging.info(f"{session_name} starting app")
         await self.app[session_name].start()
         logging.info(f"{session_name} gathering dialogs")
@@ -332,7 +386,7 @@ class WorkerQueue:
         logging.info(f"{session_name} waiting for barrier 2")
         await barrier_2.wait()
         logging.info(f"{session_name} performing loop")
-        await self._run_worker_2_perform_fetching_loop(session_name)
+        await asyncio.gather(*[self._run_worker_2_perform_fetching_loop(session_name) for _ in range(FETCH_TASKS_PER_SESSION)])
         logging.info(f"{session_name} done, releasing context")
         await self.app[session_name].stop()
         await self.status_msg[session_name].stop()
@@ -346,9 +400,11 @@ class WorkerQueue:
         for session_name in self.session_names:
             tasks.append(self._run_worker_full(barrier_1, barrier_2, session_name))
         logging.info("Calling gather")
-        await asyncio.gather(*tasks)
-        logging.info("Closing DB")
-        self.db.close()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            logging.info("Closing DB")
+            await self.db.close()
         logging.info("_run_workers out")
     
     async def start(self):
@@ -372,16 +428,15 @@ class WorkerQueue:
             if self.stopped:
                 logging.warning(f"WorkerQueue.stop() - already stopped - NOP")
             self.stopped = True
-        logging.info("WorkerQueue.stop() - canceling task")
+        logging.info("WorkerQueue.stop() - canceling task (the DB is flushed and closed by _run_workers)")
         self.task.cancel()
-        logging.info("WorkerQueue.stop() - stopping DB")
-        self.db.close()
         logging.info(f"WorkerQueue.stop() - done, please wait for the start task to finish")
 
 
 async def main():
     session_names = os.environ["TELEGRAM_FETCH_WITH"].split(",")
     logging.info(f"Initializing with {session_names}")
+    metrics.start_http_server()
     workers = WorkerQueue(session_names=session_names)
     logging.info(f"Adding signal handler")
     for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGABRT]:
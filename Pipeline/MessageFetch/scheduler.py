@@ -0,0 +1,239 @@
+"""
+Assigns fetch work to the sessions of MessageFetch/main_multi.py.
+
+Work is a FetchTask: a message id range of one channel. Big channels can be split into several
+ranges, so a backfill takes about as long as its longest range instead of its longest channel.
+Tasks are assigned largest-first to the least loaded compatible session, and each session pops its
+own tasks from a heap keyed by remaining messages. A session without work of its own steals the
+biggest compatible task of the most loaded session (a session sitting out a FloodWait counts as the
+most loaded), and a FloodWait on a task sends it back to the queues for the other sessions.
+"""
+from typing import List, Dict, Set, Tuple, Optional, Iterable
+from collections import defaultdict
+import logging
+import asyncio
+import heapq
+import time
+
+
+class FetchTask:
+    """
+    Messages of chat_id with min_id < id < offset_id, fetched newest first
+    (get_chat_history(offset_id=offset_id), stopping at min_id)
+    """
+    PENDING, RUNNING, DONE, DROPPED = "pending", "running", "done", "dropped"
+
+    def __init__(self, chat_id: int, offset_id: int, min_id: int, sessions: Iterable[str]):
+        self.chat_id = chat_id
+        self.offset_id = offset_id
+        self.min_id = min_id
+        self.sessions: Set[str] = set(sessions) # sessions which can still fetch it
+        self.state = FetchTask.PENDING
+        self.owner: str = None
+        self.version = 0 # heap entries with an older version are stale
+        self.floodwaits = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(self.offset_id - self.min_id - 1, 0)
+
+    def advance(self, message_id: int):
+        """
+        Everything from message_id up was handed to the DB - a retry continues below it
+        """
+        self.offset_id = min(self.offset_id, message_id)
+
+    def __repr__(self) -> str:
+        return f"FetchTask({self.chat_id}, ({self.min_id}, {self.offset_id}), {self.state}, owner={self.owner})"
+
+
+def split_range(chat_id: int, offset_id: int, min_id: int, sessions: Iterable[str], chunk_size: int) -> List[FetchTask]:
+    """
+    Splits (min_id, offset_id) into ranges of about chunk_size ids (0 = don't split)
+    """
+    sessions = set(sessions)
+    span = offset_id - min_id - 1
+    if chunk_size <= 0 or span <= 2 * chunk_size:
+        return [FetchTask(chat_id, offset_id, min_id, sessions)]
+    n = -(-span // chunk_size)
+    bounds = [min_id + (span * i) // n for i in range(n + 1)]
+    bounds[-1] = offset_id - 1
+    tasks = []
+    for i in reversed(range(n)):
+        upper = offset_id if i == n - 1 else bounds[i + 1] + 1 # the top range keeps the original offset
+        tasks.append(FetchTask(chat_id, upper, bounds[i], sessions))
+    return tasks
+
+
+class FetchScheduler:
+    def __init__(self, session_names: List[str]):
+        self.session_names = list(session_names)
+        self._queues: Dict[str, List[Tuple[int, int, int, FetchTask]]] = {s: [] for s in self.session_names}
+        self._load: Dict[str, int] = defaultdict(int) # remaining messages of pending tasks owned by each session
+        self._penalized_until: Dict[str, float] = defaultdict(float)
+        self._blocked: Dict[Tuple[str, int], float] = dict() # (session, chat_id) -> time the session may retry the chat
+        self._tasks_of_chat: Dict[int, List[FetchTask]] = defaultdict(list)
+        self._unfinished: Set[FetchTask] = set()
+        self._seq = 0
+        self._cond: asyncio.Condition = None
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        # created lazily, inside the running loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @property
+    def finished(self) -> bool:
+        return not self._unfinished
+
+    @property
+    def pending_channels(self) -> int:
+        return len({t.chat_id for t in self._unfinished})
+
+    @property
+    def remaining_messages(self) -> int:
+        return sum(t.remaining for t in self._unfinished)
+
+    def stats(self) -> Dict[str, int]:
+        return {s: len([t for t in self._unfinished if t.owner == s]) for s in self.session_names}
+
+    def add(self, tasks: Iterable[FetchTask]):
+        """
+        Assigns tasks largest first, each to the compatible session with the least work (LPT)
+        """
+        for task in sorted(tasks, key=lambda t: t.remaining, reverse=True):
+            task.sessions &= set(self.session_names)
+            if not task.sessions:
+                logging.warning(f"FetchScheduler - no session can fetch {task.chat_id}, skipping it")
+                continue
+            self._tasks_of_chat[task.chat_id].append(task)
+            self._unfinished.add(task)
+            self._push(task, min(task.sessions, key=lambda s: self._load[s]))
+
+    def _push(self, task: FetchTask, owner: str):
+        task.state = FetchTask.PENDING
+        task.owner = owner
+        task.version += 1
+        self._seq += 1
+        self._load[owner] += task.remaining
+        heapq.heappush(self._queues[owner], (-task.remaining, self._seq, task.version, task))
+
+    def _take(self, task: FetchTask, session: str):
+        self._load[task.owner] -= task.remaining
+        task.version += 1 # invalidates its heap entry
+        task.state = FetchTask.RUNNING
+        task.owner = session
+
+    def _is_blocked(self, session: str, task: FetchTask, now: float) -> bool:
+        return self._blocked.get((session, task.chat_id), 0) > now
+
+    def _pop_own(self, session: str, now: float) -> Optional[FetchTask]:
+        q = self._queues[session]
+        deferred = []
+        task = None
+        while q:
+            entry = heapq.heappop(q)
+            _, _, version, t = entry
+            if t.state != FetchTask.PENDING or t.owner != session or t.version != version:
+                continue # stale
+            if self._is_blocked(session, t, now):
+                deferred.append(entry)
+                continue
+            task = t
+            break
+        for entry in deferred:
+            heapq.heappush(q, entry)
+        return task
+
+    def _steal(self, session: str, now: float) -> Optional[FetchTask]:
+        def victim_load(s: str) -> float:
+            return float("inf") if self._penalized_until[s] > now else self._load[s]
+        for victim in sorted((s for s in self.session_names if s != session), key=victim_load, reverse=True):
+            candidates = [
+                t for _, _, version, t in self._queues[victim]
+                if t.state == FetchTask.PENDING and t.owner == victim and t.version == version
+                and session in t.sessions and not self._is_blocked(session, t, now)
+            ]
+            if candidates:
+                task = max(candidates, key=lambda t: t.remaining)
+                logging.info(f"FetchScheduler - {session} steals {task} from {victim}")
+                return task
+        return None
+
+    def _has_work_for(self, session: str) -> bool:
+        return any(session in t.sessions for t in self._unfinished)
+
+    def _next_wakeup(self, session: str, now: float) -> Optional[float]:
+        times = [self._penalized_until[session]] + [
+            until for (s, chat_id), until in self._blocked.items() if s == session
+        ]
+        times = [t - now for t in times if t > now]
+        return min(times) if times else None
+
+    async def next_task(self, session: str) -> Optional[FetchTask]:
+        """
+        Waits for work for session. Returns None once nothing left can ever be fetched by it
+        """
+        async with self.cond:
+            while True:
+                now = time.time()
+                if not self._has_work_for(session):
+                    return None
+                if self._penalized_until[session] <= now:
+                    task = self._pop_own(session, now) or self._steal(session, now)
+                    if task is not None:
+                        self._take(task, session)
+                        return task
+                try:
+                    await asyncio.wait_for(self.cond.wait(), timeout=self._next_wakeup(session, now))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def done(self, task: FetchTask) -> bool:
+        """
+        Returns whether every range of the channel is fetched now
+        """
+        async with self.cond:
+            task.state = FetchTask.DONE
+            self._unfinished.discard(task)
+            self.cond.notify_all()
+            return all(t.state == FetchTask.DONE for t in self._tasks_of_chat[task.chat_id])
+
+    async def floodwait(self, task: FetchTask, session: str, seconds: float):
+        """
+        Puts the task back - other sessions can pick it up while session waits
+        """
+        async with self.cond:
+            until = time.time() + seconds
+            task.floodwaits += 1
+            self._penalized_until[session] = max(self._penalized_until[session], until)
+            self._blocked[(session, task.chat_id)] = until
+            others = [s for s in task.sessions if s != session and self._penalized_until[s] <= time.time()]
+            self._push(task, min(others, key=lambda s: self._load[s]) if others else session)
+            self.cond.notify_all()
+
+    async def failed(self, task: FetchTask, session: str):
+        """
+        session can't fetch the chat - move its ranges to other sessions, or drop them if none is left
+        """
+        async with self.cond:
+            task.state = FetchTask.PENDING
+            task.owner = session
+            self._load[session] += task.remaining # _reassign takes it off again
+            for t in self._tasks_of_chat[task.chat_id]:
+                t.sessions.discard(session)
+                if t.state == FetchTask.PENDING and (t is task or t.owner == session):
+                    self._reassign(t)
+            self.cond.notify_all()
+
+    def _reassign(self, task: FetchTask):
+        self._load[task.owner] -= task.remaining
+        task.version += 1
+        if task.sessions:
+            self._push(task, min(task.sessions, key=lambda s: self._load[s]))
+        else:
+            logging.warning(f"FetchScheduler - no session left for {task}, dropping it")
+            task.state = FetchTask.DROPPED
+            self._unfinished.discard(task)
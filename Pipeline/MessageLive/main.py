@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import os
+from typing import List, Dict, Set, Optional
+from collections import OrderedDict, defaultdict
+from common.utils import load_pyrogram_session
+from pyrogram import Client, idle, raw, utils
+from pyrogram.enums import ChatType
+from pyrogram.types import Message
+from pyrogram.handlers import MessageHandler, EditedMessageHandler, RawUpdateHandler
+from pyrogram.errors import RPCError, FloodWait
+from common.backend.pg_async_backend import AsyncPostgresBackend
+from common.backend.base_backend import StoredDialog
+from common.rate_limit import RateGovernor
+from common import metrics
+import datetime
+import asyncio
+import logging
+logging.basicConfig(level=logging.INFO)
+
+
+SHOULD_FETCH_GROUPS = int(os.environ.get("TELEGRAM_FETCH_GROUPS", 0))
+should_fetch_full = {int(x) for x in os.environ.get("TELEGRAM_FETCH_FULL", "").split(",") if x}
+
+TOP_MESSAGE_INTERVAL = 60 # seconds between top_message_id updates of chats with new live messages
+REACTION_REFRESH_INTERVAL = 30 # seconds to collect reaction updates before refetching the messages
+GET_MESSAGES_CHUNK = 100
+SEEN_CACHE_SIZE = 100000 # (chat, message, edit) triples remembered to drop duplicates from several sessions
+
+LIVE_MESSAGES = metrics.counter("telelog_live_messages_total", "Messages received from the update stream", ["session", "kind"])
+LIVE_LAG_SECONDS = metrics.histogram("telelog_live_lag_seconds", "Time from posting to receiving a new message", buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 3600))
+GAP_FILLS = metrics.counter("telelog_live_gap_fills_total", "History walks filling gaps of the update stream", ["session", "reason"])
+
+
+class ChatState:
+    def __init__(self, committed_top: Optional[int]):
+        self.committed_top = committed_top # chats.top_message_id when we started, None if the chat was never backfilled
+        self.first_live: Optional[int] = None
+        self.last_live: Optional[int] = None
+        self.gaps_pending = 0
+        self.contiguous = False # everything from committed_top up to last_live is queued
+        self.dirty = False
+
+
+class LiveIngester:
+    """
+    Streams new messages, edits and reaction changes of every session into the DB.
+    History is only walked to fill gaps of the stream: the range between the committed top_message_id and the
+    first live message of a chat, and chats Telegram reports as UpdateChannelTooLong.
+    Once a chat's gap is filled, top_message_id follows the stream.
+    """
+
+    def __init__(self, session_names: List[str]):
+        self.session_names = session_names
+        self.db = AsyncPostgresBackend()
+        self.app: Dict[str, Client] = dict()
+        self.chats: Dict[int, ChatState] = dict()
+        self._seen: OrderedDict = OrderedDict()
+        self._reactions: Dict[int, Set[int]] = defaultdict(set)
+        self._reactions_session: Dict[int, str] = dict()
+        self._gaps: asyncio.Queue = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _should_store(self, message: Message) -> bool:
+        if message.chat is None or message.empty:
+            return False
+        if message.chat.type == ChatType.CHANNEL:
+            return True
+        if message.chat.id in should_fetch_full:
+            return True
+        return message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP] and SHOULD_FETCH_GROUPS
+
+    def _is_new(self, message: Message) -> bool:
+        key = (message.chat.id, message.id, message.edit_date)
+        if key in self._seen:
+            return False
+        self._seen[key] = None
+        if len(self._seen) > SEEN_CACHE_SIZE:
+            self._seen.popitem(last=False)
+        return True
+
+    def _chat(self, chat_id: int) -> ChatState:
+        if chat_id not in self.chats:
+            self.chats[chat_id] = ChatState(None)
+        return self.chats[chat_id]
+
+    async def on_message(self, session_name: str, message: Message):
+        if not self._should_store(message) or not self._is_new(message):
+            return
+        await self.db.add_message(message)
+        LIVE_MESSAGES.labels(session=session_name, kind="new").inc()
+        if message.date:
+            LIVE_LAG_SECONDS.observe(max((datetime.datetime.now() - message.date).total_seconds(), 0))
+        chat = self._chat(message.chat.id)
+        chat.last_live = max(chat.last_live or message.id, message.id)
+        chat.dirty = True
+        if chat.first_live is None:
+            chat.first_live = message.id
+            if chat.committed_top is not None:
+                await self._queue_gap(session_name, message.chat.id, message.id, chat.committed_top, "start")
+
+    async def on_edited_message(self, session_name: str, message: Message):
+        if not self._should_store(message) or not self._is_new(message):
+            return
+        await self.db.add_message(message) # upsert - views, reactions and text follow the edit
+        LIVE_MESSAGES.labels(session=session_name, kind="edited").inc()
+
+    async def on_raw_update(self, session_name: str, update, users, chats):
+        if isinstance(update, raw.types.UpdateMessageReactions):
+            chat_id = utils.get_peer_id(update.peer)
+            if chat_id in self.chats:
+                self._reactions[chat_id].add(update.msg_id)
+                self._reactions_session[chat_id] = session_name
+        elif isinstance(update, raw.types.UpdateChannelTooLong):
+            chat_id = utils.get_channel_id(update.channel_id)
+            chat = self.chats.get(chat_id, None)
+            if chat is not None and chat.last_live is not None:
+                logging.info(f"{session_name} missed updates of {chat_id}, filling from {chat.last_live}")
+                await self._queue_gap(session_name, chat_id, 0, chat.last_live, "too_long")
+
+    async def _queue_gap(self, session_name: str, chat_id: int, offset_id: int, min_id: int, reason: str):
+        self._chat(chat_id).gaps_pending += 1
+        GAP_FILLS.labels(session=session_name, reason=reason).inc()
+        await self._gaps.put((session_name, chat_id, offset_id, min_id))
+
+    async def _gap_loop(self):
+        while True:
+            session_name, chat_id, offset_id, min_id = await self._gaps.get()
+            chat = self.chats[chat_id]
+            try:
+                n = 0
+                async for row in RateGovernor.get(session_name).chat_history(self.app[session_name], chat_id, offset_id=offset_id):
+                    if row.id <= min_id:
+                        break
+                    if self._is_new(row):
+                        await self.db.add_message(row)
+                        n += 1
+                logging.info(f"{session_name} filled {n} messages of {chat_id} in ({min_id}, {offset_id or 'top'})")
+                chat.contiguous = chat.contiguous or offset_id == chat.first_live
+            except (FloodWait, RPCError) as e:
+                logging.warning(f"{session_name} failed to fill ({min_id}, {offset_id}) of {chat_id}, retrying later: {e}")
+                await asyncio.sleep(float(getattr(e, "value", 0) or 60))
+                chat.gaps_pending += 1 # the finally below takes it off again
+                await self._gaps.put((session_name, chat_id, offset_id, min_id))
+                continue
+            except Exception as e:
+                # the chat stays non-contiguous, so its top_message_id isn't advanced over the gap
+                logging.exception(f"{session_name} failed to fill ({min_id}, {offset_id}) of {chat_id}: {e}")
+            finally:
+                chat.gaps_pending -= 1
+
+    async def _top_message_loop(self):
+        while True:
+            await asyncio.sleep(TOP_MESSAGE_INTERVAL)
+            for chat_id, chat in list(self.chats.items()): # handlers add chats while we await
+                if chat.dirty and chat.contiguous and not chat.gaps_pending:
+                    chat.dirty = False
+                    try:
+                        await self.db.set_top_message_id_to_db_max(chat_id, at_most=chat.last_live)
+                    except Exception as e:
+                        logging.exception(f"Failed to queue the top_message_id of {chat_id}, retrying next round: {e}")
+                        chat.dirty = True
+
+    async def _reaction_loop(self):
+        while True:
+            await asyncio.sleep(REACTION_REFRESH_INTERVAL)
+            pending, self._reactions = self._reactions, defaultdict(set)
+            for chat_id, message_ids in pending.items():
+                session_name = self._reactions_session[chat_id]
+                message_ids = sorted(message_ids)
+                for i in range(0, len(message_ids), GET_MESSAGES_CHUNK):
+                    try:
+                        messages = await RateGovernor.get(session_name).call(self.app[session_name].get_messages, chat_id, message_ids[i:i+GET_MESSAGES_CHUNK])
+                    except (FloodWait, RPCError) as e:
+                        logging.warning(f"{session_name} failed to refresh reactions of {chat_id}: {e}")
+                        continue
+                    except Exception as e:
+                        logging.exception(f"{session_name} failed to refresh reactions of {chat_id}: {e}")
+                        continue
+                    try:
+                        for m in messages:
+                            if not m.empty:
+                                await self.db.add_message(m)
+                    except Exception as e:
+                        logging.exception(f"{session_name} failed to queue the reactions of {chat_id}: {e}")
+                        continue
+                    LIVE_MESSAGES.labels(session=session_name, kind="reactions").inc(len(messages))
+
+    def _register(self, session_name: str, app: Client):
+        async def on_message(client, message):
+            await self.on_message(session_name, message)
+        async def on_edited_message(client, message):
+            await self.on_edited_message(session_name, message)
+        async def on_raw_update(client, update, users, chats):
+            await self.on_raw_update(session_name, update, users, chats)
+        app.add_handler(MessageHandler(on_message))
+        app.add_handler(EditedMessageHandler(on_edited_message))
+        app.add_handler(RawUpdateHandler(on_raw_update), group=1)
+
+    async def start(self):
+        stored_dialogs: Dict[int, StoredDialog] = await self.db.get_stored_dialogs_committed()
+        for chat_id, d in stored_dialogs.items():
+            self.chats[chat_id] = ChatState(d.max_id)
+        logging.info(f"Loaded {len(self.chats)} chats, {len([c for c in self.chats.values() if c.committed_top is not None])} with a committed top")
+        self._gaps = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._gap_loop()),
+            asyncio.create_task(self._top_message_loop()),
+            asyncio.create_task(self._reaction_loop()),
+        ]
+        for session_name in self.session_names:
+            app = load_pyrogram_session(session_name, sleep_threshold=0)
+            self.app[session_name] = app # the handlers look it up as soon as they're registered
+            self._register(session_name, app)
+            await app.start()
+            logging.info(f"{session_name} listening")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for session_name, app in self.app.items():
+            if app.is_connected: # registered before its start, which may have failed
+                await app.stop()
+        await self.db.close()
+
+
+async def main():
+    session_names = os.environ.get("TELEGRAM_LIVE_WITH", os.environ["TELEGRAM_FETCH_WITH"]).split(",")
+    logging.info(f"Initializing with {session_names}")
+    metrics.start_http_server()
+    ingester = LiveIngester(session_names)
+    await ingester.start()
+    try:
+        await idle()
+    finally:
+        logging.info("Stopping")
+        await ingester.stop()
+    logging.info("Finished")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
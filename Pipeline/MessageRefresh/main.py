@@ -1,88 +1,147 @@
 #!/usr/bin/env python3
 
 import os
-import time
 from typing import List, Dict, Tuple
+from collections import defaultdict
 from common.utils import load_pyrogram_session
-from pyrogram.enums import ChatType
-from pyrogram.types import Message, User, Chat, Dialog, ChatPreview
-from pyrogram.errors import RPCError, FloodWait, Flood
+from pyrogram import Client
+from pyrogram.errors import RPCError, FloodWait
 from common.backend.pg_backend import PostgresBackend
-from common.backend.base_backend import StoredDialog
+from common.backend.engagement_store import EngagementStore
+from common.rate_limit import RateGovernor
+from common import metrics
 import datetime
-import time
-from common.consts import consts
-from common.backend.config import Config
-import signal
-import sys
-from typing import Optional
-import random
 import asyncio
 import logging
 logging.basicConfig(level=logging.INFO)
 
 
-current_date = datetime.datetime.now()
-expected_runtime_limit = datetime.timedelta(hours=6)
-lookback = datetime.timedelta(days=7)
-run_over = datetime.timedelta(days=1) + expected_runtime_limit
-run_every = datetime.timedelta(days=1)
-assert run_every < run_over
-refresh_interval = (
-    current_date - lookback - run_over,
-    current_date - lookback
-)
+# views, forwards and reactions move fast right after posting and barely at all after a week,
+# so every message is refetched once at each of these ages instead of every day for a fixed window
+refresh_stages = [datetime.timedelta(hours=float(h)) for h in os.environ.get("TELEGRAM_REFRESH_HOURS", "1,6,24,168").split(",")]
+refresh_grace = datetime.timedelta(days=1) # messages past the last stage by more than this are never refetched
+assert refresh_stages == sorted(refresh_stages)
 
+DUE_PER_PASS = 20000
+GET_MESSAGES_CHUNK = 100 # ids per get_messages request
+IDLE_SLEEP = 300 # seconds to sleep once nothing is due
+FAILED_CHAT_BACKOFF = datetime.timedelta(minutes=30) # a chat get_messages failed on is left out of the passes this long
+FAILED_CHAT_GIVE_UP = 3 # failures in a row after which the due messages of a chat get empty samples and aren't due anymore
 
-async def main(db):
+REFRESHED = metrics.counter("telelog_engagement_refreshed_total", "Messages refetched for their counters", ["stage"])
+CHANGED = metrics.counter("telelog_engagement_changed_total", "Refetched messages whose counters changed")
+GAVE_UP = metrics.counter("telelog_engagement_gave_up_total", "Due messages given up on after their chat failed FAILED_CHAT_GIVE_UP times")
+
+
+class ChatBackoff:
+    """
+    Chats whose get_messages failed (private, kicked), with the number of failures in a row
+    """
+    def __init__(self):
+        self.failures: Dict[int, int] = dict()
+        self.until: Dict[int, datetime.datetime] = dict()
+
+    def excluded(self) -> List[int]:
+        now = datetime.datetime.now()
+        self.until = {chat_id: t for chat_id, t in self.until.items() if t > now}
+        return list(self.until)
+
+    def failed(self, chat_id: int) -> bool:
+        """
+        Returns whether to give up on the messages of the chat that are due now
+        """
+        self.failures[chat_id] = self.failures.get(chat_id, 0) + 1
+        if self.failures[chat_id] >= FAILED_CHAT_GIVE_UP:
+            self.failures.pop(chat_id)
+            return True
+        self.until[chat_id] = datetime.datetime.now() + FAILED_CHAT_BACKOFF
+        return False
+
+    def succeeded(self, chat_id: int):
+        self.failures.pop(chat_id, None)
 
-    started_app, started_db = False, False
-    fetch_min_date, fetch_max_date = refresh_interval
-    
-    config = Config(project="MessageRefresh")
-    previous_run = config.get("previous_run", current_date - run_every - datetime.timedelta(days=1))
-    if previous_run > current_date - run_every:
-        logging.info("Not running - last run was too recent")
-        return
 
+async def refresh_chat(app: Client, governor: RateGovernor, db: PostgresBackend, backoff: ChatBackoff, chat_id: int, due: List[Tuple[int, int]]) -> int:
+    """
+    Returns how many of the due messages were refreshed (or given up on)
+    """
+    stages: Dict[Tuple[int, int], int] = {(chat_id, message_id): stage for message_id, stage in due}
+    message_ids = sorted(message_id for message_id, _ in due)
+    done = 0
+    for i in range(0, len(message_ids), GET_MESSAGES_CHUNK):
+        chunk = message_ids[i:i+GET_MESSAGES_CHUNK]
+        try:
+            messages = await governor.call(app.get_messages, chat_id, chunk)
+        except FloodWait as e:
+            logging.warning(f"FloodWait of {e.value}s while refreshing {chat_id} - the rest stays due")
+            await asyncio.sleep(float(e.value))
+            return done
+        except RPCError as e:
+            # writing no samples would mark the messages as refreshed - the chat stays due, but sits out a while
+            if not backoff.failed(chat_id):
+                logging.warning(f"Can't refresh {chat_id}, the rest stays due after {FAILED_CHAT_BACKOFF}: {e}")
+                return done
+            logging.warning(f"Can't refresh {chat_id} for the {FAILED_CHAT_GIVE_UP}th time, giving up on its {len(message_ids) - i} due messages: {e}")
+            db.update_engagement([], {(chat_id, message_id): stages[(chat_id, message_id)] for message_id in message_ids[i:]})
+            GAVE_UP.inc(len(message_ids) - i)
+            return len(message_ids)
+        backoff.succeeded(chat_id)
+        chunk_stages = {(chat_id, message_id): stages[(chat_id, message_id)] for message_id in chunk}
+        changed = db.update_engagement([m for m in messages if not m.empty], chunk_stages)
+        for stage in chunk_stages.values():
+            REFRESHED.labels(stage=str(stage)).inc()
+        CHANGED.inc(changed)
+        done += len(chunk)
+    return done
+
+
+async def refresh_due(app: Client, governor: RateGovernor, db: PostgresBackend, backoff: ChatBackoff) -> Tuple[int, int]:
+    """
+    Refetches the messages which reached their next refresh age. Returns how many were due and how many of them
+    were refreshed
+    """
+    due = db.get_engagement_due(refresh_stages, grace=refresh_grace, limit=DUE_PER_PASS, exclude_chats=backoff.excluded())
+    by_chat: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+    for chat_id, message_id, stage in due:
+        by_chat[chat_id].append((message_id, stage))
+    logging.info(f"{len(due)} messages of {len(by_chat)} chats are due")
+    done = 0
+    for chat_id, chat_due in by_chat.items():
+        done += await refresh_chat(app, governor, db, backoff, chat_id, chat_due)
+    return len(due), done
+
+
+async def main(db):
     logging.info("Connecting to account")
-    app = load_pyrogram_session(os.environ["TELEGRAM_FETCH_WITH"].split(",")[0])
+    session_name = os.environ["TELEGRAM_FETCH_WITH"].split(",")[0]
+    app = load_pyrogram_session(session_name, sleep_threshold=0)
+    governor = RateGovernor.get(session_name)
     await app.start()
 
-    stored_dialogs: Dict[int, StoredDialog] = db.get_stored_dialogs_committed()
-
-    logging.info(f"Iterating over dialogs")
-    async for dialog in app.get_dialogs():
-        if dialog.chat is None:
-            continue
-        chat: Chat = dialog.chat
-        if chat.id not in stored_dialogs:
-            logging.warning(f"Chat {chat.id} not found in DB - skipping")
-            continue
-        if stored_dialogs[chat.id].max_id is None:
-            logging.warning(f"Chat {chat.id} has no messages - skipping")
-            continue
-        
-        logging.info(f"Fetching messages for {chat.id}")
-        async for row in app.get_chat_history(chat.id, offset_date=fetch_max_date):
-            if row.id > stored_dialogs[chat.id].max_id:
-                logging.warning(f"Message {row.id} is newer than max_id {stored_dialogs[chat.id].max_id} - this shouldn't happen - skipping")
-                break
-            if row.date < fetch_min_date:
-                break
-            db.add_message(row)
-        logging.info(f"Finished fetching messages for {chat.id}")
-    
-    config.set("previous_run", current_date) # current_time, not now(), so we don't have to account for shifting due to runtime duration
-    logging.info("Reached finish")
-
-    await app.stop()
+    logging.info(f"Iterating over dialogs") # get_messages needs the peers of the chats cached
+    async for dialog in governor.dialogs(app):
+        pass
+
+    store = EngagementStore()
+    backoff = ChatBackoff()
+    logging.info(f"Refreshing at {[str(s) for s in refresh_stages]}")
+    try:
+        while True:
+            n, done = await refresh_due(app, governor, db, backoff)
+            store.compact_all() # series and rollups follow every pass
+            if n < DUE_PER_PASS or not done:
+                await asyncio.sleep(IDLE_SLEEP)
+    finally:
+        await app.stop()
 
 
 if __name__ == "__main__":
     logging.info("Connecting to DB")
+    metrics.start_http_server()
     db = PostgresBackend()
-    asyncio.run(main(db))
-    logging.info("Closing DB")
-    db.close()
-    logging.info("Bye")
+    try:
+        asyncio.run(main(db))
+    finally:
+        logging.info("Closing DB")
+        db.close()
+        logging.info("Bye")
@@ -14,6 +14,7 @@ from collections import defaultdict
 import time
 from common.consts import consts
 from common.backend.config import Config
+from common.rate_limit import RateGovernor
 import signal
 import sys
 from typing import Optional
@@ -60,10 +61,11 @@ async def main(*, app = None, db = None):
 
     logging.info("Connecting to account")
     app = load_pyrogram_session(config, default_session_string=consts["TELEGRAM_SESSION_STRING_MAIN"])
+    governor = RateGovernor.get("main")
     await app.start()
 
     logging.info("Fetching dialogs")
-    dialog_dicts = [compose_insert_chat_dict_query(clean_dict(dialog.chat)) async for dialog in app.get_dialogs()]
+    dialog_dicts = [compose_insert_chat_dict_query(clean_dict(dialog.chat)) async for dialog in governor.dialogs(app)]
     for i in range(len(dialog_dicts)):
         dialog_dicts[i].pop("top_message", None)
         dialog_dicts[i].pop("top_message_id", None)
@@ -91,7 +93,7 @@ async def main(*, app = None, db = None):
         while attempts_left:
             attempts_left -= 1
             try:
-                chat = await app.get_chat(chat_id)
+                chat = await governor.call(app.get_chat, chat_id)
                 logging.info(f"Got chat {chat_id} with invite link: {chat.invite_link}")
                 chat_dict = clean_dict(chat)
                 chat_dict["invite_link"] = chat.invite_link or ""
@@ -104,12 +106,8 @@ async def main(*, app = None, db = None):
                     sess.flush()
                     sess.commit()
                 attempts_left = 0
-            except FloodWait as e:
-                logging.error(f"Flood wait: {e}")
-                time.sleep(e.x)
             except Flood as e:
-                logging.error(f"Flood error: {e}")
-                time.sleep(e.x)
+                logging.error(f"Flood error: {e}") # the governor holds the next attempt back until the wait is over
             except RPCError as e:
                 logging.error(f"Error fetching chat {chat_id}: {e}")
             except Exception as e:
@@ -117,7 +115,7 @@ async def main(*, app = None, db = None):
                 exit(1)
         dialogs_left -= 1
         logging.info(f"Dialogs left: {dialogs_left}/{dialog_count}")
-        time.sleep(SLEEP_SECONDS_AFTER_FETCH_CHAT)
+        await asyncio.sleep(SLEEP_SECONDS_AFTER_FETCH_CHAT)
 
     await app.stop()
 
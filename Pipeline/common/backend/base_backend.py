@@ -1,4 +1,4 @@
-from typing import Dict, List, Iterable, Any, Callable, Optional
+from typing import Dict, List, Iterable, Any, Callable, Optional, Tuple
 from enum import Enum
 import queue
 import threading
@@ -11,10 +11,20 @@ import pyrogram.client
 import json
 from common.consts import consts
 from common.backend.config import Config
+from common import metrics
 from collections import namedtuple, deque
 import asyncio
 import logging
 StoredDialog = namedtuple("Dialog", ["title", "max_id", "username", "invite_link"])
+FetchShard = namedtuple("FetchShard", ["chat_id", "min_id", "max_id", "offset_id", "done"]) # fetch_shards row, ids in (min_id, max_id)
+# queued after messages of a fetch_shards range - written in the same transaction as the batch holding them
+FetchCheckpoint = namedtuple("FetchCheckpoint", ["chat_id", "min_id", "offset_id", "done", "session"])
+
+
+QUEUE_DEPTH = metrics.gauge("telelog_queue_depth", "Messages added to a backend queue and not written yet", ["backend"])
+QUEUE_BATCHES = metrics.counter("telelog_queue_batches_total", "Batches flushed by a backend queue", ["backend", "status"])
+QUEUE_FILL_SECONDS = metrics.histogram("telelog_queue_batch_fill_seconds", "Time from the first message of a batch until the batch was cut", ["backend"])
+QUEUE_FLUSH_SECONDS = metrics.histogram("telelog_queue_flush_seconds", "Time to write and commit one prepared batch", ["backend"])
 
 
 chat_type_dict = {
@@ -82,45 +92,20 @@ class BaseBackend(abc.ABC):
             raise Exception("self._conn is inactive")
         self._selected_channel: Dialog = None
         self._stored_dialogs: Dict[int, StoredDialog] = None
-        self._config = kwargs.get("config", Config(project="sessionstore"))
+        self._config = kwargs["config"] if "config" in kwargs else Config(project="sessionstore")
 
     def select_channel(self, dialog: pyrogram.types.Dialog):
         assert self._selected_channel is None
         self._selected_channel = dialog
-        #assert self._stored_dialogs
-        max_id = self._stored_dialogs[dialog.chat.id].max_id if dialog.chat.id in self._stored_dialogs else -1
-        if max_id is None:
-            max_id = -1
-        channel_id = dialog.chat.id
-        self._config.set("last_write", json.dumps({
-                "channel_id": channel_id,
-                "channel_name": dialog.chat.title,
-                "id_end": max_id,
-                "id_start": dialog.top_message.id if dialog.top_message else max_id
-            }))
 
     def unselect_channel(self):
         assert self._selected_channel is not None
         self.add_channel(self._selected_channel, update_top_message_id=True)
         self._selected_channel = None
-        self._config.unset("last_write")
-    
-    def delete_last_write(self):
-        data = self._config.get("last_write", None)
-        if data is None:
-            return None
-        data = json.loads(data)
-        channel_id = data["channel_id"]
-        channel_name = data["channel_name"]
-        id_end = data["id_end"]
-        id_start = data["id_start"]
-        assert id_end <= id_start # we receive messages in reverse
-        self.delete_messages(channel_id, id_end, id_start)
-        self._config.unset("last_write")
-        return (channel_id, channel_name, id_start-id_end+1)
 
     def close(self):
         print("BaseBackend.close() - start")
+        self._config.flush()
         if not hasattr(self, "_conn"):
             raise NotImplementedError()
         if not hasattr(self._conn, "close"):
@@ -159,6 +144,31 @@ class BaseBackend(abc.ABC):
     def add_messages(self, messages: Iterable[Message|Callable]):
         raise NotImplementedError()
 
+    def prepare_messages(self, messages: List[Message|Callable]) -> Any:
+        """
+        CPU-bound half of add_messages (normalization), run by MessageQueue ahead of the write
+        """
+        return messages
+
+    def write_prepared_messages(self, prepared: Any):
+        """
+        I/O-bound half of add_messages, receives the result of prepare_messages.
+        Retried by MessageQueue, so it must not run the callables of the batch - see prepared_callables
+        """
+        self.add_messages(prepared)
+
+    def prepared_callables(self, prepared: Any) -> List[Callable]:
+        """
+        The callables of a prepared batch, run by MessageQueue once write_prepared_messages succeeded
+        """
+        return []
+
+    def batch_failed(self, messages: List[Message|Callable]):
+        """
+        Called by MessageQueue with the messages of a batch it dropped
+        """
+        pass
+
     @abc.abstractmethod
     def delete_messages(self, channel_id: int, id_min: int, id_max: int):
         raise NotImplementedError()
@@ -188,7 +198,25 @@ class BaseBackend(abc.ABC):
         raise NotImplementedError()
 
 
+_STOP = object() # sentinel passed down the MessageQueue pipeline on stop()
+WRITE_RETRIES = 3 # attempts to write a prepared batch before its messages are counted as failed
+
+
+class MessageQueueError(Exception):
+    """
+    Raised to whoever waits for messages of which some were never written
+    """
+    pass
+
+
 class MessageQueue:
+    """
+    Two-stage pipeline in front of a backend:
+    add_message() -> queue -> [normalize thread: db.prepare_messages] -> prepared -> [write thread: db.write_prepared_messages, then the callables]
+    so batch N+1 is normalized while batch N is being written.
+    add_message() blocks once max_queue_size messages are pending, nothing is ever dropped.
+    """
+
     def __init__(
             self,
             db: BaseBackend,
@@ -196,58 +224,190 @@ class MessageQueue:
             *,
             batch_fill_timeout: float,
             batch_size: int,
+            max_queue_size: Optional[int] = None,
     ):
         self.db = db
-        self.max_queue_size = 10 * batch_size
+        self.max_queue_size = max_queue_size or 10 * batch_size
         self.batch_size = batch_size
         self.batch_fill_timeout = batch_fill_timeout
-        self.queue: deque = deque(maxlen=self.max_queue_size)
+        self.queue: queue.Queue = queue.Queue(maxsize=self.max_queue_size)
+        self.prepared: queue.Queue = queue.Queue(maxsize=1) # one batch ready while the previous one is written
         self.lock = lock
-        self.quick_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0 # messages of batches that could not be written
+        self.failed_ranges: List[Tuple[int, int]] = [] # [start, end) positions in enqueue order of the failed batches
+        self.batches_written = 0
+        self.batches_failed = 0
+        self.callables_failed = 0 # their batch was written all the same
+        self.last_fill_latency = 0.0
+        self.last_flush_duration = 0.0
+        self.total_flush_duration = 0.0
         self.last_push = time.time()
         self.last_count = 0
-        self.messages: List[Optional[Message|Callable]] = [None for _ in range(batch_size)]
         self.stopped = False
-        self.thread = threading.Thread(target=self._loop)
+        self.metric_labels = dict(backend=type(db).__name__)
+        QUEUE_DEPTH.labels(**self.metric_labels).set_function(lambda: self.depth)
+        self.normalize_thread = threading.Thread(target=self._normalize_loop, name="MessageQueue-normalize")
+        self.write_thread = threading.Thread(target=self._write_loop, name="MessageQueue-write")
         self.start()
 
+    @property
+    def depth(self) -> int:
+        with self.cond:
+            return self.enqueued - self.written - self.failed
+
+    def stats(self) -> Dict[str, float]:
+        with self.cond:
+            return dict(
+                depth=self.enqueued - self.written - self.failed,
+                enqueued=self.enqueued,
+                written=self.written,
+                failed=self.failed,
+                batches_written=self.batches_written,
+                batches_failed=self.batches_failed,
+                callables_failed=self.callables_failed,
+                last_fill_latency=self.last_fill_latency,
+                last_flush_duration=self.last_flush_duration,
+                total_flush_duration=self.total_flush_duration,
+            )
+
     def add_message(self, message: Message|Callable):
         if self.stopped:
             raise Exception("MessageQueue is stopped")
-        self.queue.append(message)
+        with self.cond:
+            self.enqueued += 1
+        self.queue.put(message) # blocks while the queue is full
 
     def start(self):
-        self.thread.start()
+        self.normalize_thread.start()
+        self.write_thread.start()
 
     def stop(self):
         logging.info(f"MessageQueue.stop() - changing stopped to True")
         self.stopped = True
-        logging.info(f"MessageQueue.stop() - waiting for thread to join")
-        self.thread.join()
-        logging.info(f"MessageQueue.stop() - thread joined - done")
-
-    def _loop(self):
-        i = 0
-        while not self.stopped:
-            i = 0
-            #logging.info("Going for another batch")
-            next_force_push = time.time() + self.batch_fill_timeout
-            while i < self.batch_size:
+        self.queue.put(_STOP)
+        logging.info(f"MessageQueue.stop() - waiting for threads to drain and join")
+        self.normalize_thread.join()
+        self.write_thread.join()
+        logging.info(f"MessageQueue.stop() - threads joined - done")
+
+    def wait_for_flush(self, target: Optional[int] = None, timeout: Optional[float] = None, *, since: int = 0) -> bool:
+        """
+        Blocks until the first `target` enqueued messages (default: everything enqueued so far) were processed.
+        Raises MessageQueueError if a batch holding any of the messages enqueued in [since, target) failed
+        """
+        with self.cond:
+            if target is None:
+                target = self.enqueued
+            if not self.cond.wait_for(lambda: self.written + self.failed >= target, timeout=timeout):
+                return False
+            lost = sum(min(end, target) - max(start, since) for start, end in self.failed_ranges if start < target and end > since)
+        if lost:
+            raise MessageQueueError(f"{lost} of the messages enqueued in [{since}, {target}) were not written")
+        return True
+
+    def _next_batch(self) -> Tuple[List[Message|Callable], bool, float]:
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True, 0
+        batch = [first]
+        t_first = time.time()
+        deadline = t_first + self.batch_fill_timeout
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True, time.time() - t_first
+            batch.append(item)
+        return batch, False, time.time() - t_first
+
+    def _normalize_loop(self):
+        stop = False
+        while not stop:
+            batch, stop, fill_latency = self._next_batch()
+            if not batch:
+                continue
+            try:
+                prepared = self.db.prepare_messages(batch)
+            except Exception as e:
+                logging.exception(f"MessageQueue - failed to prepare batch of {len(batch)}: {e}")
+                prepared = None
+            self.prepared.put((prepared, batch, fill_latency))
+        self.prepared.put(_STOP)
+
+    def _write(self, prepared: Any, n: int) -> bool:
+        """
+        Writes a prepared batch, retrying WRITE_RETRIES times. Its callables aren't part of the retried write
+        """
+        if prepared is None:
+            return False
+        for attempt in range(WRITE_RETRIES):
+            try:
+                self.db.write_prepared_messages(prepared)
+                return True
+            except Exception as e:
+                logging.exception(f"MessageQueue - failed to write batch of {n} (attempt {attempt+1}/{WRITE_RETRIES}): {e}")
+                if attempt + 1 < WRITE_RETRIES:
+                    time.sleep(2 ** attempt)
+        return False
+
+    def _run_callables(self, prepared: Any) -> int:
+        """
+        Runs the callables of a written batch once each. Returns how many raised - the batch is written regardless
+        """
+        callables = self.db.prepared_callables(prepared)
+        errors = 0
+        for c in callables:
+            try:
+                c()
+            except Exception as e:
+                logging.exception(f"MessageQueue - callable {c} failed: {e}")
+                errors += 1
+        logging.info(f"Called {len(callables)} callables")
+        return errors
+
+    def _write_loop(self):
+        while True:
+            item = self.prepared.get()
+            if item is _STOP:
+                return
+            prepared, batch, fill_latency = item
+            n = len(batch)
+            t_start = time.time()
+            failed = not self._write(prepared, n)
+            callable_errors = 0
+            if failed:
+                logging.error(f"MessageQueue - dropped a batch of {n} messages, its checkpoints and callables")
                 try:
-                    self.messages[i] = self.queue.popleft()
-                    i += 1
-                except IndexError:
-                    if time.time() > next_force_push:
-                        break
-                    #logging.info("Got index error, sleeping")
-                    time.sleep(1)
-            if i:
-                #logging.info("Calling self.db.add_messages")
-                self.db.add_messages(self.messages[:i])
-            #logging.info("Obtaining lock")
-            with self.quick_lock:
+                    self.db.batch_failed(batch)
+                except Exception as e:
+                    logging.exception(f"MessageQueue - batch_failed: {e}")
+            else:
+                callable_errors = self._run_callables(prepared)
+            flush_duration = time.time() - t_start
+            QUEUE_BATCHES.labels(status="failed" if failed else "written", **self.metric_labels).inc()
+            QUEUE_FILL_SECONDS.labels(**self.metric_labels).observe(fill_latency)
+            QUEUE_FLUSH_SECONDS.labels(**self.metric_labels).observe(flush_duration)
+            with self.cond:
+                if failed:
+                    start = self.written + self.failed
+                    self.failed_ranges.append((start, start + n))
+                    self.failed += n
+                else:
+                    self.written += n
+                    self.batches_written += 1
+                self.batches_failed += int(failed)
+                self.callables_failed += callable_errors
+                self.last_fill_latency = fill_latency
+                self.last_flush_duration = flush_duration
+                self.total_flush_duration += flush_duration
                 self.last_push = time.time()
-                self.last_count = i
+                self.last_count = n
+                self.cond.notify_all()
 
 
 class BaseBackendWithQueue(BaseBackend):
@@ -257,6 +417,7 @@ class BaseBackendWithQueue(BaseBackend):
     def __init__(self, name: str, *, batch_fill_timeout: float = 1, batch_size: int = 10000, **kwargs):
         super().__init__(name, **kwargs)
         self._lock = threading.Lock()
+        self._flush_checked = 0 # messages up to here were already reported by wait_for_queue_flush_batch
         if kwargs.get("debug_read_only", None) is True:
             self._queue = None
         else:
@@ -274,12 +435,15 @@ class BaseBackendWithQueue(BaseBackend):
     def close(self):
         logging.info(f"BaseBackendWithQueue.close() - waiting for lock")
         with self._lock:
-            logging.info(f"BaseBackendWithQueue.close() - got lock, stopping queue")
-            self._queue.stop()
-            logging.info(f"BaseBackendWithQueue.close() - stopped queue, waiting for queue to flush batches")
-            self.wait_for_queue_flush_full_sync()
-            logging.info(f"BaseBackendWithQueue.close() - stopped queue, calling super().close()")
-            super().close()
+            try:
+                if self._queue is not None: # debug_read_only
+                    logging.info(f"BaseBackendWithQueue.close() - got lock, stopping queue")
+                    self._queue.stop()
+                    logging.info(f"BaseBackendWithQueue.close() - stopped queue, waiting for queue to flush batches")
+                    self.wait_for_queue_flush_full_sync()
+            finally:
+                logging.info(f"BaseBackendWithQueue.close() - stopped queue, calling super().close()")
+                super().close()
         logging.info(f"BaseBackendWithQueue.close() - end")
     
     def __del__(self):
@@ -293,35 +457,20 @@ class BaseBackendWithQueue(BaseBackend):
     def add_message(self, message: Message|Callable):
         self._queue.add_message(message)
     
-    async def wait_for_queue_flush_batch(self, *, max_tries: int = 3):
-        assert isinstance(max_tries, int) and max_tries > 0
-        start_wait = time.time()
-        for i in range(1, max_tries+1):
-            if not self._queue.quick_lock.acquire(timeout = 1): # should be quick
-                raise TimeoutError("Timed out waiting for lock")
-            last_push = self._queue.last_push
-            self._queue.quick_lock.release()
-            if last_push > start_wait:
-                return
-            if i == max_tries:
-                raise TimeoutError("Timed out waiting for queue to flush batch")
-            else:
-                await asyncio.sleep(self._queue.batch_fill_timeout)
+    async def wait_for_queue_flush_batch(self, *, timeout: Optional[float] = None):
+        """
+        Waits (without blocking the event loop) until every message added so far was written
+        """
+        target = self._queue.enqueued
+        since, self._flush_checked = self._flush_checked, target
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, lambda: self._queue.wait_for_flush(target, timeout, since=since)):
+            raise TimeoutError("Timed out waiting for queue to flush batch")
     
-    def wait_for_queue_flush_full_sync(self):
-        max_batches = 1 + int(self._queue.max_queue_size / self._queue.batch_size)
-        max_tries = int(max_batches * 1.25)
-        assert max_batches >= 1
-        assert max_tries >= 1
+    def wait_for_queue_flush_full_sync(self, *, timeout: Optional[float] = None):
+        """
+        After stop(): waits for every batch, and raises MessageQueueError if any of them was lost
+        """
         assert self._queue.stopped # so we can't receive any more messages
-        for i in range(1, max_tries+1):
-            if not self._queue.quick_lock.acquire(timeout = 1): # should be quick
-                raise TimeoutError("Timed out waiting for lock")
-            queue_len = len(self._queue.queue)
-            self._queue.quick_lock.release()
-            if queue_len == 0:
-                return
-            if i == max_tries:
-                raise TimeoutError("Timed out waiting for queue to flush all batches")
-            else:
-                time.sleep(self._queue.batch_fill_timeout)
+        if not self._queue.wait_for_flush(timeout=timeout):
+            raise TimeoutError("Timed out waiting for queue to flush all batches")
@@ -1,32 +1,173 @@
-from typing import Any, Optional, Dict
-from sqlalchemy import Connection
+from typing import Any, Optional, Dict, List
+import threading
+import weakref
+import logging
+import select
+import uuid
+import time
+from sqlalchemy import Connection, text, delete
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.dialects.postgresql import insert
 from common.backend.models import Configurations
 
 
+NOTIFY_CHANNEL = "telelog_config"
+_UNSET = object()
+
+
+class ConfigListener:
+    """
+    One LISTEN connection per process, shared by every Config instance.
+    Config writes send NOTIFY telelog_config '<project>\\t<key>\\t<writer token>' in the same
+    transaction, and the listener refreshes that key in every other instance of the project.
+    After a lost connection all instances are reloaded, since notifications may have been missed.
+    """
+    _instance: "ConfigListener" = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._configs: Dict[str, weakref.WeakSet] = dict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ConfigListener")
+        self._thread.start()
+
+    @classmethod
+    def get(cls) -> "ConfigListener":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = ConfigListener()
+            return cls._instance
+
+    def register(self, config: "Config"):
+        with self._lock:
+            self._configs.setdefault(config.project, weakref.WeakSet()).add(config)
+
+    def _configs_of(self, project: Optional[str] = None) -> List["Config"]:
+        with self._lock:
+            if project is not None:
+                return list(self._configs.get(project, ()))
+            return [c for configs in self._configs.values() for c in configs]
+
+    def _run(self):
+        from common.utils import create_postgres_engine
+        engine = create_postgres_engine()
+        first = True
+        while True:
+            raw = None
+            try:
+                raw = engine.raw_connection()
+                conn = raw.driver_connection
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                if not first:
+                    for config in self._configs_of():
+                        self._apply(config.reload)
+                first = False
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._notified(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logging.warning(f"ConfigListener - connection lost ({e}), reconnecting")
+                time.sleep(5)
+            finally:
+                if raw is not None:
+                    self._apply(raw.close)
+
+    def _notified(self, payload: str):
+        try:
+            project, key, token = payload.split("\t", 2)
+        except ValueError:
+            logging.warning(f"ConfigListener - malformed notification {payload!r}")
+            return
+        for config in self._configs_of(project):
+            if config.token != token:
+                self._apply(config.refresh_key, key)
+
+    def _apply(self, f, *args):
+        """
+        Errors of one refresh are logged, they don't cost the LISTEN connection
+        """
+        try:
+            f(*args)
+        except Exception as e:
+            logging.exception(f"ConfigListener - {getattr(f, '__name__', f)} failed: {e}")
+
+
 class Config:
+    """
+    Key-value store of a project in the configurations table.
+    Keys are loaded once and reads are served from memory. Writes go through to the DB right away,
+    or with defer=True are coalesced and flushed together after flush_interval seconds (or on flush()).
+    Other processes learn about writes through LISTEN/NOTIFY - see ConfigListener.
+    """
 
-    def __init__(self, *, project: Optional[str] = None, conn: Optional[Connection] = None):
+    def __init__(self, *, project: Optional[str] = None, conn: Optional[Connection] = None, listen: bool = True, flush_interval: float = 1):
         self._project = project or "default"
         if not conn:
             from common.utils import create_postgres_connection
             conn = create_postgres_connection()
         self._conn = conn
-    
+        self.token = uuid.uuid4().hex
+        self._lock = threading.RLock()
+        self._cache: Dict[str, Any] = None
+        self._pending: Dict[str, Any] = dict()
+        self._flush_interval = flush_interval
+        self._flush_timer: threading.Timer = None
+        if listen:
+            ConfigListener.get().register(self)
+
+    @property
+    def project(self) -> str:
+        return self._project
+
     def table(self, sess: Session):
         return sess.query(Configurations).filter_by(project=self._project)
-    
+
     def _commit(self):
         self._conn.commit()
-    
+
     def load_config(self) -> Dict:
         config = {}
         with Session(self._conn) as sess:
             for item in self.table(sess).all():
                 config[item.key] = item.value
         return config
-    
+
+    def _get_cache(self) -> Dict[str, Any]:
+        cache = self._cache
+        if cache is None:
+            with self._lock:
+                if self._cache is None:
+                    self._cache = self.load_config()
+                cache = self._cache
+        return cache
+
+    def reload(self):
+        with self._lock:
+            config = self.load_config()
+            config.update({k: v for k, v in self._pending.items() if v is not _UNSET})
+            for k, v in self._pending.items():
+                if v is _UNSET:
+                    config.pop(k, None)
+            self._cache = config
+
+    def refresh_key(self, key: str):
+        with self._lock:
+            if self._cache is None:
+                return # nothing loaded yet
+            if key in self._pending:
+                return # our own unflushed write is newer
+            item = self._get_one(key)
+            if item is None:
+                self._cache.pop(key, None)
+            else:
+                self._cache[key] = item.value
+
     def _get_one(self, key: str):
         try:
             with Session(self._conn) as sess:
@@ -34,28 +175,69 @@ class Config:
             return result
         except NoResultFound:
             return None
-    
+
     def get(self, key: str, default: Optional[Any] = None):
-        item = self._get_one(key)
-        if item is None:
+        cache = self._get_cache()
+        if key not in cache:
             if default is not None:
                 self.set(key, default)
             return default
         else:
-            return item.value
-    
-    def set(self, key: str, value: Any):
-        item = self._get_one(key) or Configurations(project=self._project, key=key, value=value)
-        item.value = value
+            return cache[key]
+
+    def _write(self, items: Dict[str, Any]):
         with Session(self._conn) as sess:
-            sess.merge(item)
+            for key, value in items.items():
+                if value is _UNSET:
+                    sess.execute(
+                        delete(Configurations)
+                        .where(Configurations.project == self._project)
+                        .where(Configurations.key == key)
+                    )
+                else:
+                    stmt = insert(Configurations).values(project=self._project, key=key, value=value)
+                    sess.execute(stmt.on_conflict_do_update(
+                        index_elements=[Configurations.project, Configurations.key],
+                        set_={Configurations.value: stmt.excluded.value, Configurations.last_updated: text("now()")},
+                    ))
+                sess.execute(text("SELECT pg_notify(:channel, :payload)"), dict(channel=NOTIFY_CHANNEL, payload=f"{self._project}\t{key}\t{self.token}"))
             sess.commit()
         self._conn.commit()
-    
-    def unset(self, key: str):
-        item = self._get_one(key)
-        if item is not None:
-            with Session(self._conn) as sess:
-                sess.delete(item)
-                sess.commit()
-            self._conn.commit()
+
+    def _update(self, key: str, value: Any, defer: bool):
+        self._get_cache()
+        with self._lock:
+            cache = self._cache
+            if value is _UNSET:
+                cache.pop(key, None)
+            else:
+                cache[key] = value
+            if not defer:
+                self._pending.pop(key, None)
+                self._write({key: value})
+                return
+            self._pending[key] = value
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def set(self, key: str, value: Any, *, defer: bool = False):
+        self._update(key, value, defer)
+
+    def unset(self, key: str, *, defer: bool = False):
+        self._update(key, _UNSET, defer)
+
+    def flush(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            pending, self._pending = self._pending, dict()
+            if pending:
+                try:
+                    self._write(pending)
+                except Exception:
+                    for k, v in pending.items():
+                        self._pending.setdefault(k, v)
+                    raise
@@ -1,4 +1,7 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple, Iterable, Any
+import threading
+import logging
+import os
 from common.utils import create_postgres_engine
 from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert
@@ -7,45 +10,95 @@ import common.backend.models as models
 
 
 class EmojiMap:
-    engine = create_postgres_engine()
-    emoji_map: Dict[str|int, int] = dict()
+    """
+    Process-wide reaction -> reaction_id registry.
+    Hits are plain dict reads. The DB is only touched by preload() (once per process) and by register(),
+    which upserts every unseen emoji of a batch in one statement - ON CONFLICT makes concurrent
+    registration from other threads/processes converge on the same ids.
+    """
+    engine = None
+    emoji_map: Dict[str, int] = dict()
+    _engine_pid: int = None
+    _loaded = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get_engine(cls):
+        # engines must not be shared across fork()
+        if cls.engine is None or cls._engine_pid != os.getpid():
+            cls.engine = create_postgres_engine()
+            cls._engine_pid = os.getpid()
+        return cls.engine
 
     @classmethod
     def _reload_map(cls):
-        with Session(cls.engine) as session:
-            stmt = select(models.EmojiMap)
-            result = session.execute(stmt).fetchall()
-            for row in result:
-                emoji = row[0].reaction
-                cls.emoji_map[emoji] = row[0].reaction_id
-    
+        with Session(cls._get_engine()) as session:
+            result = session.execute(select(models.EmojiMap.reaction, models.EmojiMap.reaction_id)).fetchall()
+        cls.emoji_map.update({reaction: reaction_id for reaction, reaction_id in result})
+
     @classmethod
-    def _add_emoji(cls, emoji: str, is_custom: bool):
-        e = models.EmojiMap(reaction=emoji, is_custom=is_custom)
-        with Session(cls.engine) as session:
+    def preload(cls):
+        if cls._loaded:
+            return
+        with cls._lock:
+            if cls._loaded:
+                return
+            cls._reload_map()
+            cls._loaded = True
+        logging.info(f"EmojiMap - loaded {len(cls.emoji_map)} reactions")
+
+    @staticmethod
+    def key(emoji: str|int) -> Tuple[str, bool]:
+        """
+        Returns the emoji_map.reaction value of an emoji and whether it is custom (custom emojis are ints)
+        """
+        if isinstance(emoji, (str, int)):
+            return str(emoji), isinstance(emoji, int)
+        raise ValueError(f"Unknown emoji type: {emoji} = {type(emoji)}")
+
+    @classmethod
+    def register(cls, emojis: Iterable[str|int]):
+        cls.preload()
+        pending = dict(cls.key(e) for e in emojis)
+        pending = {k: v for k, v in pending.items() if k not in cls.emoji_map}
+        if not pending:
+            return
+        with cls._lock:
+            pending = {k: v for k, v in pending.items() if k not in cls.emoji_map} # another thread may have won
+            if not pending:
+                return
+            stmt = insert(models.EmojiMap).values([dict(reaction=k, is_custom=v) for k, v in sorted(pending.items())])
             stmt = (
-                insert(models.EmojiMap)
-                .values(reaction=e.reaction, is_custom=e.is_custom)
+                stmt
                 .on_conflict_do_update(
                     index_elements=[models.EmojiMap.reaction],
-                    set_={models.EmojiMap.is_custom: e.is_custom}
+                    set_={models.EmojiMap.is_custom: stmt.excluded.is_custom}
                 )
-                .returning(models.EmojiMap.reaction_id)
+                .returning(models.EmojiMap.reaction, models.EmojiMap.reaction_id)
             )
-            result = session.execute(stmt)
-            e.reaction_id = result.fetchone()[0]
-            session.flush()
-            session.commit()
-        assert e.reaction_id is not None
-        cls.emoji_map[emoji] = e.reaction_id
-    
+            with Session(cls._get_engine()) as session:
+                result = session.execute(stmt).fetchall()
+                session.commit()
+            cls.emoji_map.update({reaction: reaction_id for reaction, reaction_id in result})
+        logging.info(f"EmojiMap - registered {len(result)} new reactions")
+
     @classmethod
     def to_int(cls, emoji: str|int) -> int:
-        if isinstance(emoji, (str, int)):
-            is_custom = isinstance(emoji, int)
-            emoji = str(emoji)
-            if emoji not in cls.emoji_map:
-                cls._add_emoji(emoji, is_custom)
-            return cls.emoji_map[emoji]
-        else:
-            raise ValueError(f"Unknown emoji type: {emoji} = {type(emoji)}")
+        k, _ = cls.key(emoji)
+        reaction_id = cls.emoji_map.get(k, None)
+        if reaction_id is None:
+            cls.register([emoji])
+            reaction_id = cls.emoji_map[k]
+        return reaction_id
+
+    @classmethod
+    def resolve_rows(cls, rows: List[Dict[str, Any]], column: str = "reaction_id"):
+        """
+        Replaces raw emojis in rows[...][column] with their ids, registering all unseen ones at once
+        """
+        if not rows:
+            return
+        cls.register({row[column] for row in rows})
+        emoji_map = cls.emoji_map
+        for row in rows:
+            row[column] = emoji_map[cls.key(row[column])[0]]
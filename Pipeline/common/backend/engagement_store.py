@@ -0,0 +1,256 @@
+"""
+Append-only engagement history - engagement_series and engagement_rollups in MessageStore/src/postgres.sql.
+
+MessageRefresh/main.py appends an engagement_samples row per refetched message. compact() folds those into one
+engagement_series row per message, holding its whole trajectory as delta-encoded arrays, and adds their growth
+to the 1m/60m/1d engagement_rollups in the same transaction. Every sample is counted exactly once, so the rollups
+are maintained incrementally and queries over many messages never have to scan samples.
+
+    store = EngagementStore()
+    store.compact()
+    curves = store.trajectories(chat_id, posted_from=hour, posted_to=hour + datetime.timedelta(hours=1))
+    hourly = store.rollups(GranularityType.sixty_minutes, chat_id, start, end)
+"""
+from typing import List, Dict, Tuple, Optional, Iterable, Any
+from collections import namedtuple, defaultdict
+import itertools
+import datetime
+import logging
+from sqlalchemy import Engine, text
+from sqlalchemy.orm import Session
+import common.backend.models as models
+from common.backend.models import GranularityType
+from common.utils import create_postgres_engine, upsert
+from common import metrics
+
+
+ROLLUP_STEPS: Dict[GranularityType, datetime.timedelta] = {
+    GranularityType.one_minute: datetime.timedelta(minutes=1),
+    GranularityType.sixty_minutes: datetime.timedelta(hours=1),
+    GranularityType.one_day: datetime.timedelta(days=1),
+}
+COMPACT_MESSAGES = 5000 # messages folded per transaction
+_epoch = datetime.datetime(1970, 1, 1)
+
+SAMPLES_COMPACTED = metrics.counter("telelog_engagement_samples_compacted_total", "engagement_samples rows folded into engagement_series")
+
+# times are datetimes, the counters absolute values at those times
+Trajectory = namedtuple("Trajectory", ["chat_id", "message_id", "posted_at", "times", "views", "forwards", "reactions"])
+Rollup = namedtuple("Rollup", ["chat_id", "bucket", "samples", "views", "forwards", "reactions"])
+
+COUNTERS = ("views", "forwards", "reactions")
+
+
+def delta_encode(values: Iterable[int]) -> List[int]:
+    out, prev = [], 0
+    for v in values:
+        out.append(v - prev)
+        prev = v
+    return out
+
+
+def delta_decode(deltas: Iterable[int]) -> List[int]:
+    return list(itertools.accumulate(deltas))
+
+
+def floor_time(t: datetime.datetime, step: datetime.timedelta) -> datetime.datetime:
+    return t - (t - _epoch) % step
+
+
+def decode_series(row) -> Trajectory:
+    offsets = delta_decode(row.t)
+    return Trajectory(
+        chat_id=row.chat_id,
+        message_id=row.message_id,
+        posted_at=row.posted_at,
+        times=[row.posted_at + datetime.timedelta(seconds=s) for s in offsets],
+        views=delta_decode(row.views),
+        forwards=delta_decode(row.forwards),
+        reactions=delta_decode(row.reactions),
+    )
+
+
+def encode_series(trajectory: Trajectory, stage: int, last_sampled_at: Optional[datetime.datetime]) -> Dict[str, Any]:
+    return dict(
+        chat_id=trajectory.chat_id,
+        message_id=trajectory.message_id,
+        posted_at=trajectory.posted_at,
+        stage=stage,
+        last_sampled_at=last_sampled_at,
+        t=delta_encode(int((t - trajectory.posted_at).total_seconds()) for t in trajectory.times),
+        views=delta_encode(trajectory.views),
+        forwards=delta_encode(trajectory.forwards),
+        reactions=delta_encode(trajectory.reactions),
+    )
+
+
+def select_samples(limit: int):
+    """
+    Every sample of up to `limit` messages, with the posting date the series is partitioned by
+    """
+    return text("""
+        WITH k AS (SELECT DISTINCT chat_id, message_id FROM engagement_samples LIMIT :limit)
+        SELECT s.chat_id, s.message_id, m.date, s.sampled_at, s.stage, s.views, s.forwards, s.reactions_vote_count
+        FROM engagement_samples s
+        JOIN k ON k.chat_id = s.chat_id AND k.message_id = s.message_id
+        LEFT JOIN messages m ON m.chat_id = s.chat_id AND m.message_id = s.message_id
+        ORDER BY s.chat_id, s.message_id, s.sampled_at
+    """).bindparams(limit=limit)
+
+
+def select_series(keys: List[Tuple[int, int, datetime.datetime]]):
+    return text("""
+        SELECT e.chat_id, e.message_id, e.posted_at, e.stage, e.last_sampled_at, e.t, e.views, e.forwards, e.reactions
+        FROM engagement_series e
+        JOIN unnest(CAST(:chat_ids AS BIGINT[]), CAST(:message_ids AS BIGINT[]), CAST(:posted_at AS TIMESTAMP[])) AS k(chat_id, message_id, posted_at)
+            ON k.chat_id = e.chat_id AND k.message_id = e.message_id AND k.posted_at = e.posted_at
+    """).bindparams(
+        chat_ids=[k[0] for k in keys],
+        message_ids=[k[1] for k in keys],
+        posted_at=[k[2] for k in keys],
+    )
+
+
+def delete_samples(keys: List[Tuple[int, int]], until: datetime.datetime):
+    """
+    Only what select_samples could have returned - samples written meanwhile stay for the next compaction
+    """
+    return text("""
+        DELETE FROM engagement_samples s
+        USING unnest(CAST(:chat_ids AS BIGINT[]), CAST(:message_ids AS BIGINT[])) AS k(chat_id, message_id)
+        WHERE s.chat_id = k.chat_id AND s.message_id = k.message_id AND s.sampled_at <= :until
+    """).bindparams(chat_ids=[k[0] for k in keys], message_ids=[k[1] for k in keys], until=until)
+
+
+def add_rollups(granularity: GranularityType, rollups: Dict[Tuple[int, datetime.datetime], List[int]]):
+    """
+    rollups[(chat_id, bucket)] = [samples, views, forwards, reactions], added to what is stored
+    """
+    keys = list(rollups.keys())
+    values = [rollups[k] for k in keys]
+    return text("""
+        INSERT INTO engagement_rollups AS r (granularity, chat_id, bucket, samples, views, forwards, reactions)
+        SELECT CAST(:granularity AS granularity_type), b.chat_id, b.bucket, b.samples, b.views, b.forwards, b.reactions
+        FROM unnest(
+            CAST(:chat_ids AS BIGINT[]), CAST(:buckets AS TIMESTAMP[]), CAST(:samples AS INTEGER[]),
+            CAST(:views AS BIGINT[]), CAST(:forwards AS BIGINT[]), CAST(:reactions AS BIGINT[])
+        ) AS b(chat_id, bucket, samples, views, forwards, reactions)
+        ON CONFLICT (granularity, chat_id, bucket) DO UPDATE SET
+            samples = r.samples + EXCLUDED.samples,
+            views = r.views + EXCLUDED.views,
+            forwards = r.forwards + EXCLUDED.forwards,
+            reactions = r.reactions + EXCLUDED.reactions
+    """).bindparams(
+        granularity=granularity.value,
+        chat_ids=[k[0] for k in keys],
+        buckets=[k[1] for k in keys],
+        samples=[v[0] for v in values],
+        views=[v[1] for v in values],
+        forwards=[v[2] for v in values],
+        reactions=[v[3] for v in values],
+    )
+
+
+class EngagementStore:
+    def __init__(self, engine: Optional[Engine] = None):
+        self._engine = engine or create_postgres_engine()
+
+    def compact(self, *, limit: int = COMPACT_MESSAGES) -> int:
+        """
+        Folds the samples of up to `limit` messages into their series and the rollups. Returns the number of samples
+        """
+        with Session(self._engine) as sess:
+            samples = sess.execute(select_samples(limit)).fetchall()
+            if not samples:
+                return 0
+            until = max(s.sampled_at for s in samples)
+            by_message = {k: list(g) for k, g in itertools.groupby(samples, key=lambda s: (s.chat_id, s.message_id))}
+            posted = {k: g[0].date for k, g in by_message.items() if g[0].date is not None}
+            stored = {
+                (row.chat_id, row.message_id): row
+                for row in sess.execute(select_series([(c, m, d) for (c, m), d in posted.items()])).fetchall()
+            } if posted else dict()
+            rows_series = []
+            rollups: Dict[GranularityType, Dict[Tuple[int, datetime.datetime], List[int]]] = {g: defaultdict(lambda: [0, 0, 0, 0]) for g in ROLLUP_STEPS}
+            for (chat_id, message_id), message_samples in by_message.items():
+                if (chat_id, message_id) not in posted:
+                    continue # the message was deleted from messages - nothing to attach the samples to
+                row = stored.get((chat_id, message_id), None)
+                if row is not None:
+                    trajectory, stage, last_sampled_at = decode_series(row), row.stage, row.last_sampled_at
+                else:
+                    trajectory = Trajectory(chat_id, message_id, posted[(chat_id, message_id)], [], [], [], [])
+                    stage, last_sampled_at = 0, None
+                for s in message_samples:
+                    stage = max(stage, s.stage)
+                    values = (s.views, s.forwards, s.reactions_vote_count)
+                    if all(v is None for v in values):
+                        continue # the message was gone when refetched
+                    if last_sampled_at is not None and s.sampled_at <= last_sampled_at:
+                        continue
+                    # counters telegram didn't return carry the previous value, so they don't count as growth
+                    previous = [getattr(trajectory, c)[-1] if trajectory.times else 0 for c in COUNTERS]
+                    values = [v if v is not None else p for v, p in zip(values, previous)]
+                    trajectory.times.append(s.sampled_at)
+                    for c, v in zip(COUNTERS, values):
+                        getattr(trajectory, c).append(v)
+                    last_sampled_at = s.sampled_at
+                    for granularity, step in ROLLUP_STEPS.items():
+                        r = rollups[granularity][(chat_id, floor_time(s.sampled_at, step))]
+                        r[0] += 1
+                        for i, (v, p) in enumerate(zip(values, previous)):
+                            r[i + 1] += v - p
+                rows_series.append(encode_series(trajectory, stage, last_sampled_at))
+            if rows_series:
+                upsert(sess, models.EngagementSeries, rows_series)
+            for granularity, r in rollups.items():
+                if r:
+                    sess.execute(add_rollups(granularity, r))
+            sess.execute(delete_samples(list(by_message.keys()), until))
+            sess.commit()
+        SAMPLES_COMPACTED.inc(len(samples))
+        logging.info(f"Compacted {len(samples)} samples of {len(by_message)} messages")
+        return len(samples)
+
+    def compact_all(self, *, limit: int = COMPACT_MESSAGES) -> int:
+        total = 0
+        while True:
+            n = self.compact(limit=limit)
+            total += n
+            if not n:
+                return total
+
+    def trajectory(self, chat_id: int, message_id: int) -> Optional[Trajectory]:
+        with Session(self._engine) as sess:
+            row = sess.execute(text("""
+                SELECT chat_id, message_id, posted_at, t, views, forwards, reactions FROM engagement_series
+                WHERE chat_id = :chat_id AND message_id = :message_id
+            """).bindparams(chat_id=chat_id, message_id=message_id)).first()
+        return decode_series(row) if row is not None else None
+
+    def trajectories(self, chat_id: int, posted_from: datetime.datetime, posted_to: datetime.datetime) -> Dict[int, Trajectory]:
+        """
+        Trajectories of the messages of chat_id posted in [posted_from, posted_to), by message_id
+        """
+        with Session(self._engine) as sess:
+            rows = sess.execute(text("""
+                SELECT chat_id, message_id, posted_at, t, views, forwards, reactions FROM engagement_series
+                WHERE chat_id = :chat_id AND posted_at >= :posted_from AND posted_at < :posted_to
+                ORDER BY message_id
+            """).bindparams(chat_id=chat_id, posted_from=posted_from, posted_to=posted_to)).fetchall()
+        return {row.message_id: decode_series(row) for row in rows}
+
+    def rollups(self, granularity: GranularityType, chat_id: Optional[int], start: datetime.datetime, end: datetime.datetime) -> List[Rollup]:
+        """
+        Growth per bucket in [start, end), of one chat or (chat_id=None) of every chat
+        """
+        where_chat = "AND chat_id = :chat_id" if chat_id is not None else ""
+        stmt = text(f"""
+            SELECT chat_id, bucket, samples, views, forwards, reactions FROM engagement_rollups
+            WHERE granularity = CAST(:granularity AS granularity_type) AND bucket >= :start AND bucket < :end {where_chat}
+            ORDER BY chat_id, bucket
+        """).bindparams(granularity=granularity.value, start=start, end=end)
+        if chat_id is not None:
+            stmt = stmt.bindparams(chat_id=chat_id)
+        with Session(self._engine) as sess:
+            return [Rollup(*row) for row in sess.execute(stmt).fetchall()]
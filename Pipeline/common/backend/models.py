@@ -1,7 +1,7 @@
 from typing import Dict
 from enum import Enum
-from sqlalchemy import Column, Integer, String, Boolean, BigInteger, Float, Text, DateTime, CheckConstraint, PickleType, text, select, update, insert, PrimaryKeyConstraint, func, UniqueConstraint
-from sqlalchemy.dialects.postgresql import ENUM, ARRAY
+from sqlalchemy import Column, LargeBinary, Integer, SmallInteger, String, Boolean, BigInteger, Float, Text, DateTime, CheckConstraint, PickleType, text, select, update, insert, PrimaryKeyConstraint, func, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ENUM, ARRAY, UUID
 from sqlalchemy.ext.declarative import declarative_base
 from pgvector.sqlalchemy import Vector
 
@@ -119,6 +119,106 @@ class Messages(Base):
     has_media = Column(Boolean)
 
 
+class ChatWatermarks(Base):
+    __tablename__ = 'chat_watermarks'
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    min_message_id = Column(BigInteger)
+    max_message_id = Column(BigInteger)
+    ongoing_min_message_id = Column(BigInteger)
+    message_count = Column(BigInteger, CheckConstraint('message_count>=0'), nullable=False, default=0)
+    max_date = Column(DateTime)
+    last_fetch = Column(DateTime)
+
+
+class FetchShards(Base):
+    __tablename__ = 'fetch_shards'
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    min_id = Column(BigInteger, primary_key=True, nullable=False)
+    max_id = Column(BigInteger, nullable=False)
+    offset_id = Column(BigInteger, nullable=False)
+    done = Column(Boolean, nullable=False, default=False)
+    session = Column(String)
+    updated_at = Column(DateTime, server_default=func.now())
+
+
+class EngagementSamples(Base):
+    __tablename__ = 'engagement_samples'
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    message_id = Column(BigInteger, primary_key=True, nullable=False)
+    sampled_at = Column(DateTime, primary_key=True, nullable=False)
+    stage = Column(SmallInteger, nullable=False)
+    views = Column(Integer)
+    forwards = Column(Integer)
+    reactions_vote_count = Column(Integer)
+    poll_vote_count = Column(Integer)
+
+
+class EngagementSeries(Base):
+    __tablename__ = 'engagement_series'
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    message_id = Column(BigInteger, primary_key=True, nullable=False)
+    posted_at = Column(DateTime, primary_key=True, nullable=False)
+    stage = Column(SmallInteger, nullable=False, default=0)
+    last_sampled_at = Column(DateTime)
+    t = Column(ARRAY(Integer), nullable=False)
+    views = Column(ARRAY(Integer), nullable=False)
+    forwards = Column(ARRAY(Integer), nullable=False)
+    reactions = Column(ARRAY(Integer), nullable=False)
+
+
+class EngagementRollups(Base):
+    __tablename__ = 'engagement_rollups'
+    granularity = Column(granularity_type_enum, primary_key=True, nullable=False)
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    bucket = Column(DateTime, primary_key=True, nullable=False)
+    samples = Column(Integer, nullable=False, default=0)
+    views = Column(BigInteger, nullable=False, default=0)
+    forwards = Column(BigInteger, nullable=False, default=0)
+    reactions = Column(BigInteger, nullable=False, default=0)
+
+
+class MessageHype(Base):
+    __tablename__ = 'message_hype'
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+    message_id = Column(BigInteger, primary_key=True, nullable=False)
+    sender_id = Column(BigInteger, nullable=False)
+    hype = Column(Float, nullable=False)
+    chat_z = Column(Float)
+    sender_z = Column(Float)
+    scored_at = Column(DateTime, nullable=False)
+
+
+class SenderHypeStats(Base):
+    __tablename__ = 'sender_hype_stats'
+    sender_id = Column(BigInteger, primary_key=True, nullable=False)
+    n = Column(BigInteger, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    updated_at = Column(DateTime)
+
+
+class DetectedEvents(Base):
+    __tablename__ = 'detected_events'
+    event_id = Column(UUID(as_uuid=True), primary_key=True, nullable=False)
+    source = Column(String, nullable=False)
+    centroid = Column(Vector())
+    chat_ids = Column(ARRAY(BigInteger), nullable=False)
+    message_ids = Column(ARRAY(BigInteger), nullable=False)
+    size = Column(Integer, nullable=False)
+    first_at = Column(DateTime)
+    last_at = Column(DateTime)
+    total_hype = Column(Float)
+    updated_at = Column(DateTime)
+
+
+class EmbeddingCache(Base):
+    __tablename__ = 'embedding_cache'
+    model = Column(String, primary_key=True, nullable=False)
+    text_hash = Column(LargeBinary, primary_key=True, nullable=False)
+    embedding = Column(Vector(), nullable=False)
+    created_at = Column(DateTime)
+
+
 class MessageEmbeddings(Base):
     __tablename__ = 'message_embeddings'
 
@@ -0,0 +1,311 @@
+"""
+Attribute-level extraction of the rows written by PostgresBackend, straight from pyrogram objects.
+Produces exactly what compose_insert_message_dict_query(clean_dict(message)) produces, without
+building the intermediate dict of the whole object graph (chat, from_user, reply_to_message, media...).
+"""
+from typing import Tuple, Dict, Any, Optional, List, Callable
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import pickle
+import io
+from pyrogram import Client
+from pyrogram.types import Message, Chat, User
+from common.backend.emoji_map import EmojiMap
+
+
+# same precedence as pg_backend.get_message_media
+media_attributes = (
+    "document",
+    "audio",
+    "voice",
+    "video",
+    "sticker",
+    "animation",
+    "video_note",
+    "photo",
+    "new_chat_photo",
+)
+
+
+def extract_chat(chat: Chat) -> Dict[str, Any]:
+    chat_type = getattr(chat, "type", None)
+    linked_chat = getattr(chat, "linked_chat", None)
+    return dict(
+        chat_id=getattr(chat, "id", None),
+        title=getattr(chat, "title", None),
+        top_message_id=None,
+        next_top_message_id=None,
+        first_name=getattr(chat, "first_name", None),
+        last_name=getattr(chat, "last_name", None),
+        username=getattr(chat, "username", None),
+        invite_link=getattr(chat, "invite_link", None),
+        type=chat_type.name.lower() if chat_type is not None else None,
+        members_count=getattr(chat, "members_count", None),
+        is_verified=getattr(chat, "is_verified", None),
+        is_restricted=getattr(chat, "is_restricted", None),
+        is_scam=getattr(chat, "is_scam", None),
+        is_fake=getattr(chat, "is_fake", None),
+        is_support=getattr(chat, "is_support", None),
+        linked_chat_id=linked_chat.id if linked_chat is not None else None,
+        phone_number=getattr(chat, "phone_number", None),
+    )
+
+
+def extract_user(user: User) -> Dict[str, Any]:
+    return dict(
+        sender_id=getattr(user, "id", None),
+        first_name=getattr(user, "first_name", None),
+        last_name=getattr(user, "last_name", None),
+        username=getattr(user, "username", None),
+        is_verified=getattr(user, "is_verified", None),
+        is_restricted=getattr(user, "is_restricted", None),
+        is_scam=getattr(user, "is_scam", None),
+        is_fake=getattr(user, "is_fake", None),
+        is_support=getattr(user, "is_support", None),
+        is_bot=getattr(user, "is_bot", None),
+        phone_number=getattr(user, "phone_number", None),
+    )
+
+
+def raw_emoji(emoji: str|int) -> str|int:
+    return emoji
+
+
+def extract_reactions(message: Message, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Optional[Dict[Any, int]]:
+    reactions = message.reactions
+    if reactions is None:
+        return None
+    reactions = getattr(reactions, "reactions", reactions)
+    if not reactions or not isinstance(reactions, list):
+        return None
+    d = dict()
+    for r in reactions:
+        emoji = r.emoji if r.emoji is not None else r.custom_emoji_id
+        d[resolve(emoji)] = r.count
+    return d
+
+
+def extract_poll_options(message: Message) -> Dict[str, int]:
+    poll = message.poll
+    if not poll or not isinstance(poll.options, list):
+        return dict()
+    return {o.text: o.voter_count for o in poll.options}
+
+
+def extract_text(message: Message) -> Optional[str]:
+    if message.text:
+        return str(message.text)
+    elif message.caption:
+        return str(message.caption)
+    elif message.poll:
+        return message.poll.question
+    else:
+        return None
+
+
+def extract_media(message: Message) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    for media_type in media_attributes:
+        media = getattr(message, media_type, None)
+        if media is not None:
+            return media_type, media.file_id, media.file_unique_id
+    return None, None, None
+
+
+def extract_message_items(message: Message, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """
+    resolve maps a reaction emoji to the value stored in reaction_id - EmojiMap by default.
+    Batch callers pass raw_emoji and resolve all reactions at once with EmojiMap.resolve_rows
+    """
+    reactions_list = extract_reactions(message, resolve)
+    options_list = extract_poll_options(message)
+    chat = message.chat
+    chat_id = chat.id if chat is not None else None
+    message_id = message.id
+    if message.outgoing:
+        return
+    if chat_id is None or message_id is None:
+        return
+    from_user = message.from_user
+    sender_chat = message.sender_chat
+    sender_id = from_user.id if from_user is not None else (sender_chat.id if sender_chat is not None else None)
+    forward_from_chat = getattr(message, "forward_from_chat", None)
+    forward_from = getattr(message, "forward_from", None)
+    forward_from_chat_id = forward_from_chat.id if forward_from_chat is not None else (forward_from.id if forward_from is not None else None)
+    poll_vote_count = sum(options_list.values()) if options_list else None
+    reactions_vote_count = sum(reactions_list.values()) if reactions_list is not None else None
+    media_type, file_id, file_unique_id = extract_media(message)
+    items_messages = [
+        dict(
+            chat_id=chat_id,
+            message_id=message_id,
+            sender_id=sender_id,
+            text=extract_text(message),
+            date=message.date,
+            views=message.views,
+            forwards=message.forwards,
+            forward_from_chat_id=forward_from_chat_id,
+            forward_from_message_id=getattr(message, "forward_from_message_id", None),
+            reply_to_message_id=message.reply_to_message_id,
+            poll_vote_count=poll_vote_count,
+            reactions_vote_count=reactions_vote_count,
+            media_type=media_type,
+            file_id=file_id,
+            file_unique_id=file_unique_id,
+        )
+    ]
+    items_reactions = []
+    if reactions_list:
+        for r, c in reactions_list.items():
+            items_reactions.append(dict(
+                chat_id=chat_id,
+                message_id=message_id,
+                reaction_id=r,
+                reaction_votes_norm=c / reactions_vote_count if reactions_vote_count else 0,
+                reaction_votes_abs=c,
+            ))
+    items_polls = []
+    if options_list:
+        for i, (o, v) in enumerate(options_list.items()):
+            items_polls.append(dict(
+                chat_id=chat_id,
+                message_id=message_id,
+                poll_option_id=i,
+                poll_option_text=o,
+                poll_option_votes_norm=v / poll_vote_count if poll_vote_count else 0,
+                poll_option_votes_abs=v,
+            ))
+    items_chats = [extract_chat(chat)]
+    items_users = [extract_user(from_user)] if from_user is not None else []
+    return items_messages, items_reactions, items_polls, items_chats, items_users
+
+
+def extract_engagement(message: Message, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """
+    Only the columns of extract_message_items which change after a message is posted:
+    (messages counters, reactions rows, polls rows without poll_option_text)
+    """
+    chat = message.chat
+    if chat is None or message.id is None or message.empty:
+        return
+    reactions_list = extract_reactions(message, resolve)
+    options_list = extract_poll_options(message)
+    poll_vote_count = sum(options_list.values()) if options_list else None
+    reactions_vote_count = sum(reactions_list.values()) if reactions_list is not None else None
+    counters = dict(
+        chat_id=chat.id,
+        message_id=message.id,
+        views=message.views,
+        forwards=message.forwards,
+        reactions_vote_count=reactions_vote_count,
+        poll_vote_count=poll_vote_count,
+    )
+    items_reactions = [
+        dict(
+            chat_id=chat.id,
+            message_id=message.id,
+            reaction_id=r,
+            reaction_votes_norm=c / reactions_vote_count if reactions_vote_count else 0,
+            reaction_votes_abs=c,
+        )
+        for r, c in (reactions_list or dict()).items()
+    ]
+    items_polls = [
+        dict(
+            chat_id=chat.id,
+            message_id=message.id,
+            poll_option_id=i,
+            poll_option_votes_norm=v / poll_vote_count if poll_vote_count else 0,
+            poll_option_votes_abs=v,
+        )
+        for i, v in enumerate(options_list.values())
+    ]
+    return counters, items_reactions, items_polls
+
+
+class MessagePickler(pickle.Pickler):
+    # the pyrogram Client hangs off every object - store a reference instead of the client itself
+    def persistent_id(self, obj):
+        return "client" if isinstance(obj, Client) else None
+
+
+class MessageUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return None
+
+
+def dump_messages(messages: List[Message]) -> bytes:
+    f = io.BytesIO()
+    MessagePickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(messages)
+    return f.getvalue()
+
+
+def load_messages(payload: bytes) -> List[Message]:
+    return MessageUnpickler(io.BytesIO(payload)).load()
+
+
+PackedRows = Tuple[Tuple[str, ...], List[Tuple]]
+
+
+def pack_rows(rows: List[Dict[str, Any]]) -> PackedRows:
+    # every row of a table comes from the same dict literal, so the key order is shared
+    if not rows:
+        return (), []
+    columns = tuple(rows[0].keys())
+    return columns, [tuple(row.values()) for row in rows]
+
+
+def unpack_rows(packed: PackedRows) -> List[Dict[str, Any]]:
+    columns, rows = packed
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def normalize_chunk(payload: bytes) -> Tuple[List[PackedRows], List[int]]:
+    """
+    NormalizePool worker. Returns the five tables of extract_message_items packed column-major,
+    with reaction_id still holding the raw emoji (see EmojiMap.resolve_rows), and the indexes
+    of the messages the extractor could not handle
+    """
+    messages = load_messages(payload)
+    tables = ([], [], [], [], [])
+    failed = []
+    for i, message in enumerate(messages):
+        try:
+            normalized = extract_message_items(message, raw_emoji)
+        except (AttributeError, TypeError):
+            failed.append(i)
+            continue
+        if not normalized:
+            continue
+        for table, items in zip(tables, normalized):
+            table += items
+    return [pack_rows(table) for table in tables], failed
+
+
+class NormalizePool:
+    """
+    Runs extract_message_items in worker processes so that normalizing a batch does not compete
+    with pyrogram for the GIL. Workers never touch the DB - reactions come back with raw emojis, and
+    messages the extractor fails on are handed back to the caller for the clean_dict fallback.
+    """
+    def __init__(self, processes: int):
+        self.processes = processes
+        # spawn, not fork: the parent runs pyrogram and queue threads
+        self._executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def normalize(self, messages: List[Message]) -> Tuple[Tuple[List[Dict[str, Any]], ...], List[Message]]:
+        if not messages:
+            return ([], [], [], [], []), []
+        chunk_size = -(-len(messages) // self.processes)
+        chunks = [messages[i:i+chunk_size] for i in range(0, len(messages), chunk_size)]
+        futures = [self._executor.submit(normalize_chunk, dump_messages(chunk)) for chunk in chunks]
+        tables = ([], [], [], [], [])
+        failed = []
+        for chunk, future in zip(chunks, futures):
+            packed, failed_indexes = future.result()
+            for table, packed_table in zip(tables, packed):
+                table += unpack_rows(packed_table)
+            failed += [chunk[i] for i in failed_indexes]
+        return tables, failed
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,442 @@
+from typing import Dict, Any, Optional, List, Set, Iterable, Callable, Tuple
+import asyncio
+import inspect
+import logging
+import os
+import time
+import datetime
+from pyrogram.types import Message, Chat, Dialog, ChatPreview
+from sqlalchemy import select, delete, func, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+import common.backend.models as models
+from common.backend.base_backend import BaseBackend, StoredDialog, FetchShard, FetchCheckpoint, QUEUE_DEPTH, QUEUE_BATCHES, WRITE_RETRIES, MessageQueueError
+from common.backend.pg_backend import (
+    TableNames,
+    PreparedBatch,
+    prepare_message_batch,
+    create_normalize_pool,
+    compose_insert_dialog_queries,
+    select_max_message_id,
+    upsert_top_message_id,
+    reset_ongoing_watermark,
+    insert_fetch_shards,
+    checkpoint_fetch_shard,
+    batch_chat_ids,
+    drop_failed_checkpoints,
+    select_fetch_shards,
+    delete_fetch_shards,
+    upsert_watermarks,
+    rebuild_watermark,
+    select_offsets_from_watermarks,
+    select_stored_dialogs,
+    select_message_count,
+    WRITE_SECONDS,
+    ROWS_WRITTEN,
+    COMMIT_SECONDS,
+)
+from common.backend.pg_copy import copy_upsert_async
+from common.backend.emoji_map import EmojiMap
+from common.utils import create_async_postgres_engine, build_upsert
+
+
+_STOP = object()
+
+
+async def upsert_async(conn, model, rows) -> int:
+    stmt, rows = build_upsert(model, rows)
+    if not rows:
+        return 0
+    result = await conn.execute(stmt, rows)
+    return result.rowcount
+
+
+async def write_message_items_async(
+        conn,
+        items_messages: List[Dict[str, Any]],
+        items_reactions: List[Dict[str, Any]],
+        items_polls: List[Dict[str, Any]],
+        items_chats: List[Dict[str, Any]],
+        items_users: List[Dict[str, Any]],
+        *,
+        checkpoints: List[FetchCheckpoint] = (),
+        copy: bool = False,
+) -> Tuple[int, int, int, int]:
+    """
+    Async twin of pg_backend.write_message_items
+    """
+    write_table = copy_upsert_async if copy else upsert_async
+    mode = "copy" if copy else "upsert"
+    async def write(conn, model, rows: List[Dict[str, Any]]) -> int:
+        with WRITE_SECONDS.labels(table=model.__tablename__, mode=mode).time():
+            n = await write_table(conn, model, rows)
+        ROWS_WRITTEN.labels(table=model.__tablename__).inc(max(n, 0))
+        return n
+    update_count_messages, update_count_reactions, update_count_polls, update_count_chats = 0, 0, 0, 0
+    if items_messages:
+        await conn.execute(upsert_watermarks(items_messages))
+        update_count_messages += await write(conn, models.Messages, items_messages)
+    if items_reactions:
+        update_count_reactions += await write(conn, models.Reactions, items_reactions)
+    if items_polls:
+        update_count_polls += await write(conn, models.Polls, items_polls)
+    if items_chats:
+        update_count_chats += await write(conn, models.Chats, items_chats)
+    if items_users:
+        update_count_chats += await write(conn, models.Users, items_users)
+    for c in checkpoints:
+        await conn.execute(checkpoint_fetch_shard(c.chat_id, c.min_id, c.offset_id, done=c.done, session=c.session))
+    return update_count_messages, update_count_reactions, update_count_polls, update_count_chats
+
+
+class AsyncPostgresBackend(BaseBackend):
+    """
+    BaseBackend on asyncpg with a connection pool, for asyncio callers (MessageFetch/main_multi.py).
+    Every DB method is a coroutine. add_message() feeds an asyncio.Queue which is drained by two tasks:
+    one normalizes batch N+1 in a worker thread while the other writes batch N, so the event loop
+    never waits on Postgres unless the queue is full.
+    """
+    _engine: AsyncEngine = None
+
+    def __init__(
+        self,
+        name = "postgres_async",
+        *,
+        batch_fill_timeout: float = 1,
+        batch_size: int = 10000,
+        max_queue_size: Optional[int] = None,
+        pool_size: Optional[int] = None,
+        copy_ingest: Optional[bool] = None,
+        normalize_processes: Optional[int] = None,
+        **kwargs,
+    ):
+        self._engine = create_async_postgres_engine(pool_size=pool_size)
+        if copy_ingest is None:
+            copy_ingest = bool(int(os.environ.get("POSTGRES_COPY_INGEST", 0)))
+        self._copy_ingest = copy_ingest
+        self._known_chats: Set[int] = set()
+        self._failed_chats: Set[int] = set() # chats that lost a batch - their fetch_shards aren't advanced anymore
+        self._normalize_pool = create_normalize_pool(normalize_processes)
+        EmojiMap.preload()
+        self._batch_size = batch_size
+        self._batch_fill_timeout = batch_fill_timeout
+        self._max_queue_size = max_queue_size or 10 * batch_size
+        self._queue: asyncio.Queue = None
+        self._prepared: asyncio.Queue = None
+        self._tasks: List[asyncio.Task] = []
+        self._flushed: asyncio.Condition = None
+        self._enqueued, self._written, self._failed = 0, 0, 0
+        self._failed_ranges: List[Tuple[int, int]] = [] # [start, end) positions in enqueue order of the failed batches
+        self._flush_checked = 0 # messages up to here were already reported by wait_for_queue_flush
+        self._callables_failed = 0 # their batch was written all the same
+        self._stopped = False
+        super().__init__(name, **kwargs)
+        logging.info(f"Created async Postgres pool at {self._engine.url} (copy_ingest={self._copy_ingest})")
+
+    @property
+    def is_connected(self) -> bool:
+        return self._engine is not None
+
+    def _start(self):
+        # asyncio primitives have to be created inside the running loop
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        QUEUE_DEPTH.labels(backend=type(self).__name__).set_function(lambda: self._enqueued - self._written - self._failed)
+        self._prepared = asyncio.Queue(maxsize=1)
+        self._flushed = asyncio.Condition()
+        self._tasks = [
+            asyncio.create_task(self._normalize_loop()),
+            asyncio.create_task(self._write_loop()),
+        ]
+
+    async def add_message(self, message: Message|Callable):
+        """
+        Callables (sync, or returning an awaitable) run once every message added before them is committed
+        """
+        if self._stopped:
+            raise Exception("AsyncPostgresBackend is stopped")
+        self._start()
+        self._enqueued += 1
+        await self._queue.put(message) # waits while the queue is full
+
+    async def _next_batch(self) -> Tuple[List[Message|Callable], bool]:
+        loop = asyncio.get_running_loop()
+        first = await self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = loop.time() + self._batch_fill_timeout
+        while len(batch) < self._batch_size:
+            if self._queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._queue.get_nowait()
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _normalize_loop(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch, stop = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                prepared = await loop.run_in_executor(None, prepare_message_batch, batch, set(self._known_chats), self._normalize_pool)
+            except Exception as e:
+                logging.exception(f"AsyncPostgresBackend - failed to prepare batch of {len(batch)}: {e}")
+                prepared = None
+            await self._prepared.put((prepared, batch))
+        await self._prepared.put(_STOP)
+
+    async def _write(self, prepared: Optional[PreparedBatch], n: int) -> bool:
+        """
+        Writes a prepared batch, retrying WRITE_RETRIES times. Its callables aren't part of the retried write
+        """
+        if prepared is None:
+            return False
+        for attempt in range(WRITE_RETRIES):
+            try:
+                await self.write_prepared_messages(prepared)
+                return True
+            except Exception as e:
+                logging.exception(f"AsyncPostgresBackend - failed to write batch of {n} (attempt {attempt+1}/{WRITE_RETRIES}): {e}")
+                if attempt + 1 < WRITE_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        return False
+
+    async def _run_callables(self, callables: List[Callable], *, raise_errors: bool = False):
+        """
+        Runs the callables of a written batch once each. Unless raise_errors, one that raises is logged and the
+        batch still counts as written
+        """
+        for c in callables:
+            try:
+                result = c()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                if raise_errors:
+                    raise
+                logging.exception(f"AsyncPostgresBackend - callable {c} failed: {e}")
+                self._callables_failed += 1
+        logging.info(f"Called {len(callables)} callables")
+
+    async def _write_loop(self):
+        while True:
+            item = await self._prepared.get()
+            if item is _STOP:
+                return
+            prepared, batch = item
+            n = len(batch)
+            failed = not await self._write(prepared, n)
+            if failed:
+                logging.error(f"AsyncPostgresBackend - dropped a batch of {n} messages, its checkpoints and callables")
+                self._failed_chats |= batch_chat_ids(batch)
+            else:
+                await self._run_callables(prepared.callables)
+            QUEUE_BATCHES.labels(backend=type(self).__name__, status="failed" if failed else "written").inc()
+            async with self._flushed:
+                if failed:
+                    start = self._written + self._failed
+                    self._failed_ranges.append((start, start + n))
+                    self._failed += n
+                else:
+                    self._written += n
+                self._flushed.notify_all()
+
+    def _check_lost(self, since: int, target: int):
+        lost = sum(min(end, target) - max(start, since) for start, end in self._failed_ranges if start < target and end > since)
+        if lost:
+            raise MessageQueueError(f"{lost} of the messages enqueued in [{since}, {target}) were not written")
+
+    async def write_prepared_messages(self, prepared: PreparedBatch):
+        new_chats = {c["chat_id"] for c in prepared.items_chats} | {u["sender_id"] for u in prepared.items_users}
+        async with self._engine.begin() as conn:
+            update_count_messages, update_count_reactions, update_count_polls, update_count_chats = await write_message_items_async(
+                conn,
+                prepared.items_messages,
+                prepared.items_reactions,
+                prepared.items_polls,
+                prepared.items_chats,
+                prepared.items_users,
+                checkpoints=drop_failed_checkpoints(prepared.checkpoints, self._failed_chats),
+                copy=self._copy_ingest,
+            )
+            t_commit = time.time()
+        COMMIT_SECONDS.labels(backend="AsyncPostgresBackend").observe(time.time() - t_commit) # leaving begin() commits
+        update_count = update_count_messages + update_count_reactions + update_count_polls + update_count_chats
+        self._known_chats |= new_chats
+        if update_count:
+            logging.info(f"Inserted {update_count} items, of which: {update_count_messages} messages, {update_count_reactions} reactions, {update_count_polls} polls, {update_count_chats} chats")
+
+    async def add_messages(self, messages: Iterable[Message|Callable]):
+        """
+        Writes the messages right away, bypassing the queue
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(None, prepare_message_batch, messages, set(self._known_chats), self._normalize_pool)
+        await self.write_prepared_messages(prepared)
+        await self._run_callables(prepared.callables, raise_errors=True)
+
+    async def wait_for_queue_flush(self, *, timeout: Optional[float] = None):
+        """
+        Waits until every message added so far was processed. Raises MessageQueueError if any of those added
+        since the previous call were lost
+        """
+        if self._queue is None:
+            return
+        target = self._enqueued
+        since, self._flush_checked = self._flush_checked, target
+        async with self._flushed:
+            await asyncio.wait_for(self._flushed.wait_for(lambda: self._written + self._failed >= target), timeout=timeout)
+        self._check_lost(since, target)
+
+    async def close(self):
+        logging.info(f"AsyncPostgresBackend.close() - start")
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._queue is not None:
+            await self._queue.put(_STOP)
+            await asyncio.gather(*self._tasks)
+        await self._engine.dispose()
+        self._engine = None
+        if self._normalize_pool is not None:
+            self._normalize_pool.close()
+            self._normalize_pool = None
+        logging.info(f"AsyncPostgresBackend.close() - end")
+        self._check_lost(0, self._enqueued)
+
+    async def unselect_channel(self):
+        assert self._selected_channel is not None
+        await self.add_channel(self._selected_channel)
+        self._selected_channel = None
+
+    async def add_channel(self, dialog: Dialog|Chat|ChatPreview|List[Dialog|Chat|ChatPreview]):
+        dialog_query_list = compose_insert_dialog_queries(dialog)
+        async with self._engine.begin() as conn:
+            await upsert_async(conn, models.Chats, dialog_query_list)
+
+    async def set_top_message_id_to_db_max(self, channel_id: int, at_most: Optional[int] = None):
+        """
+        See PostgresBackend.set_top_message_id_to_db_max
+        """
+        await self.add_message(lambda: self._set_top_message_id_to_db_max(channel_id, at_most))
+
+    async def _set_top_message_id_to_db_max(self, channel_id: int, at_most: Optional[int] = None):
+        if channel_id in self._failed_chats:
+            logging.error(f"Not setting {channel_id} top_message_id: a batch of it was lost, its fetch shards are kept for a refetch")
+            return
+        async with self._engine.begin() as conn:
+            top_message_id = (await conn.execute(select_max_message_id(channel_id))).scalar()
+            if top_message_id is None:
+                return
+            if at_most is not None:
+                top_message_id = min(top_message_id, at_most)
+            await conn.execute(upsert_top_message_id(channel_id, top_message_id, only_increase=True))
+            await conn.execute(reset_ongoing_watermark(channel_id, top_message_id))
+            await conn.execute(delete_fetch_shards(channel_id, top_message_id))
+
+    async def set_top_message_id(self, channel_id: int, top_message_id: int, skip_check: bool = False):
+        """
+        Announce that the DB contains all available messages in range [0, top_message_id]
+        """
+        async with self._engine.begin() as conn:
+            if not skip_check:
+                stmt = (
+                    select(models.Messages.message_id)
+                    .where(models.Messages.chat_id == channel_id)
+                    .where(models.Messages.message_id > top_message_id)
+                    .limit(1)
+                )
+                row = (await conn.execute(stmt)).first()
+                if row:
+                    raise RuntimeError(f"Cannot set top_message_id to {top_message_id} for chat {channel_id}: there are messages with message_id > {top_message_id}, such as {row[0]}")
+            await conn.execute(upsert_top_message_id(channel_id, top_message_id))
+            await conn.execute(reset_ongoing_watermark(channel_id, top_message_id))
+            await conn.execute(delete_fetch_shards(channel_id, top_message_id))
+
+    async def get_fetch_shards(self) -> Dict[int, List[FetchShard]]:
+        d = dict()
+        async with self._engine.connect() as conn:
+            for row in (await conn.execute(select_fetch_shards())).fetchall():
+                d.setdefault(row[0], []).append(FetchShard(*row))
+        return d
+
+    async def add_fetch_shards(self, shards: List[FetchShard]):
+        if not shards:
+            return
+        async with self._engine.begin() as conn:
+            await conn.execute(insert_fetch_shards(shards))
+
+    async def checkpoint_fetch_shard(self, chat_id: int, min_id: int, offset_id: int, *, done: bool = False, session: Optional[str] = None):
+        """
+        Queued after the messages it covers and committed together with the last of them
+        """
+        await self.add_message(FetchCheckpoint(chat_id, min_id, offset_id, done, session))
+
+    async def get_offsets_from_ongoing_writes(self) -> Dict[int, Optional[int]]:
+        async with self._engine.connect() as conn:
+            result = await conn.execute(select_offsets_from_watermarks())
+            return {row[0]: row[1] for row in result.fetchall()}
+
+    async def delete_messages(self, channel_id: int, id_min: int, id_max: int):
+        assert id_min <= id_max
+        async with self._engine.begin() as conn:
+            for model in [models.Polls, models.Reactions, models.Messages]:
+                await conn.execute(
+                    delete(model)
+                    .where(model.chat_id == channel_id)
+                    .where(model.message_id >= id_min)
+                    .where(model.message_id <= id_max)
+                )
+            await conn.execute(rebuild_watermark(channel_id))
+
+    async def delete_channel(self, channel_id: int):
+        assert self._selected_channel is None
+        async with self._engine.begin() as conn:
+            for model in [models.Polls, models.Reactions, models.Messages, models.Chats, models.ChatWatermarks, models.FetchShards, models.EngagementSamples, models.EngagementSeries, models.MessageHype]:
+                await conn.execute(delete(model).where(model.chat_id == channel_id))
+
+    async def get_stored_dialogs(self) -> Dict[int, StoredDialog]:
+        async with self._engine.connect() as conn:
+            result = await conn.execute(select_stored_dialogs())
+            d = {row[0]: StoredDialog(title=row[1], max_id=row[2], username=None, invite_link=None)
+                 for row in result.fetchall()}
+        self._stored_dialogs = d
+        return d
+
+    async def get_stored_dialogs_committed(self) -> Dict[int, StoredDialog]:
+        async with self._engine.connect() as conn:
+            result = await conn.execute(text(f"SELECT chat_id, title, top_message_id, username, invite_link FROM {TableNames.CHATS}"))
+            d = {row[0]: StoredDialog(title=row[1], max_id=row[2], username=row[3], invite_link=row[4])
+                 for row in result.fetchall()}
+        self._stored_dialogs = d
+        self._known_chats |= set(d.keys())
+        return d
+
+    async def find_channel(self, search_str: str) -> List[Dict[str, Any]]:
+        async with self._engine.connect() as conn:
+            result = await conn.execute(select(models.Chats).where(models.Chats.title.like(f"%{search_str}%")))
+            return [dict(row._mapping) for row in result.fetchall()]
+
+    async def count_messages(self) -> Tuple[int, datetime.datetime]:
+        async with self._engine.connect() as conn:
+            row = (await conn.execute(select_message_count())).first()
+        return row[0], row[1]
+
+    async def count_dialogs(self) -> int:
+        async with self._engine.connect() as conn:
+            return (await conn.execute(select(func.count()).select_from(models.Chats))).scalar()
@@ -1,10 +1,10 @@
 from typing import Tuple, Dict, Any, Optional, List, Set, Iterable, Callable
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 import pyrogram.types
 from pyrogram.types import Message, User, Chat, ChatReactions, Reaction, Poll, PollOption, Dialog, ChatPreview, MessageEntity
 from pyrogram.enums import ChatType
 import sqlalchemy
-from sqlalchemy import Connection, create_engine, Table, Column, Integer, String, MetaData, DateTime, Float, Boolean, ForeignKey, Enum, Text, select, delete, func, outerjoin
+from sqlalchemy import Connection, create_engine, Table, Column, Integer, String, MetaData, DateTime, Float, Boolean, ForeignKey, Enum, Text, select, delete, update, func, outerjoin, text
 import pgvector
 import common.backend.models as models
 import threading
@@ -14,8 +14,9 @@ import asyncio
 import time
 import datetime
 from common.consts import consts
-from common.backend.base_backend import BaseBackendWithQueue, MessageQueue, media_type_dict, chat_type_dict, StoredDialog, clean_dict
+from common.backend.base_backend import BaseBackendWithQueue, MessageQueue, media_type_dict, chat_type_dict, StoredDialog, FetchShard, FetchCheckpoint, clean_dict
 from common.backend.emoji_map import EmojiMap
+from common.backend.normalize import extract_message_items, extract_chat, extract_engagement, raw_emoji, NormalizePool
 import common.backend.models as models
 from common.utils import create_postgres_engine
 from sqlalchemy.orm import Session
@@ -24,6 +25,17 @@ import json
 import os
 
 from common.utils import upsert
+from common.backend.pg_copy import copy_upsert
+from common import metrics
+
+
+NORMALIZE_SECONDS = metrics.histogram("telelog_normalize_seconds", "Time to normalize one batch of messages into rows", ["mode"])
+WRITE_SECONDS = metrics.histogram("telelog_upsert_seconds", "Time to upsert the rows of one table of a batch", ["table", "mode"])
+ROWS_WRITTEN = metrics.counter("telelog_rows_written_total", "Rows inserted or updated", ["table"])
+COMMIT_SECONDS = metrics.histogram("telelog_commit_seconds", "Time to commit one batch", ["backend"])
+
+
+PreparedBatch = namedtuple("PreparedBatch", ["items_messages", "items_reactions", "items_polls", "items_chats", "items_users", "checkpoints", "callables"])
 
 
 class TableNames:
@@ -31,6 +43,11 @@ class TableNames:
     CHATS = "chats"
     REACTIONS = "reactions"
     POLLS = "polls"
+    WATERMARKS = "chat_watermarks"
+    SHARDS = "fetch_shards"
+    ENGAGEMENT = "engagement_samples"
+    ENGAGEMENT_SERIES = "engagement_series"
+    HYPE = "message_hype"
 
 
 def create_dict_insert_query(*, table_name, values, on_conflict_keys=[], on_conflict_update_keys = []) -> Tuple[str, List]:
@@ -60,12 +77,17 @@ def perform_insert(cur, *, table_name, values, on_conflict_keys=[], on_conflict_
     cur.execute(query, values)
 
 
-def compose_insert_message_query(message: Message) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
-    return compose_insert_message_dict_query(clean_dict(message))
+def compose_insert_message_query(message: Message, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    try:
+        return extract_message_items(message, resolve)
+    except (AttributeError, TypeError) as e:
+        # unexpected object layout (e.g. a pyrogram fork renaming fields) - take the slow, generic path
+        logging.warning(f"extract_message_items failed ({e}), falling back to clean_dict")
+        return compose_insert_message_dict_query(clean_dict(message), resolve)
 
 
-def compose_insert_message_dict_query(message: Dict) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
-    reactions_list: Dict[int, int] = get_reactions_list(message)
+def compose_insert_message_dict_query(message: Dict, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    reactions_list: Dict[int, int] = get_reactions_list(message, resolve)
     options_list: Dict[str, int] = get_poll_options(message) if message.get("poll", None) else dict()
     chat_id: int = message.get("chat", {}).get("id", None)
     message_id: int = message.get("id", None)
@@ -200,9 +222,7 @@ def compose_insert_user_dict_query(chat: Dict) -> Dict[str, Any]:
     return chat_dict
 
 
-def get_reactions_list(message: Dict) -> Dict[int, int]:
-    if not EmojiMap.emoji_map:
-        EmojiMap._reload_map()
+def get_reactions_list(message: Dict, resolve: Callable[[str|int], Any] = EmojiMap.to_int) -> Dict[int, int]:
     reactions = message.get("reactions", None)
     i = 0
     if reactions is None:
@@ -212,7 +232,7 @@ def get_reactions_list(message: Dict) -> Dict[int, int]:
         i += 1
     if not isinstance(reactions, list):
         return None # FIXME report error
-    return {EmojiMap.to_int(r.get("emoji", r.get("custom_emoji_id", None))): r.get("count", None)
+    return {resolve(r.get("emoji", r.get("custom_emoji_id", None))): r.get("count", None)
             for r in reactions}
 
 
@@ -266,6 +286,438 @@ def get_message_media(message: Dict) -> Tuple[str, str]:
         return None, None, None
 
 
+def compose_insert_dialog_queries(dialog: Dialog|Chat|ChatPreview|List[Dialog|Chat|ChatPreview]) -> List[Dict[str, Any]]:
+    dialog_list: List[Dialog|Chat|ChatPreview] = []
+    if isinstance(dialog, (Dialog, Chat, ChatPreview)):
+        dialog_list.append(dialog)
+    elif isinstance(dialog, list):
+        dialog_list = dialog
+    else:
+        raise ValueError(f"Incorrect dialog type: {type(dialog)}")
+    dialog_query_list = []
+    for dialog in dialog_list:
+        if isinstance(dialog, Dialog):
+            chat: Chat = dialog.chat
+            d = extract_chat(chat)
+        elif isinstance(dialog, Chat):
+            chat: Chat = dialog
+            d = extract_chat(chat)
+        elif isinstance(dialog, ChatPreview):
+            chat: ChatPreview = dialog
+            d = compose_insert_chat_dict_query(clean_dict(chat))
+        else:
+            raise ValueError(f"Incorrect dialog type: {type(dialog)}")
+        dialog_query_list.append(d)
+    return dialog_query_list
+
+
+def select_max_message_id(channel_id: int):
+    return (
+        select(models.ChatWatermarks.max_message_id)
+        .where(models.ChatWatermarks.chat_id == channel_id)
+    )
+
+
+def upsert_top_message_id(channel_id: int, top_message_id: int, *, only_increase: bool = False):
+    """
+    only_increase=True never moves an existing top_message_id down (several writers may announce ranges)
+    """
+    return (
+        insert(models.Chats)
+        .values(dict(chat_id=channel_id, top_message_id=top_message_id))
+        .on_conflict_do_update(
+            index_elements=["chat_id"],
+            set_=dict(top_message_id=top_message_id),
+            where=(models.Chats.top_message_id.is_(None) | (models.Chats.top_message_id < top_message_id)) if only_increase else None,
+        )
+    )
+
+
+def reset_ongoing_watermark(channel_id: int, top_message_id: int):
+    """
+    Run together with upsert_top_message_id - nothing is stored above a newly committed top_message_id
+    """
+    return (
+        update(models.ChatWatermarks)
+        .where(models.ChatWatermarks.chat_id == channel_id)
+        .where(models.ChatWatermarks.ongoing_min_message_id <= top_message_id)
+        .values(ongoing_min_message_id=None)
+    )
+
+
+def insert_fetch_shards(shards: List[FetchShard]):
+    return (
+        insert(models.FetchShards)
+        .values([dict(chat_id=s.chat_id, min_id=s.min_id, max_id=s.max_id, offset_id=s.offset_id, done=s.done) for s in shards])
+        .on_conflict_do_nothing(index_elements=["chat_id", "min_id"])
+    )
+
+
+def checkpoint_fetch_shard(chat_id: int, min_id: int, offset_id: int, *, done: bool = False, session: Optional[str] = None):
+    """
+    Only run once every message of the shard above offset_id is committed (or in the same transaction)
+    """
+    values = dict(
+        offset_id=func.least(models.FetchShards.offset_id, offset_id),
+        updated_at=func.now(),
+    )
+    if done:
+        values["done"] = True
+    if session is not None:
+        values["session"] = session
+    return (
+        update(models.FetchShards)
+        .where(models.FetchShards.chat_id == chat_id)
+        .where(models.FetchShards.min_id == min_id)
+        .values(**values)
+    )
+
+
+def collapse_checkpoints(checkpoints: List[FetchCheckpoint]) -> List[FetchCheckpoint]:
+    """
+    The lowest offset_id of every shard in a batch
+    """
+    d: Dict[Tuple[int, int], FetchCheckpoint] = dict()
+    for c in checkpoints:
+        prev = d.get((c.chat_id, c.min_id), None)
+        if prev is not None:
+            c = c._replace(offset_id=min(prev.offset_id, c.offset_id), done=prev.done or c.done, session=c.session or prev.session)
+        d[(c.chat_id, c.min_id)] = c
+    return list(d.values())
+
+
+def batch_chat_ids(messages: List[Message|Callable]) -> Set[int]:
+    """
+    Chats with messages or fetch_shards checkpoints in a batch
+    """
+    ids = {m.chat_id for m in messages if isinstance(m, FetchCheckpoint)}
+    ids |= {m.chat.id for m in messages if isinstance(m, Message) and m.chat is not None}
+    return ids
+
+
+def drop_failed_checkpoints(checkpoints: List[FetchCheckpoint], failed_chats: Set[int]) -> List[FetchCheckpoint]:
+    """
+    A chat that lost a batch keeps its fetch_shards where they were before the loss, so they're refetched from there
+    """
+    dropped = [c for c in checkpoints if c.chat_id in failed_chats]
+    for c in dropped:
+        logging.warning(f"Not checkpointing shard ({c.chat_id}, {c.min_id}) at {c.offset_id}: an earlier batch of the chat was lost")
+    return [c for c in checkpoints if c.chat_id not in failed_chats]
+
+
+def select_fetch_shards():
+    return select(
+        models.FetchShards.chat_id,
+        models.FetchShards.min_id,
+        models.FetchShards.max_id,
+        models.FetchShards.offset_id,
+        models.FetchShards.done,
+    )
+
+
+def delete_fetch_shards(channel_id: int, top_message_id: Optional[int] = None):
+    """
+    Shards entirely at or below top_message_id (all of them if None) - run together with upsert_top_message_id
+    """
+    stmt = delete(models.FetchShards).where(models.FetchShards.chat_id == channel_id)
+    if top_message_id is not None:
+        stmt = stmt.where(models.FetchShards.max_id <= top_message_id + 1)
+    return stmt
+
+
+def upsert_watermarks(items_messages: List[Dict[str, Any]]):
+    """
+    Folds a batch into chat_watermarks. Has to run before the batch itself is written,
+    since message_count only counts messages which are not stored yet.
+    """
+    batch = {(m["chat_id"], m["message_id"]): m.get("date", None) for m in items_messages}
+    return text(f"""
+        INSERT INTO {TableNames.WATERMARKS} AS w (chat_id, min_message_id, max_message_id, ongoing_min_message_id, message_count, max_date, last_fetch)
+        SELECT
+            b.chat_id,
+            MIN(b.message_id),
+            MAX(b.message_id),
+            MIN(b.message_id) FILTER (WHERE c.top_message_id IS NULL OR b.message_id > c.top_message_id),
+            COUNT(*) FILTER (WHERE NOT EXISTS (
+                SELECT 1 FROM {TableNames.MESSAGES} m WHERE m.chat_id = b.chat_id AND m.message_id = b.message_id
+            )),
+            MAX(b.date),
+            now()
+        FROM unnest(CAST(:chat_ids AS BIGINT[]), CAST(:message_ids AS BIGINT[]), CAST(:dates AS TIMESTAMP[])) AS b(chat_id, message_id, date)
+        LEFT JOIN {TableNames.CHATS} c ON c.chat_id = b.chat_id
+        GROUP BY b.chat_id
+        ON CONFLICT (chat_id) DO UPDATE SET
+            min_message_id = LEAST(w.min_message_id, EXCLUDED.min_message_id),
+            max_message_id = GREATEST(w.max_message_id, EXCLUDED.max_message_id),
+            ongoing_min_message_id = LEAST(w.ongoing_min_message_id, EXCLUDED.ongoing_min_message_id),
+            message_count = w.message_count + EXCLUDED.message_count,
+            max_date = GREATEST(w.max_date, EXCLUDED.max_date),
+            last_fetch = EXCLUDED.last_fetch
+    """).bindparams(
+        chat_ids=[k[0] for k in batch.keys()],
+        message_ids=[k[1] for k in batch.keys()],
+        dates=list(batch.values()),
+    )
+
+
+def rebuild_watermark(channel_id: int):
+    """
+    Recomputes the watermark of one chat from messages (after deleting messages)
+    """
+    return text(f"""
+        INSERT INTO {TableNames.WATERMARKS} AS w (chat_id, min_message_id, max_message_id, ongoing_min_message_id, message_count, max_date)
+        SELECT
+            CAST(:chat_id AS BIGINT),
+            MIN(m.message_id),
+            MAX(m.message_id),
+            MIN(m.message_id) FILTER (WHERE c.top_message_id IS NULL OR m.message_id > c.top_message_id),
+            COUNT(*),
+            MAX(m.date)
+        FROM {TableNames.MESSAGES} m
+        LEFT JOIN {TableNames.CHATS} c ON c.chat_id = m.chat_id
+        WHERE m.chat_id = :chat_id
+        ON CONFLICT (chat_id) DO UPDATE SET
+            min_message_id = EXCLUDED.min_message_id,
+            max_message_id = EXCLUDED.max_message_id,
+            ongoing_min_message_id = EXCLUDED.ongoing_min_message_id,
+            message_count = EXCLUDED.message_count,
+            max_date = EXCLUDED.max_date
+    """).bindparams(chat_id=channel_id)
+
+
+def select_offsets_from_watermarks():
+    """
+    select_offsets_from_ongoing_writes(models.Messages), read from chat_watermarks in O(chats)
+    """
+    return (
+        select(models.ChatWatermarks.chat_id, models.ChatWatermarks.ongoing_min_message_id)
+        .where(models.ChatWatermarks.ongoing_min_message_id.is_not(None))
+    )
+
+
+def select_stored_dialogs():
+    return (
+        select(models.ChatWatermarks.chat_id, models.Chats.title, models.ChatWatermarks.max_message_id)
+        .select_from(models.ChatWatermarks)
+        .outerjoin(models.Chats, models.Chats.chat_id == models.ChatWatermarks.chat_id)
+        .where(models.ChatWatermarks.max_message_id.is_not(None))
+    )
+
+
+def select_message_count():
+    return select(
+        func.coalesce(func.sum(models.ChatWatermarks.message_count), 0),
+        func.max(models.ChatWatermarks.max_date),
+    )
+
+
+def select_offsets_from_ongoing_writes(model = models.Messages):
+    """
+    For every chat, the lowest stored message_id above the committed top_message_id
+    (where an interrupted backfill should resume)
+    """
+    return (
+        select(
+            models.Chats.chat_id, 
+            select(func.min(model.message_id))
+                .where(model.chat_id == models.Chats.chat_id)
+                .where(
+                    (models.Chats.top_message_id.is_(None))
+                    | (model.message_id > models.Chats.top_message_id)
+                )
+                .label("min_message_id")
+        )
+        .select_from(models.Chats)
+        # ongoing_write is just an indicator - not actually necessary for correctness
+        # was originally here for performance, but turns out it's not necessary for that either
+        #.where(models.Chats.ongoing_write == True)
+    )
+
+
+def select_engagement_due(stages: List[datetime.timedelta], *, now: datetime.datetime, grace: datetime.timedelta, limit: int, exclude_chats: Iterable[int] = ()):
+    """
+    (chat_id, message_id, stage) of messages older than the stage-th refresh age (counted from 1) without a sample
+    for it (in engagement_samples, or already compacted into engagement_series), newest first. Messages older than the last age + grace are left alone - their counters barely move anymore.
+    Chats in exclude_chats are skipped, so they don't take up the limit
+    """
+    cutoffs = {f"cutoff_{k}": now - age for k, age in enumerate(stages, start=1)}
+    due_stage = " ".join(f"WHEN m.date <= :cutoff_{k} THEN {k}" for k in reversed(range(1, len(stages) + 1)))
+    return text(f"""
+        SELECT d.chat_id, d.message_id, d.stage FROM (
+            SELECT m.chat_id, m.message_id, m.date, CASE {due_stage} END AS stage
+            FROM {TableNames.MESSAGES} m
+            WHERE m.date > :oldest AND m.date <= :cutoff_1
+            AND m.chat_id <> ALL(CAST(:exclude_chats AS BIGINT[]))
+        ) d
+        WHERE COALESCE(GREATEST(
+            (SELECT MAX(s.stage) FROM {TableNames.ENGAGEMENT} s WHERE s.chat_id = d.chat_id AND s.message_id = d.message_id),
+            (SELECT e.stage FROM {TableNames.ENGAGEMENT_SERIES} e WHERE e.chat_id = d.chat_id AND e.message_id = d.message_id AND e.posted_at = d.date)
+        ), 0) < d.stage
+        ORDER BY d.date DESC
+        LIMIT :limit
+    """).bindparams(oldest=now - stages[-1] - grace, limit=limit, exclude_chats=list(exclude_chats), **cutoffs)
+
+
+def update_message_counters(items_counters: List[Dict[str, Any]]):
+    """
+    Updates only the counter columns of messages, and only in rows where one of them changed
+    """
+    return text(f"""
+        UPDATE {TableNames.MESSAGES} AS m SET
+            views = b.views,
+            forwards = b.forwards,
+            reactions_vote_count = b.reactions_vote_count,
+            poll_vote_count = b.poll_vote_count
+        FROM unnest(
+            CAST(:chat_ids AS BIGINT[]), CAST(:message_ids AS BIGINT[]), CAST(:views AS INTEGER[]),
+            CAST(:forwards AS INTEGER[]), CAST(:reactions_vote_counts AS INTEGER[]), CAST(:poll_vote_counts AS INTEGER[])
+        ) AS b(chat_id, message_id, views, forwards, reactions_vote_count, poll_vote_count)
+        WHERE m.chat_id = b.chat_id AND m.message_id = b.message_id
+        AND (m.views, m.forwards, m.reactions_vote_count, m.poll_vote_count)
+            IS DISTINCT FROM (b.views, b.forwards, b.reactions_vote_count, b.poll_vote_count)
+    """).bindparams(
+        chat_ids=[r["chat_id"] for r in items_counters],
+        message_ids=[r["message_id"] for r in items_counters],
+        views=[r["views"] for r in items_counters],
+        forwards=[r["forwards"] for r in items_counters],
+        reactions_vote_counts=[r["reactions_vote_count"] for r in items_counters],
+        poll_vote_counts=[r["poll_vote_count"] for r in items_counters],
+    )
+
+
+def update_poll_votes(items_polls: List[Dict[str, Any]]):
+    """
+    Like update_message_counters, for the votes of poll options (the option texts don't change)
+    """
+    return text(f"""
+        UPDATE {TableNames.POLLS} AS p SET
+            poll_option_votes_norm = b.votes_norm,
+            poll_option_votes_abs = b.votes_abs
+        FROM unnest(
+            CAST(:chat_ids AS BIGINT[]), CAST(:message_ids AS BIGINT[]), CAST(:option_ids AS INTEGER[]),
+            CAST(:votes_norm AS REAL[]), CAST(:votes_abs AS INTEGER[])
+        ) AS b(chat_id, message_id, option_id, votes_norm, votes_abs)
+        WHERE p.chat_id = b.chat_id AND p.message_id = b.message_id AND p.poll_option_id = b.option_id
+        AND p.poll_option_votes_abs IS DISTINCT FROM b.votes_abs
+    """).bindparams(
+        chat_ids=[r["chat_id"] for r in items_polls],
+        message_ids=[r["message_id"] for r in items_polls],
+        option_ids=[r["poll_option_id"] for r in items_polls],
+        votes_norm=[r["poll_option_votes_norm"] for r in items_polls],
+        votes_abs=[r["poll_option_votes_abs"] for r in items_polls],
+    )
+
+
+def write_engagement_items(
+        sess: Session,
+        items_counters: List[Dict[str, Any]],
+        items_reactions: List[Dict[str, Any]],
+        items_polls: List[Dict[str, Any]],
+        items_samples: List[Dict[str, Any]],
+) -> int:
+    """
+    The narrow twin of write_message_items for refetched messages (the caller commits).
+    Returns the number of messages whose counters changed
+    """
+    n = 0
+    if items_counters:
+        n = sess.execute(update_message_counters(items_counters)).rowcount
+        ROWS_WRITTEN.labels(table=TableNames.MESSAGES).inc(max(n, 0))
+    if items_reactions:
+        ROWS_WRITTEN.labels(table=TableNames.REACTIONS).inc(max(upsert(sess, models.Reactions, items_reactions).rowcount, 0))
+    if items_polls:
+        ROWS_WRITTEN.labels(table=TableNames.POLLS).inc(max(sess.execute(update_poll_votes(items_polls)).rowcount, 0))
+    if items_samples:
+        sess.execute(insert(models.EngagementSamples).on_conflict_do_nothing(), items_samples)
+        ROWS_WRITTEN.labels(table=TableNames.ENGAGEMENT).inc(len(items_samples))
+    return n
+
+
+def create_normalize_pool(processes: Optional[int] = None) -> Optional[NormalizePool]:
+    if processes is None:
+        processes = int(os.environ.get("POSTGRES_NORMALIZE_PROCESSES", 0))
+    if processes <= 0:
+        return None
+    logging.info(f"Normalizing messages in {processes} processes")
+    return NormalizePool(processes)
+
+
+def prepare_message_batch(messages: List[Message|Callable], known_chats: Set[int], pool: Optional[NormalizePool] = None) -> PreparedBatch:
+    t_start = time.time()
+    checkpoints = collapse_checkpoints([m for m in messages if isinstance(m, FetchCheckpoint)])
+    callables = [m for m in messages if not isinstance(m, (Message, FetchCheckpoint))] # can use callable() too I guess
+    messages = [m for m in messages if isinstance(m, Message)]
+    items_messages, items_reactions, items_polls, items_chats, items_users = [], [], [], [], []
+    if pool is not None:
+        (items_messages, items_reactions, items_polls, items_chats, items_users), messages = pool.normalize(messages)
+    for i in range(len(messages)):
+        normalized = compose_insert_message_query(messages[i], raw_emoji)
+        if not normalized:
+            continue
+        items_messages_add, items_reactions_add, items_polls_add, items_chats_add, items_users_add = normalized
+        items_messages += items_messages_add
+        items_reactions += items_reactions_add
+        items_polls += items_polls_add
+        items_chats += items_chats_add
+        items_users += items_users_add
+    EmojiMap.resolve_rows(items_reactions) # one round trip for all new emojis of the batch, none if there are none
+    items_chats_dict = aggregate_chat_dict_queries("chat_id", items_chats, known_chats)
+    items_users_dict = aggregate_chat_dict_queries("sender_id", items_users, known_chats)
+    logging.info(f"items_chats_dict: {len(items_chats)}->{len(items_chats_dict)}, items_users_dict: {len(items_users)}->{len(items_users_dict)}")
+    NORMALIZE_SECONDS.labels(mode="pool" if pool is not None else "inprocess").observe(time.time() - t_start)
+    return PreparedBatch(
+        items_messages=items_messages,
+        items_reactions=items_reactions,
+        items_polls=items_polls,
+        items_chats=list(items_chats_dict.values()),
+        items_users=list(items_users_dict.values()),
+        checkpoints=checkpoints,
+        callables=callables,
+    )
+
+
+def write_message_items(
+        sess: Session,
+        items_messages: List[Dict[str, Any]],
+        items_reactions: List[Dict[str, Any]],
+        items_polls: List[Dict[str, Any]],
+        items_chats: List[Dict[str, Any]],
+        items_users: List[Dict[str, Any]],
+        *,
+        checkpoints: List[FetchCheckpoint] = (),
+        copy: bool = False,
+) -> Tuple[int, int, int, int]:
+    """
+    Writes one normalized batch inside sess (the caller commits), with the fetch_shards checkpoints queued
+    after its messages - a shard's offset_id is never ahead of its committed messages.
+    copy=True stages every table with binary COPY and merges it with one upsert per table,
+    copy=False goes through the executemany-based upsert().
+    Returns (messages, reactions, polls, chats+users) affected row counts.
+    """
+    write_table = copy_upsert if copy else (lambda sess, model, rows: upsert(sess, model, rows).rowcount)
+    mode = "copy" if copy else "upsert"
+    def write(sess: Session, model, rows: List[Dict[str, Any]]) -> int:
+        with WRITE_SECONDS.labels(table=model.__tablename__, mode=mode).time():
+            n = write_table(sess, model, rows)
+        ROWS_WRITTEN.labels(table=model.__tablename__).inc(max(n, 0))
+        return n
+    update_count_messages, update_count_reactions, update_count_polls, update_count_chats = 0, 0, 0, 0
+    if items_messages:
+        sess.execute(upsert_watermarks(items_messages))
+        update_count_messages += write(sess, models.Messages, items_messages)
+    if items_reactions:
+        update_count_reactions += write(sess, models.Reactions, items_reactions)
+    if items_polls:
+        update_count_polls += write(sess, models.Polls, items_polls)
+    if items_chats:
+        update_count_chats += write(sess, models.Chats, items_chats)
+    if items_users:
+        update_count_chats += write(sess, models.Users, items_users)
+    for c in checkpoints:
+        sess.execute(checkpoint_fetch_shard(c.chat_id, c.min_id, c.offset_id, done=c.done, session=c.session))
+    return update_count_messages, update_count_reactions, update_count_polls, update_count_chats
+
+
 class PostgresBackend(BaseBackendWithQueue):
     _conn: Connection
 
@@ -274,20 +726,35 @@ class PostgresBackend(BaseBackendWithQueue):
         name = "postgres",
         *,
         model = None,
+        copy_ingest: Optional[bool] = None,
+        normalize_processes: Optional[int] = None,
         **kwargs,
     ):
         self._engine = create_postgres_engine()
         self._conn: Connection = self.new_connection()
         self._model = model
-        super().__init__(name, **kwargs)
-        logging.info(f"Connected to Postgres at {self._engine.url}")
+        if copy_ingest is None:
+            copy_ingest = bool(int(os.environ.get("POSTGRES_COPY_INGEST", 0)))
+        self._copy_ingest = copy_ingest
         self._known_chats: Set[int] = set()
+        self._known_chats_lock = threading.Lock() # read by the normalize thread, grown by the write thread and callers
+        self._failed_chats: Set[int] = set() # chats that lost a batch - their fetch_shards aren't advanced anymore
+        self._normalize_pool = create_normalize_pool(normalize_processes)
+        EmojiMap.preload()
+        super().__init__(name, **kwargs)
+        logging.info(f"Connected to Postgres at {self._engine.url} (copy_ingest={self._copy_ingest})")
 
     def new_connection(self) -> Connection:
         return self._engine.connect()
     
     def _commit(self):
         self._conn.connection.commit()
+
+    def close(self):
+        super().close()
+        if self._normalize_pool is not None:
+            self._normalize_pool.close()
+            self._normalize_pool = None
     
     @staticmethod
     def create_db(
@@ -340,47 +807,36 @@ class PostgresBackend(BaseBackendWithQueue):
         return (isinstance(self._conn, Connection) and self._conn.closed == 0)
     
     def add_channel(self, dialog: Dialog|Chat|ChatPreview|List[Dialog|Chat|ChatPreview]):
-        dialog_list: List[Dialog|Chat|ChatPreview] = []
-        if isinstance(dialog, (Dialog, Chat, ChatPreview)):
-            dialog_list.append(dialog)
-        elif isinstance(dialog, list):
-            dialog_list = dialog
-        else:
-            raise ValueError(f"Incorrect dialog type: {type(dialog)}")
-        dialog_query_list = []
-        for dialog in dialog_list:
-            if isinstance(dialog, Dialog):
-                chat: Chat = dialog.chat
-                d = compose_insert_chat_dict_query(clean_dict(chat))
-            elif isinstance(dialog, Chat):
-                chat: Chat = dialog
-                d = compose_insert_chat_dict_query(clean_dict(chat))
-            elif isinstance(dialog, ChatPreview):
-                chat: ChatPreview = dialog
-                d = compose_insert_chat_dict_query(clean_dict(chat))
-            else:
-                raise ValueError(f"Incorrect dialog type: {type(dialog)}")
-            dialog_query_list.append(d)
+        dialog_query_list = compose_insert_dialog_queries(dialog)
         with Session(self._engine) as sess:
             upsert(sess, models.Chats, dialog_query_list)
             sess.flush()
             sess.commit()
     
-    def set_top_message_id_to_db_max(self, channel_id: int):
-        self.add_message(lambda: self._set_top_message_id_to_db_max(channel_id))
+    def set_top_message_id_to_db_max(self, channel_id: int, at_most: Optional[int] = None):
+        """
+        Once the messages queued so far are committed, announces everything stored up to at_most as contiguous.
+        at_most should be the top of the range the caller fetched - other writers may have stored newer messages
+        """
+        self.add_message(lambda: self._set_top_message_id_to_db_max(channel_id, at_most))
     
-    def _set_top_message_id_to_db_max(self, channel_id: int):
+    def _set_top_message_id_to_db_max(self, channel_id: int, at_most: Optional[int] = None):
         #logging.info(f"Waiting for queue to flush once before setting {channel_id} top_message_id to max")
         #await self.wait_for_queue_flush_batch()
+        with self._known_chats_lock:
+            if channel_id in self._failed_chats:
+                logging.error(f"Not setting {channel_id} top_message_id: a batch of it was lost, its fetch shards are kept for a refetch")
+                return
         with Session(self._engine) as sess:
-            stmt = (
-                select(func.max(models.Messages.message_id))
-                .where(models.Messages.chat_id == channel_id)
-            )
-            top_message_id = sess.execute(stmt).scalar()
+            top_message_id = sess.execute(select_max_message_id(channel_id)).scalar() # committed with the batches before us
             if top_message_id is None:
                 return
-        self.set_top_message_id(channel_id, top_message_id, skip_check=True)
+            if at_most is not None:
+                top_message_id = min(top_message_id, at_most)
+            sess.execute(upsert_top_message_id(channel_id, top_message_id, only_increase=True))
+            sess.execute(reset_ongoing_watermark(channel_id, top_message_id))
+            sess.execute(delete_fetch_shards(channel_id, top_message_id))
+            sess.commit()
     
     def set_top_message_id(self, channel_id: int, top_message_id: int, skip_check: bool = False):
         """
@@ -400,17 +856,80 @@ class PostgresBackend(BaseBackendWithQueue):
                     row = rows[0]
                     raise RuntimeError(f"Cannot set top_message_id to {top_message_id} for chat {channel_id}: there are messages with message_id > {top_message_id}, such as {row.message_id}")
             # now we can insert
-            sess.execute(
-                insert(models.Chats)
-                .values(dict(chat_id=channel_id, top_message_id=top_message_id))
-                .on_conflict_do_update(
-                    index_elements=["chat_id"],
-                    set_=dict(top_message_id=top_message_id)
-                )
-            )
+            sess.execute(upsert_top_message_id(channel_id, top_message_id))
+            sess.execute(reset_ongoing_watermark(channel_id, top_message_id))
+            sess.execute(delete_fetch_shards(channel_id, top_message_id))
             sess.flush()
             sess.commit()
 
+    def get_fetch_shards(self) -> Dict[int, List[FetchShard]]:
+        d = defaultdict(list)
+        with Session(self._engine) as sess:
+            for row in sess.execute(select_fetch_shards()).fetchall():
+                d[row[0]].append(FetchShard(*row))
+        return dict(d)
+
+    def add_fetch_shards(self, shards: List[FetchShard]):
+        if not shards:
+            return
+        with Session(self._engine) as sess:
+            sess.execute(insert_fetch_shards(shards))
+            sess.commit()
+
+    def checkpoint_fetch_shard(self, chat_id: int, min_id: int, offset_id: int, *, done: bool = False, session: Optional[str] = None):
+        """
+        Queued after the messages it covers and committed together with the last of them
+        """
+        self.add_message(FetchCheckpoint(chat_id, min_id, offset_id, done, session))
+
+    def get_engagement_due(self, stages: List[datetime.timedelta], *, grace: datetime.timedelta, limit: int, exclude_chats: Iterable[int] = ()) -> List[Tuple[int, int, int]]:
+        with Session(self._engine) as sess:
+            stmt = select_engagement_due(stages, now=datetime.datetime.now(), grace=grace, limit=limit, exclude_chats=exclude_chats)
+            return [tuple(row) for row in sess.execute(stmt).fetchall()]
+
+    def update_engagement(self, messages: List[Message], stages: Dict[Tuple[int, int], int]) -> int:
+        """
+        Writes the counters of refetched messages and a sample of them, bypassing the message queue.
+        stages[(chat_id, message_id)] is the refresh stage the message was fetched for. Keys without a message
+        (deleted, or the chat became unreachable) get a sample without counters, so they aren't due again
+        """
+        sampled_at = datetime.datetime.now()
+        items_counters, items_reactions, items_polls, items_samples = [], [], [], []
+        for message in messages:
+            extracted = extract_engagement(message, raw_emoji)
+            if not extracted:
+                continue
+            counters, reactions, polls = extracted
+            stage = stages.get((counters["chat_id"], counters["message_id"]), None)
+            if stage is None:
+                continue
+            items_counters.append(counters)
+            items_reactions += reactions
+            items_polls += polls
+            items_samples.append(dict(
+                counters,
+                sampled_at=sampled_at,
+                stage=stage,
+            ))
+        sampled = {(r["chat_id"], r["message_id"]) for r in items_samples}
+        for (chat_id, message_id), stage in stages.items():
+            if (chat_id, message_id) not in sampled:
+                items_samples.append(dict(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    views=None,
+                    forwards=None,
+                    reactions_vote_count=None,
+                    poll_vote_count=None,
+                    sampled_at=sampled_at,
+                    stage=stage,
+                ))
+        EmojiMap.resolve_rows(items_reactions)
+        with Session(self._engine) as sess:
+            n = write_engagement_items(sess, items_counters, items_reactions, items_polls, items_samples)
+            sess.commit()
+        return n
+
     def set_ongoing_write(self, channel_id: int, ongoing_write: bool):
         with Session(self._engine) as sess:
             sess.execute(
@@ -426,47 +945,14 @@ class PostgresBackend(BaseBackendWithQueue):
 
     def get_offsets_from_ongoing_writes_reactions(self) -> Dict[int, Optional[int]]:
         with Session(self._engine) as sess:
-            stmt = (
-                select(
-                    models.Chats.chat_id, 
-                    select(func.min(models.Reactions.message_id))
-                        .where(models.Reactions.chat_id == models.Chats.chat_id)
-                        .where(
-                            (models.Chats.top_message_id.is_(None))
-                            | (models.Reactions.message_id > models.Chats.top_message_id)
-                        )
-                        .label("min_message_id")
-                )
-                .select_from(models.Chats)
-                # ongoing_write is just an indicator - not actually necessary for correctness
-                # was originally here for performance, but turns out it's not necessary for that either
-                #.where(models.Chats.ongoing_write == True)
-            )
-            rows = {row[0]: row[1] for row in sess.execute(stmt).fetchall() if row[1] is not None}
+            rows = {row[0]: row[1] for row in sess.execute(select_offsets_from_ongoing_writes(models.Reactions)).fetchall() if row[1] is not None}
         return rows
 
     def get_offsets_from_ongoing_writes(self) -> Dict[int, Optional[int]]:
         with Session(self._engine) as sess:
-            stmt = (
-                select(
-                    models.Chats.chat_id, 
-                    select(func.min(models.Messages.message_id))
-                        .where(models.Messages.chat_id == models.Chats.chat_id)
-                        .where(
-                            (models.Chats.top_message_id.is_(None))
-                            | (models.Messages.message_id > models.Chats.top_message_id)
-                        )
-                        .label("min_message_id")
-                )
-                .select_from(models.Chats)
-                # ongoing_write is just an indicator - not actually necessary for correctness
-                # was originally here for performance, but turns out it's not necessary for that either
-                #.where(models.Chats.ongoing_write == True)
-            )
-            rows = {row[0]: row[1] for row in sess.execute(stmt).fetchall() if row[1] is not None}
+            rows = {row[0]: row[1] for row in sess.execute(select_offsets_from_watermarks()).fetchall()}
         return rows
 
-    
     def delete_messages(self, channel_id: int, id_min: int, id_max: int):
         assert id_min <= id_max
         with self.lock:
@@ -474,7 +960,8 @@ class PostgresBackend(BaseBackendWithQueue):
             cur.execute(f"DELETE FROM {TableNames.POLLS} WHERE chat_id = %s AND message_id >= %s AND message_id <= %s", (channel_id, id_min, id_max))
             cur.execute(f"DELETE FROM {TableNames.REACTIONS} WHERE chat_id = %s AND message_id >= %s AND message_id <= %s", (channel_id, id_min, id_max))
             cur.execute(f"DELETE FROM {TableNames.MESSAGES} WHERE chat_id = %s AND message_id >= %s AND message_id <= %s", (channel_id, id_min, id_max))
-            self._commit()
+            self._conn.execute(rebuild_watermark(channel_id))
+            self._conn.commit() # same DBAPI connection as cur, so this commits the deletes too
             cur.close()
 
     def delete_channel(self, channel_id: int):
@@ -485,28 +972,24 @@ class PostgresBackend(BaseBackendWithQueue):
             cur.execute(f"DELETE FROM {TableNames.REACTIONS} WHERE chat_id = %s", (channel_id,))
             cur.execute(f"DELETE FROM {TableNames.MESSAGES} WHERE chat_id = %s", (channel_id,))
             cur.execute(f"DELETE FROM {TableNames.CHATS} WHERE chat_id = %s", (channel_id,))
+            cur.execute(f"DELETE FROM {TableNames.WATERMARKS} WHERE chat_id = %s", (channel_id,))
+            cur.execute(f"DELETE FROM {TableNames.SHARDS} WHERE chat_id = %s", (channel_id,))
+            cur.execute(f"DELETE FROM {TableNames.ENGAGEMENT} WHERE chat_id = %s", (channel_id,))
+            cur.execute(f"DELETE FROM {TableNames.ENGAGEMENT_SERIES} WHERE chat_id = %s", (channel_id,))
+            cur.execute(f"DELETE FROM {TableNames.HYPE} WHERE chat_id = %s", (channel_id,))
             self._commit()
             cur.close()
 
     def get_stored_dialogs(self) -> Dict[int, StoredDialog]:
-        cur = self._conn.connection.cursor()
-        cur.execute(f"""
-                    SELECT {TableNames.CHATS}.chat_id, {TableNames.CHATS}.title, subquery.max_message_id
-                    FROM (
-                        SELECT chat_id, MAX(message_id) AS max_message_id FROM {TableNames.MESSAGES} GROUP BY chat_id
-                    ) AS subquery
-                    LEFT JOIN {TableNames.CHATS} ON subquery.chat_id = chats.chat_id
-                    """)
         d = dict()
-        for row in cur.fetchall():
-            if row[0] is None:
-                continue
-            d[row[0]] = StoredDialog(title=row[1], max_id=row[2])
-            assert d[row[0]].max_id is not None
-        cur.close()
+        with Session(self._engine) as sess:
+            for row in sess.execute(select_stored_dialogs()).fetchall():
+                d[row[0]] = StoredDialog(title=row[1], max_id=row[2])
         self._stored_dialogs = d
         with Session(self._engine) as sess:
-            self._known_chats |= {c.sender_id for c in sess.query(models.Users.chat_id).all()}
+            known_users = {c.sender_id for c in sess.query(models.Users.chat_id).all()}
+        with self._known_chats_lock:
+            self._known_chats |= known_users
         return d
     
     def get_chats_with_reactions_bak(self) -> Set[int]:
@@ -528,7 +1011,8 @@ class PostgresBackend(BaseBackendWithQueue):
             #assert d[row[0]].max_id is not None
         cur.close()
         self._stored_dialogs = d
-        self._known_chats |= set(d.keys())
+        with self._known_chats_lock:
+            self._known_chats |= set(d.keys())
         return d
 
     def find_channel(self, search_str: str) -> List[Dict[str, Any]]:
@@ -539,11 +1023,8 @@ class PostgresBackend(BaseBackendWithQueue):
         return dialogs
 
     def count_messages(self) -> Tuple[int, datetime.datetime]:
-        cur = self._conn.connection.cursor()
-        cur.execute(f"SELECT COUNT(*), MAX(date) FROM {TableNames.MESSAGES}")
-        res = cur.fetchone()
-        cur.close()
-        n, maxdate = res[0], res[1]
+        with Session(self._engine) as sess:
+            n, maxdate = sess.execute(select_message_count()).first()
         return n, maxdate
     
     @property
@@ -590,41 +1071,43 @@ class PostgresBackend(BaseBackendWithQueue):
     def add_messages(self, messages: Iterable[Message|Callable]):
         if not messages:
             return
-        callables = [m for m in messages if not isinstance(m, Message)] # can use callable() too I guess
-        messages = [m for m in messages if isinstance(m, Message)]
-        items_messages, items_reactions, items_polls, items_chats, items_users = [], [], [], [], []
-        for i in range(len(messages)):
-            normalized = compose_insert_message_query(messages[i])
-            if not normalized:
-                continue
-            items_messages_add, items_reactions_add, items_polls_add, items_chats_add, items_users_add = normalized
-            items_messages += items_messages_add
-            items_reactions += items_reactions_add
-            items_polls += items_polls_add
-            items_chats += items_chats_add
-            items_users += items_users_add
-        items_chats_dict = aggregate_chat_dict_queries("chat_id", items_chats, self._known_chats)
-        items_users_dict = aggregate_chat_dict_queries("sender_id", items_users, self._known_chats)
-        logging.info(f"items_chats_dict: {len(items_chats)}->{len(items_chats_dict)}, items_users_dict: {len(items_users)}->{len(items_users_dict)}")
-        new_chats = set(items_chats_dict.keys()) | set(items_users_dict.keys())
-        update_count_messages, update_count_reactions, update_count_polls, update_count_chats = 0, 0, 0, 0
+        prepared = self.prepare_messages(messages)
+        self.write_prepared_messages(prepared)
+        for c in prepared.callables:
+            c()
+
+    def prepare_messages(self, messages: List[Message|Callable]) -> PreparedBatch:
+        with self._known_chats_lock:
+            known_chats = set(self._known_chats)
+        return prepare_message_batch(messages, known_chats, self._normalize_pool)
+
+    def batch_failed(self, messages: List[Message|Callable]):
+        with self._known_chats_lock:
+            self._failed_chats |= batch_chat_ids(messages)
+
+    def write_prepared_messages(self, prepared: PreparedBatch):
+        new_chats = {c["chat_id"] for c in prepared.items_chats} | {u["sender_id"] for u in prepared.items_users}
+        with self._known_chats_lock:
+            checkpoints = drop_failed_checkpoints(prepared.checkpoints, self._failed_chats)
         with Session(self._engine) as sess:
-            if items_messages:
-                update_count_messages += upsert(sess, models.Messages, items_messages).rowcount
-            if items_reactions:
-                update_count_reactions += upsert(sess, models.Reactions, items_reactions).rowcount
-            if items_polls:
-                update_count_polls += upsert(sess, models.Polls, items_polls).rowcount
-            if items_chats_dict:
-                update_count_chats += upsert(sess, models.Chats, list(items_chats_dict.values())).rowcount
-            if items_users_dict:
-                update_count_chats += upsert(sess, models.Users, list(items_users_dict.values())).rowcount
+            update_count_messages, update_count_reactions, update_count_polls, update_count_chats = write_message_items(
+                sess,
+                prepared.items_messages,
+                prepared.items_reactions,
+                prepared.items_polls,
+                prepared.items_chats,
+                prepared.items_users,
+                checkpoints=checkpoints,
+                copy=self._copy_ingest,
+            )
             sess.flush()
-            sess.commit()
+            with COMMIT_SECONDS.labels(backend="PostgresBackend").time():
+                sess.commit()
         update_count = update_count_messages + update_count_reactions + update_count_polls + update_count_chats
-        self._known_chats |= new_chats
+        with self._known_chats_lock:
+            self._known_chats |= new_chats
         if update_count:
             logging.info(f"Inserted {update_count} items, of which: {update_count_messages} messages, {update_count_reactions} reactions, {update_count_polls} polls, {update_count_chats} chats")
-        for c in callables:
-            c()
-        logging.info(f"Called {len(callables)} callables")
+
+    def prepared_callables(self, prepared: PreparedBatch) -> List[Callable]:
+        return prepared.callables
@@ -0,0 +1,308 @@
+from typing import Dict, List, Any, Iterable, Callable, Tuple, Optional
+from collections import namedtuple
+import datetime
+import struct
+import io
+import numpy as np
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+COPY_NULL = struct.pack("!i", -1)
+
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_TZ = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+_int8 = struct.Struct("!iq")
+_int4 = struct.Struct("!ii")
+_int2 = struct.Struct("!ih")
+_float4 = struct.Struct("!if")
+_float8 = struct.Struct("!id")
+_length = struct.Struct("!i")
+
+def _encode_text(v) -> bytes:
+    b = str(v).encode("utf-8")
+    return _length.pack(len(b)) + b
+
+
+def _encode_bool(v) -> bytes:
+    return b"\x00\x00\x00\x01\x01" if v else b"\x00\x00\x00\x01\x00"
+
+
+def _encode_timestamp(v: datetime.datetime) -> bytes:
+    if v.tzinfo is not None:
+        v = v.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return _int8.pack(8, (v - PG_EPOCH) // ONE_MICROSECOND)
+
+
+def _encode_timestamptz(v: datetime.datetime) -> bytes:
+    if v.tzinfo is None:
+        v = v.astimezone()
+    return _int8.pack(8, (v - PG_EPOCH_TZ) // ONE_MICROSECOND)
+
+
+def _encode_vector(v) -> bytes:
+    # pgvector's binary format: int16 dims, int16 unused, dims x float4
+    a = np.asarray(v, dtype=">f4")
+    return _length.pack(4 + 4 * len(a)) + struct.pack("!hh", len(a), 0) + a.tobytes()
+
+
+type_encoders: Dict[str, Callable[[Any], bytes]] = {
+    "int8": lambda v: _int8.pack(8, v),
+    "int4": lambda v: _int4.pack(4, v),
+    "int2": lambda v: _int2.pack(2, v),
+    "float4": lambda v: _float4.pack(4, v),
+    "float8": lambda v: _float8.pack(8, v),
+    "bool": _encode_bool,
+    "text": _encode_text,
+    "varchar": _encode_text,
+    "bpchar": _encode_text,
+    "timestamp": _encode_timestamp,
+    "timestamptz": _encode_timestamptz,
+    "vector": _encode_vector,
+}
+
+
+select_columns = text("""
+    SELECT a.attname, t.typname, t.typtype, a.attgenerated
+    FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+    WHERE a.attrelid = CAST(:table_name AS regclass) AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum
+""")
+
+_column_encoders: Dict[str, Dict[str, Callable[[Any], bytes]]] = dict() # table name -> column encoders, per process
+
+
+def column_encoders(table_name: str, rows: Iterable[Tuple[str, str, str, str]]) -> Dict[str, Callable[[Any], bytes]]:
+    """
+    Encoders of the writable columns of table_name, from its select_columns rows. GENERATED columns (e.g. has_text,
+    declared as a plain column in models.py) are left out
+    """
+    encoders = dict()
+    for column_name, type_name, type_type, generated in rows:
+        if generated:
+            continue
+        if type_type == "e": # enums are sent as their label
+            encoders[column_name] = _encode_text
+        elif type_name in type_encoders:
+            encoders[column_name] = type_encoders[type_name]
+        else:
+            raise NotImplementedError(f"No binary COPY encoder for {table_name}.{column_name} of type {type_name}")
+    return encoders
+
+
+def get_column_encoders(sess: Session, table_name: str) -> Dict[str, Callable[[Any], bytes]]:
+    """
+    Reads the actual column types of table_name from the catalog once per process, so the binary
+    encoding matches the server (e.g. REAL columns declared as Float in models.py)
+    """
+    if table_name not in _column_encoders:
+        _column_encoders[table_name] = column_encoders(table_name, sess.execute(select_columns, dict(table_name=table_name)).fetchall())
+    return _column_encoders[table_name]
+
+
+async def get_column_encoders_async(conn, table_name: str) -> Dict[str, Callable[[Any], bytes]]:
+    if table_name not in _column_encoders:
+        _column_encoders[table_name] = column_encoders(table_name, (await conn.execute(select_columns, dict(table_name=table_name))).fetchall())
+    return _column_encoders[table_name]
+
+
+def encode_copy_binary(rows: Iterable[Tuple], encoders: List[Callable[[Any], bytes]]) -> bytes:
+    field_count = struct.pack("!h", len(encoders))
+    parts = [COPY_HEADER]
+    append = parts.append
+    for row in rows:
+        append(field_count)
+        for encode, v in zip(encoders, row):
+            append(COPY_NULL if v is None else encode(v))
+    append(COPY_TRAILER)
+    return b"".join(parts)
+
+
+def merge_rows(rows: Iterable[Dict[str, Any]], primary_keys: List[str], *, coalesce: bool = True) -> Dict[Tuple, Dict[str, Any]]:
+    """
+    Collapses rows sharing a primary key the same way consecutive upserts would:
+    later non-null values win, nulls never overwrite (or, without coalesce, the later row wins as a whole)
+    """
+    d: Dict[Tuple, Dict[str, Any]] = dict()
+    for row in rows:
+        key = tuple(row[k] for k in primary_keys)
+        if key not in d or not coalesce:
+            d[key] = dict(row)
+            continue
+        merged = d[key]
+        for k, v in row.items():
+            if v is not None or k not in merged:
+                merged[k] = v
+    return d
+
+
+CopyPlan = namedtuple("CopyPlan", ["table_name", "staging", "columns", "primary_keys", "update_columns", "records"])
+
+
+def plan_copy_upsert(model, rows: List[Dict[str, Any]], writable: Iterable[str], *, coalesce: bool = True) -> CopyPlan:
+    table = model.__table__
+    primary_keys = [key.name for key in inspect(table).primary_key]
+    row_keys = set().union(*(row.keys() for row in rows))
+    writable = set(writable)
+    columns = [c.name for c in table.columns
+               if c.name in row_keys
+               and not c.computed
+               and c.name in writable]
+    update_columns = [c for c in columns if c not in primary_keys]
+    if not update_columns:
+        raise ValueError("copy_upsert resulted in an empty update list")
+    merged = merge_rows(rows, primary_keys, coalesce=coalesce)
+    return CopyPlan(
+        table_name=table.name,
+        staging=f"_staging_{table.name}",
+        columns=columns,
+        primary_keys=primary_keys,
+        update_columns=update_columns,
+        records=[tuple(row.get(c, None) for c in columns) for row in merged.values()],
+    )
+
+
+def create_staging_sql(plan: CopyPlan) -> List[str]:
+    return [
+        f"DROP TABLE IF EXISTS {plan.staging}",
+        f"CREATE TEMP TABLE {plan.staging} ON COMMIT DROP AS SELECT {', '.join(plan.columns)} FROM {plan.table_name} WITH NO DATA",
+    ]
+
+
+def merge_staging_sql(plan: CopyPlan, *, coalesce: bool = True) -> str:
+    columns_str = ", ".join(plan.columns)
+    primary_keys_str = ", ".join(plan.primary_keys)
+    if coalesce:
+        set_str = ", ".join([f"{c} = COALESCE(EXCLUDED.{c}, {plan.table_name}.{c})" for c in plan.update_columns])
+    else:
+        set_str = ", ".join([f"{c} = EXCLUDED.{c}" for c in plan.update_columns])
+    return f"""
+        INSERT INTO {plan.table_name} ({columns_str})
+        SELECT {columns_str} FROM {plan.staging} ORDER BY {primary_keys_str}
+        ON CONFLICT ({primary_keys_str}) DO UPDATE SET {set_str}
+    """
+
+
+def copy_upsert(sess: Session, model, rows: List[Dict[str, Any]], *, coalesce: bool = True) -> int:
+    """
+    Same semantics as common.utils.upsert, but streams the rows into a temp staging
+    table with binary COPY and merges them with a single INSERT ... SELECT ... ON CONFLICT.
+    With coalesce=False nulls overwrite too, for rows that are recomputed as a whole.
+    Runs inside the session's transaction - the caller commits.
+    """
+    if not rows:
+        return 0
+    encoders = get_column_encoders(sess, model.__table__.name)
+    plan = plan_copy_upsert(model, rows, encoders.keys(), coalesce=coalesce)
+    cur = sess.connection().connection.cursor()
+    try:
+        for stmt in create_staging_sql(plan):
+            cur.execute(stmt)
+        payload = encode_copy_binary(plan.records, [encoders[c] for c in plan.columns])
+        cur.copy_expert(f"COPY {plan.staging} ({', '.join(plan.columns)}) FROM STDIN WITH (FORMAT binary)", io.BytesIO(payload))
+        cur.execute(merge_staging_sql(plan, coalesce=coalesce))
+        rowcount = cur.rowcount
+        cur.execute(f"DROP TABLE {plan.staging}")
+    finally:
+        cur.close()
+    return rowcount
+
+
+async def copy_upsert_async(conn, model, rows: List[Dict[str, Any]], *, coalesce: bool = True) -> int:
+    """
+    copy_upsert for a sqlalchemy AsyncConnection on asyncpg, which speaks binary COPY natively
+    """
+    if not rows:
+        return 0
+    encoders = await get_column_encoders_async(conn, model.__table__.name)
+    plan = plan_copy_upsert(model, rows, encoders.keys(), coalesce=coalesce)
+    for stmt in create_staging_sql(plan):
+        await conn.exec_driver_sql(stmt)
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(plan.staging, records=plan.records, columns=plan.columns)
+    result = await conn.exec_driver_sql(merge_staging_sql(plan, coalesce=coalesce))
+    await conn.exec_driver_sql(f"DROP TABLE {plan.staging}")
+    return result.rowcount
+
+
+def vector_copy_dtype(dims: int) -> np.dtype:
+    """
+    One binary COPY row of (int8, int8, vector(dims)) - field lengths included - as a NumPy record
+    """
+    return np.dtype([
+        ("fields", ">i2"),
+        ("key0_length", ">i4"), ("key0", ">i8"),
+        ("key1_length", ">i4"), ("key1", ">i8"),
+        ("vector_length", ">i4"), ("dims", ">i2"), ("unused", ">i2"), ("vector", ">f4", (dims,)),
+    ])
+
+
+def encode_copy_vectors(keys: np.ndarray, embeddings: np.ndarray) -> bytes:
+    """
+    The binary COPY payload of rows (keys[i, 0], keys[i, 1], embeddings[i]), built with array assignments
+    instead of per-row encoders
+    """
+    n, dims = embeddings.shape
+    records = np.empty(n, dtype=vector_copy_dtype(dims))
+    records["fields"] = 3
+    records["key0_length"] = 8
+    records["key0"] = keys[:, 0]
+    records["key1_length"] = 8
+    records["key1"] = keys[:, 1]
+    records["vector_length"] = 4 + 4 * dims
+    records["dims"] = dims
+    records["unused"] = 0
+    records["vector"] = embeddings
+    return COPY_HEADER + records.tobytes() + COPY_TRAILER
+
+
+def last_per_key(keys: np.ndarray) -> np.ndarray:
+    """
+    Row indices keeping only the last row of every key, in key order - one INSERT ... ON CONFLICT
+    can't update the same row twice
+    """
+    reversed_keys = keys[::-1]
+    _, first = np.unique(reversed_keys, axis=0, return_index=True)
+    return len(keys) - 1 - first
+
+
+def copy_vectors(sess: Session, model, keys: np.ndarray, embeddings: np.ndarray) -> int:
+    """
+    Upserts the (n, dims) embeddings of model's vector column "embedding" for the (n, 2) primary keys
+    (chat_id, message_id or last_message_id): binary COPY into a temp staging table, then one INSERT ... ON CONFLICT.
+    Runs inside the session's transaction - the caller commits
+    """
+    if not len(keys):
+        return 0
+    table = model.__table__
+    dims = table.c.embedding.type.dim
+    keys = np.asarray(keys, dtype=np.int64).reshape(-1, 2)
+    embeddings = np.asarray(embeddings)
+    if embeddings.shape != (len(keys), dims):
+        raise ValueError(f"{table.name} takes {len(keys)} embeddings of {dims} dims, got shape {embeddings.shape}")
+    primary_keys = [key.name for key in inspect(table).primary_key]
+    plan = CopyPlan(
+        table_name=table.name,
+        staging=f"_staging_{table.name}",
+        columns=primary_keys + ["embedding"],
+        primary_keys=primary_keys,
+        update_columns=["embedding"],
+        records=None,
+    )
+    keep = last_per_key(keys)
+    payload = encode_copy_vectors(keys[keep], embeddings[keep])
+    cur = sess.connection().connection.cursor()
+    try:
+        for stmt in create_staging_sql(plan):
+            cur.execute(stmt)
+        cur.copy_expert(f"COPY {plan.staging} ({', '.join(plan.columns)}) FROM STDIN WITH (FORMAT binary)", io.BytesIO(payload))
+        cur.execute(merge_staging_sql(plan))
+        rowcount = cur.rowcount
+        cur.execute(f"DROP TABLE {plan.staging}")
+    finally:
+        cur.close()
+    return rowcount
@@ -0,0 +1,175 @@
+"""
+Approximate nearest neighbour search over the embedding columns (pgvector HNSW, cosine distance).
+
+HNSW rather than IVFFlat: it needs no training pass over the rows already there, so the embedders keep inserting
+into indexed tables without the lists drifting away from the data and needing a rebuild.
+HNSW takes vector columns of at most 2000 dimensions - the 3072-dim chain embeddings are indexed as a halfvec
+expression, and queries on that source compare embedding::halfvec(3072) so the planner can use it.
+
+Partitioned tables are built one partition at a time: CREATE INDEX CONCURRENTLY on every partition, then attached
+to an index created ON ONLY the parent. Writers are never blocked, and an interrupted build resumes from the
+partitions still missing.
+
+nearest() adds the filters of /search (chats, dates, sender hype) to the ANN scan. search() runs it with
+pgvector's iterative index scans, so the scan goes on until limit rows pass the filters instead of filtering
+ef_search candidates down to fewer than limit.
+"""
+from typing import Optional, Iterable, Union, List
+from collections import namedtuple
+import datetime
+import logging
+import os
+import time
+from sqlalchemy import Engine, Connection, Select, select, and_, text, cast
+from sqlalchemy.orm import Session
+from pgvector.sqlalchemy import HALFVEC
+import common.backend.models as models
+
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+EF_SEARCH = int(os.environ.get("VECTOR_EF_SEARCH", 100))
+ITERATIVE_SCAN = os.environ.get("VECTOR_ITERATIVE_SCAN", "strict_order") # "off" for pgvector before 0.8
+BUILD_MEMORY = os.environ.get("VECTOR_BUILD_MEMORY", "2GB") # maintenance_work_mem, the graph should fit in it
+
+VectorSource = namedtuple("VectorSource", ["table", "model", "message_id", "halfvec_dims"])
+SOURCES = {
+    "messages": VectorSource("messages", models.Messages, models.Messages.message_id, None),
+    "message_embeddings": VectorSource("message_embeddings", models.MessageEmbeddings, models.MessageEmbeddings.message_id, None),
+    "message_chain_embeddings_hegemmav2": VectorSource(
+        "message_chain_embeddings_hegemmav2", models.MessageChainEmbeddingsHegemmav2,
+        models.MessageChainEmbeddingsHegemmav2.last_message_id, 3072,
+    ),
+}
+
+
+def index_name(table: str) -> str:
+    return f"idx_{table}_embedding_hnsw"
+
+
+def create_index(source: VectorSource, table: str, *, only: bool = False, concurrently: bool = False) -> str:
+    if source.halfvec_dims:
+        column = f"(embedding::halfvec({source.halfvec_dims})) halfvec_cosine_ops"
+    else:
+        column = "embedding vector_cosine_ops"
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name(table)} "
+        f"ON {'ONLY ' if only else ''}{table} USING hnsw ({column}) "
+        f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    )
+
+
+def select_partitions() -> str:
+    return """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+        ORDER BY c.relname
+    """
+
+
+def index_valid(conn: Connection, name: str) -> Optional[bool]:
+    """
+    None if the index does not exist. False if it does but can't be used - an interrupted concurrent build,
+    or a parent index with partitions not attached yet
+    """
+    return conn.execute(text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), dict(name=name)).scalar()
+
+
+def build_concurrently(conn: Connection, source: VectorSource, table: str):
+    if index_valid(conn, index_name(table)) is False:
+        logging.info(f"Dropping the interrupted build of {index_name(table)}")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {index_name(table)}"))
+    t_start = time.time()
+    conn.execute(text(create_index(source, table, concurrently=True)))
+    logging.info(f"Indexed {table} in {time.time() - t_start:.1f}s")
+
+
+def build_indexes(engine: Engine, sources: Optional[Iterable[str]] = None, *, workers: int = 2):
+    """
+    Creates the missing HNSW indexes of sources (default all) without blocking writers
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"SET maintenance_work_mem = '{BUILD_MEMORY}'"))
+        conn.execute(text(f"SET max_parallel_maintenance_workers = {int(workers)}"))
+        for name in sources or SOURCES:
+            source = SOURCES[name]
+            if index_valid(conn, index_name(source.table)):
+                logging.info(f"{index_name(source.table)} is already built")
+                continue
+            partitions = [r[0] for r in conn.execute(text(select_partitions()), dict(table=source.table))]
+            if not partitions:
+                build_concurrently(conn, source, source.table)
+                continue
+            conn.execute(text(create_index(source, source.table, only=True)))
+            for i, partition in enumerate(partitions):
+                logging.info(f"Indexing partition {i+1}/{len(partitions)} of {source.table}")
+                build_concurrently(conn, source, partition)
+                conn.execute(text(f"ALTER INDEX {index_name(source.table)} ATTACH PARTITION {index_name(partition)}"))
+            logging.info(f"{index_name(source.table)} is built: {index_valid(conn, index_name(source.table))}")
+
+
+def distance_to(source: VectorSource, embedding):
+    column = source.model.embedding
+    if source.halfvec_dims:
+        column = cast(column, HALFVEC(source.halfvec_dims))
+    return column.cosine_distance(embedding)
+
+
+def nearest(
+    source: str,
+    embedding,
+    *,
+    limit: int = 10,
+    chat_ids: Optional[Union[Iterable[int], Select]] = None,
+    after: Optional[datetime.datetime] = None,
+    before: Optional[datetime.datetime] = None,
+    min_sender_z: Optional[float] = None,
+) -> Select:
+    """
+    The limit messages of source nearest to embedding, as (chat_id, message_id, date, distance).
+    chat_ids may be a subquery. min_sender_z keeps messages scored at least that far above their sender's
+    average (message_hype) - messages not scored yet are left out
+    """
+    src = SOURCES[source]
+    distance = distance_to(src, embedding)
+    message_id = src.message_id
+    query = select(src.model.chat_id, message_id.label("message_id"), models.Messages.date, distance.label("distance"))
+    if src.model is not models.Messages:
+        query = query.join(models.Messages, and_(models.Messages.chat_id == src.model.chat_id, models.Messages.message_id == message_id))
+    if chat_ids is not None:
+        query = query.where(src.model.chat_id.in_(chat_ids if isinstance(chat_ids, Select) else list(chat_ids)))
+    if after is not None:
+        query = query.where(models.Messages.date >= after)
+    if before is not None:
+        query = query.where(models.Messages.date < before)
+    if min_sender_z is not None:
+        query = query.join(models.MessageHype, and_(models.MessageHype.chat_id == src.model.chat_id, models.MessageHype.message_id == message_id))
+        query = query.where(models.MessageHype.sender_z >= min_sender_z)
+    return query.where(src.model.embedding.is_not(None)).order_by(distance).limit(limit)
+
+
+def search(conn: Union[Session, Connection], query: Select, *, ef_search: int = EF_SEARCH, exact: bool = False) -> List:
+    """
+    Runs a nearest() query. The settings only last for the current transaction.
+    exact=True scans without the index - the ground truth for recall
+    """
+    conn.execute(text("SELECT set_config('hnsw.ef_search', :v, true)"), dict(v=str(ef_search)))
+    if ITERATIVE_SCAN != "off":
+        conn.execute(text("SELECT set_config('hnsw.iterative_scan', :v, true)"), dict(v=ITERATIVE_SCAN))
+    if exact:
+        conn.execute(text("SELECT set_config('enable_indexscan', 'off', true)"))
+    return conn.execute(query).fetchall()
+
+
+def closest_to_event(conn: Union[Session, Connection], event: models.DetectedEvents, l: int = 5) -> List:
+    """
+    The l messages nearest to the centroid of a detected event, among the messages of its chats in its time span.
+    For summarizing the event
+    """
+    query = nearest(
+        event.source, event.centroid, limit=l,
+        chat_ids=set(event.chat_ids), after=event.first_at, before=event.last_at + datetime.timedelta(seconds=1),
+    )
+    return search(conn, query)
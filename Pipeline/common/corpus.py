@@ -0,0 +1,126 @@
+"""
+Recorded pyrogram messages for offline benchmarks (scripts/replay_ingest.py, scripts/bench_normalize.py).
+A corpus file is a gzip stream of pickled message chunks (see normalize.dump_messages - the Client
+is not stored), so it can be appended to while recording and streamed while loading.
+"""
+from typing import List, Dict, Iterator, Iterable
+import logging
+import gzip
+import struct
+from pyrogram import Client
+from pyrogram.enums import MessagesFilter
+from pyrogram.types import Message
+from common.backend.normalize import dump_messages, load_messages
+
+
+CHUNK_SIZE = 1000
+_chunk_length = struct.Struct("!I")
+
+# synthetic chat ids for replays, far away from real telegram ids (same range as scripts/bench_ingest.py)
+REPLAY_CHAT_ID_BASE = -7_000_000_000_000
+
+
+class CorpusWriter:
+    def __init__(self, path: str):
+        self._f = gzip.open(path, "wb")
+        self._buffer: List[Message] = []
+        self.count = 0
+
+    def __enter__(self) -> "CorpusWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, message: Message):
+        self._buffer.append(message)
+        self.count += 1
+        if len(self._buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        payload = dump_messages(self._buffer)
+        self._f.write(_chunk_length.pack(len(payload)))
+        self._f.write(payload)
+        self._buffer = []
+
+    def close(self):
+        if self._f is None:
+            return
+        self.flush()
+        self._f.close()
+        self._f = None
+
+
+def read_corpus(path: str) -> Iterator[Message]:
+    with gzip.open(path, "rb") as f:
+        while True:
+            header = f.read(_chunk_length.size)
+            if not header:
+                return
+            (length,) = _chunk_length.unpack(header)
+            yield from load_messages(f.read(length))
+
+
+def load_corpus(paths: str|Iterable[str]) -> List[Message]:
+    if isinstance(paths, str):
+        paths = [paths]
+    return [m for path in paths for m in read_corpus(path)]
+
+
+def describe_corpus(messages: Iterable[Message]) -> Dict[str, int]:
+    d = dict(messages=0, chats=0, reactions=0, polls=0, media=0, text=0, replies=0, forwards=0)
+    chats = set()
+    for m in messages:
+        d["messages"] += 1
+        chats.add(m.chat.id if m.chat else None)
+        d["reactions"] += int(m.reactions is not None)
+        d["polls"] += int(m.poll is not None)
+        d["media"] += int(m.media is not None)
+        d["text"] += int(bool(m.text or m.caption))
+        d["replies"] += int(m.reply_to_message_id is not None)
+        d["forwards"] += int(getattr(m, "forward_from_chat", None) is not None or getattr(m, "forward_from", None) is not None)
+    d["chats"] = len(chats)
+    return d
+
+
+async def record_chat(app: Client, writer: CorpusWriter, chat_id: int, *, limit: int, polls: int = 0, media: int = 0) -> int:
+    """
+    Records the latest `limit` messages of chat_id, plus up to `polls` poll and `media` photo/video
+    messages found through search, so the corpus covers them even in text-heavy chats
+    """
+    seen = set()
+    async def add(messages):
+        async for m in messages:
+            if m.id in seen:
+                continue
+            seen.add(m.id)
+            writer.write(m)
+    await add(app.get_chat_history(chat_id, limit=limit))
+    if polls:
+        await add(app.search_messages(chat_id, filter=MessagesFilter.POLL, limit=polls))
+    if media:
+        await add(app.search_messages(chat_id, filter=MessagesFilter.PHOTO_VIDEO, limit=media))
+    logging.info(f"Recorded {len(seen)} messages from {chat_id}")
+    return len(seen)
+
+
+def remap_chats(messages: List[Message], base: int = REPLAY_CHAT_ID_BASE) -> Dict[int, int]:
+    """
+    Moves the messages into synthetic chats so a replay never touches the rows of real ones.
+    Returns {original chat_id: synthetic chat_id}
+    """
+    mapping: Dict[int, int] = dict()
+    remapped = set() # unpickled messages of a chunk share their Chat objects - move each object once
+    for m in messages:
+        for chat in (m.chat, m.sender_chat):
+            if chat is None or id(chat) in remapped:
+                continue
+            if chat is m.chat and chat.id not in mapping:
+                mapping[chat.id] = base - len(mapping)
+            if chat.id in mapping: # sender_chat only if it is a chat of the corpus (channel posts)
+                chat.id = mapping[chat.id]
+                remapped.add(id(chat))
+    return mapping
@@ -0,0 +1,67 @@
+"""
+Wire format between MessageEmbed (DEALER) and EmbedQueue (ROUTER).
+
+A batch of embeddings is one multipart message of three frames:
+    header      HEADER: version, dtype code, dims, count, sequence number
+    keys        count x 2 int64 (chat_id, message_id), little-endian
+    embeddings  count x dims float32 or float16, little-endian, C-contiguous - sent without copying
+EmbedQueue answers every batch with one ACK frame (sequence number, status) once it is written - or failed to be.
+
+Flow control is by credits: a sender keeps at most ZMQ_CREDITS batches unacknowledged, so a slow DB writer
+holds back the sender thread and never the model, and an acked batch is known to be in the DB.
+"""
+from typing import List, Tuple
+from collections import namedtuple
+import struct
+import numpy as np
+
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("<BBIIQ") # version, dtype, dims, count, seq
+ACK = struct.Struct("<QB") # seq, status
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+DTYPE_CODES = {np.dtype(v): k for k, v in DTYPES.items()}
+KEYS_DTYPE = np.dtype("<i8")
+
+ACK_STORED = 0
+ACK_FAILED = 1
+
+Batch = namedtuple("Batch", ["seq", "keys", "embeddings"]) # keys: (n, 2) int64, embeddings: (n, dims)
+
+
+def encode_batch(seq: int, chat_ids: List[int], message_ids: List[int], embeddings, dtype=np.float32) -> List:
+    """
+    The frames of a batch. The embeddings frame is a memoryview over one contiguous array
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    array = np.ascontiguousarray(np.asarray(embeddings, dtype=dtype))
+    if array.ndim != 2 or array.shape[0] != len(chat_ids) or len(chat_ids) != len(message_ids):
+        raise ValueError(f"Batch of {len(chat_ids)} chat ids, {len(message_ids)} message ids and embeddings of shape {array.shape}")
+    keys = np.empty((len(chat_ids), 2), dtype=KEYS_DTYPE)
+    keys[:, 0] = chat_ids
+    keys[:, 1] = message_ids
+    header = HEADER.pack(PROTOCOL_VERSION, DTYPE_CODES[dtype], array.shape[1], array.shape[0], seq)
+    return [header, keys.data, array.data]
+
+
+def decode_batch(frames: List) -> Batch:
+    """
+    Inverse of encode_batch. The arrays are views over the received frames, not copies
+    """
+    if len(frames) != 3:
+        raise ValueError(f"Batch of {len(frames)} frames")
+    header, keys, embeddings = frames
+    version, dtype, dims, n, seq = HEADER.unpack(bytes(header))
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Protocol version {version}, expected {PROTOCOL_VERSION}")
+    keys = np.frombuffer(keys, dtype=KEYS_DTYPE).reshape(n, 2)
+    embeddings = np.frombuffer(embeddings, dtype=DTYPES[dtype]).reshape(n, dims)
+    return Batch(seq, keys, embeddings)
+
+
+def encode_ack(seq: int, status: int) -> bytes:
+    return ACK.pack(seq, status)
+
+
+def decode_ack(frame) -> Tuple[int, int]:
+    return ACK.unpack(bytes(frame))
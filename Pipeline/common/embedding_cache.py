@@ -0,0 +1,132 @@
+"""
+Content-addressed cache of embeddings, so the same text is never embedded twice by the same model.
+
+Forwarded posts, reposted news and the shared prefixes of message_chain.chain repeat the same texts over and over.
+A text is keyed by its model and the hash of its normalized form (NFKC, whitespace collapsed). Lookups go to an
+in-process LRU first and then, in one query per batch, to the embedding_cache table; only what's left reaches the
+model, and duplicates within a batch are embedded once.
+
+Hits are counted per tier, and the model time they saved is estimated from the measured seconds per embedded text.
+"""
+from typing import List, Callable, Optional, Dict, Sequence
+from collections import OrderedDict
+import datetime
+import hashlib
+import logging
+import os
+import re
+import time
+import unicodedata
+import numpy as np
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+import common.backend.models as models
+from common.utils import create_postgres_engine
+from common import metrics
+
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 100000)) # embeddings kept in memory per process
+EMBEDDING_CACHE_TABLE = int(os.environ.get("EMBEDDING_CACHE_TABLE", 1)) # 0 = in-process LRU only
+LOG_EVERY = 10000 # lookups between hit rate log lines
+
+LOOKUPS = metrics.counter("telelog_embedding_cache_lookups_total", "Embedding cache lookups", ["model", "result"])
+SAVED_SECONDS = metrics.counter("telelog_embedding_cache_saved_seconds_total", "Estimated model time saved by cache hits", ["model"])
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _whitespace.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, *, engine: Optional[Engine] = None, size: int = EMBEDDING_CACHE_SIZE, table: bool = bool(EMBEDDING_CACHE_TABLE)):
+        self.model_name = model_name
+        self.size = size
+        self._engine = (engine or create_postgres_engine()) if table else None
+        self._lru: OrderedDict = OrderedDict()
+        self._seconds_per_text: Optional[float] = None # measured on misses
+        self.hits, self.misses = 0, 0
+
+    def _remember(self, key: bytes, embedding: np.ndarray):
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def _load(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        if not keys or self._engine is None:
+            return dict()
+        table = models.EmbeddingCache
+        with Session(self._engine) as sess:
+            rows = sess.execute(
+                select(table.text_hash, table.embedding)
+                .where(table.model == self.model_name)
+                .where(table.text_hash.in_(keys))
+            ).fetchall()
+        return {bytes(key): np.asarray(embedding, dtype=np.float32) for key, embedding in rows}
+
+    def _store(self, embeddings: Dict[bytes, np.ndarray]):
+        if not embeddings or self._engine is None:
+            return
+        now = datetime.datetime.now()
+        rows = [dict(model=self.model_name, text_hash=key, embedding=embedding, created_at=now) for key, embedding in embeddings.items()]
+        with Session(self._engine) as sess:
+            sess.execute(insert(models.EmbeddingCache).on_conflict_do_nothing(index_elements=["model", "text_hash"]), rows)
+            sess.commit()
+
+    def embed(self, texts: Sequence[str], embed_fn: Callable[[List[str]], Sequence[np.ndarray]]) -> List[np.ndarray]:
+        """
+        Embeddings of texts in order, calling embed_fn only with the texts not cached yet (each once)
+        """
+        keys = [text_hash(t) for t in texts]
+        found: Dict[bytes, np.ndarray] = dict()
+        for key in keys:
+            if key in self._lru:
+                found[key] = self._lru[key]
+                self._lru.move_to_end(key)
+        n_memory = len(found)
+        from_table = self._load([k for k in dict.fromkeys(keys) if k not in found])
+        found.update(from_table)
+
+        missing = {k: t for k, t in zip(keys, texts) if k not in found} # first text of every missing key
+        if missing:
+            t_start = time.time()
+            embedded = embed_fn(list(missing.values()))
+            self._seconds_per_text = (time.time() - t_start) / len(missing)
+            new = {k: np.asarray(e) for k, e in zip(missing.keys(), embedded)}
+            self._store(new)
+            found.update(new)
+        for key in from_table.keys() | missing.keys():
+            self._remember(key, found[key])
+
+        # repeats of a text within the batch count as hits - it was embedded (or found) once for all of them
+        self._count(memory=n_memory, table=len(from_table), batch=len(keys) - len(set(keys)), misses=len(missing))
+        return [found[k] for k in keys]
+
+    def _count(self, *, memory: int, table: int, batch: int, misses: int):
+        before = self.lookups
+        hits = memory + table + batch
+        self.hits += hits
+        self.misses += misses
+        LOOKUPS.labels(model=self.model_name, result="memory").inc(memory)
+        LOOKUPS.labels(model=self.model_name, result="table").inc(table)
+        LOOKUPS.labels(model=self.model_name, result="batch").inc(batch)
+        LOOKUPS.labels(model=self.model_name, result="miss").inc(misses)
+        if self._seconds_per_text is not None:
+            SAVED_SECONDS.labels(model=self.model_name).inc(hits * self._seconds_per_text)
+        if before // LOG_EVERY != self.lookups // LOG_EVERY:
+            logging.info(f"Embedding cache of {self.model_name}: {self.hit_rate:.1%} hits of {self.lookups} texts")
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.lookups, 1)
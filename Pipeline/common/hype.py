@@ -0,0 +1,203 @@
+"""
+Vectorized hype scores (README: m.hype ~= (m.views, m.reactions, m.forwards)).
+
+score_window() loads the counters of every message posted in a time window as NumPy columns and computes:
+    hype      log-engagement relative to the audience of the chat (HYPE_WEIGHTS, members_count)
+    chat_z    hype standardized against the other messages of the chat in the window
+    sender_z  hype standardized against everything the sender posted before (sender_hype_stats)
+Everything is computed per group with np.bincount over the whole window at once - no per-row Python.
+
+sender_hype_stats keeps (n, mean, m2) per sender and is updated incrementally: the new hype values of a window
+are merged in with the batched form of Welford's update (Chan et al.), and messages scored before have their
+previous value taken out first, so rescoring a window after the counters moved never counts a message twice.
+Scores go to message_hype, stats to sender_hype_stats, both with one binary COPY each.
+"""
+from typing import Dict, Tuple, Optional
+from collections import namedtuple
+import datetime
+import logging
+import math
+import time
+import numpy as np
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+import common.backend.models as models
+from common.backend.pg_copy import copy_upsert
+from common.utils import create_postgres_engine
+from common import metrics
+
+
+HYPE_WEIGHTS = dict(views=1.0, forwards=2.0, reactions=1.5) # reactions include poll votes
+MIN_STD = 1e-3 # groups with (almost) identical hype get z = 0 instead of dividing by ~0
+MIN_SENDER_SAMPLES = 5 # fewer previous messages than this - no sender_z
+
+SCORE_SECONDS = metrics.histogram("telelog_hype_score_seconds", "Time to score one window", ["step"])
+MESSAGES_SCORED = metrics.counter("telelog_hype_messages_scored_total", "Messages given a hype score")
+
+message_columns = np.dtype([
+    ("chat_id", np.int64),
+    ("message_id", np.int64),
+    ("sender_id", np.int64),
+    ("views", np.float64),
+    ("forwards", np.float64),
+    ("reactions", np.float64),
+    ("members", np.float64),
+    ("old_hype", np.float64), # NaN if never scored
+    ("old_sender_id", np.int64),
+])
+
+SenderStats = namedtuple("SenderStats", ["n", "mean", "m2"]) # arrays aligned with a sender id array
+
+
+def select_window() -> str:
+    # sender_id is the chat for channel posts without a signature
+    return """
+        SELECT
+            m.chat_id, m.message_id, COALESCE(m.sender_id, m.chat_id),
+            COALESCE(m.views, 0), COALESCE(m.forwards, 0),
+            COALESCE(m.reactions_vote_count, 0) + COALESCE(m.poll_vote_count, 0),
+            COALESCE(c.members_count, 0),
+            COALESCE(h.hype, 'NaN'), COALESCE(h.sender_id, 0)
+        FROM messages m
+        LEFT JOIN chats c ON c.chat_id = m.chat_id
+        LEFT JOIN message_hype h ON h.chat_id = m.chat_id AND h.message_id = m.message_id
+        WHERE m.date >= %s AND m.date < %s
+    """
+
+
+def hype_of(columns: np.ndarray) -> np.ndarray:
+    reach = np.log1p(columns["members"])
+    return (
+        HYPE_WEIGHTS["views"] * np.log1p(columns["views"])
+        + HYPE_WEIGHTS["forwards"] * np.log1p(columns["forwards"])
+        + HYPE_WEIGHTS["reactions"] * np.log1p(columns["reactions"])
+        - reach
+    )
+
+
+def group_stats(groups: np.ndarray, x: np.ndarray, size: int) -> SenderStats:
+    """
+    (n, mean, m2) of x per group index in [0, size)
+    """
+    n = np.bincount(groups, minlength=size).astype(np.float64)
+    mean = np.bincount(groups, weights=x, minlength=size) / np.maximum(n, 1)
+    m2 = np.bincount(groups, weights=(x - mean[groups]) ** 2, minlength=size)
+    return SenderStats(n, mean, m2)
+
+
+def stats_merge(a: SenderStats, b: SenderStats) -> SenderStats:
+    """
+    Welford's update for a whole batch b at once (Chan et al.), elementwise per group
+    """
+    n = a.n + b.n
+    safe_n = np.maximum(n, 1)
+    delta = b.mean - a.mean
+    mean = a.mean + delta * b.n / safe_n
+    m2 = a.m2 + b.m2 + delta ** 2 * a.n * b.n / safe_n
+    return SenderStats(n, np.where(n > 0, mean, 0), np.where(n > 0, m2, 0))
+
+
+def stats_remove(total: SenderStats, b: SenderStats) -> SenderStats:
+    """
+    The inverse of stats_merge - total without the values of b
+    """
+    n = total.n - b.n
+    safe_n = np.maximum(n, 1)
+    mean = (total.n * total.mean - b.n * b.mean) / safe_n
+    delta = b.mean - mean
+    m2 = total.m2 - b.m2 - delta ** 2 * n * b.n / np.maximum(total.n, 1)
+    return SenderStats(n, np.where(n > 0, mean, 0), np.where(n > 0, np.maximum(m2, 0), 0))
+
+
+def zscore(x: np.ndarray, mean: np.ndarray, var: np.ndarray) -> np.ndarray:
+    return (x - mean) / np.maximum(np.sqrt(var), MIN_STD)
+
+
+class HypeScorer:
+    def __init__(self, engine: Optional[Engine] = None):
+        self._engine = engine or create_postgres_engine()
+
+    def load_window(self, start: datetime.datetime, end: datetime.datetime) -> np.ndarray:
+        conn = self._engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(select_window(), (start, end))
+            columns = np.fromiter(cur, dtype=message_columns, count=cur.rowcount)
+            cur.close()
+        finally:
+            conn.close()
+        return columns
+
+    def load_sender_stats(self, sender_ids: np.ndarray) -> SenderStats:
+        stats = SenderStats(np.zeros(len(sender_ids)), np.zeros(len(sender_ids)), np.zeros(len(sender_ids)))
+        conn = self._engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT sender_id, n, mean, m2 FROM sender_hype_stats WHERE sender_id = ANY(%s)", (sender_ids.tolist(),))
+            rows = cur.fetchall()
+            cur.close()
+        finally:
+            conn.close()
+        if rows:
+            ids, n, mean, m2 = (np.array(c) for c in zip(*rows))
+            idx = np.searchsorted(sender_ids, ids) # sender_ids is sorted (np.unique)
+            stats.n[idx], stats.mean[idx], stats.m2[idx] = n, mean, m2
+        return stats
+
+    def score_window(self, start: datetime.datetime, end: datetime.datetime) -> int:
+        """
+        Scores every message posted in [start, end) and folds the scores into the sender statistics.
+        Returns the number of messages scored
+        """
+        t_start = time.time()
+        columns = self.load_window(start, end)
+        t_loaded = time.time()
+        SCORE_SECONDS.labels(step="load").observe(t_loaded - t_start)
+        if not len(columns):
+            return 0
+        hype = hype_of(columns)
+
+        chat_ids, chat_idx = np.unique(columns["chat_id"], return_inverse=True)
+        chat = group_stats(chat_idx, hype, len(chat_ids))
+        chat_z = zscore(hype, chat.mean[chat_idx], (chat.m2 / np.maximum(chat.n, 1))[chat_idx])
+
+        # one index space for current and previous senders, so removal and merge line up
+        rescored = ~np.isnan(columns["old_hype"])
+        sender_ids, sender_idx = np.unique(np.concatenate([columns["sender_id"], columns["old_sender_id"][rescored]]), return_inverse=True)
+        new_idx, old_idx = sender_idx[:len(columns)], sender_idx[len(columns):]
+        stored = self.load_sender_stats(sender_ids)
+        previous = stats_remove(stored, group_stats(old_idx, columns["old_hype"][rescored], len(sender_ids)))
+        sender_var = previous.m2 / np.maximum(previous.n - 1, 1)
+        sender_z = zscore(hype, previous.mean[new_idx], sender_var[new_idx])
+        sender_z[previous.n[new_idx] < MIN_SENDER_SAMPLES] = np.nan
+        updated = stats_merge(previous, group_stats(new_idx, hype, len(sender_ids)))
+        t_scored = time.time()
+        SCORE_SECONDS.labels(step="score").observe(t_scored - t_loaded)
+
+        scored_at = datetime.datetime.now()
+        rows_hype = [
+            dict(chat_id=c, message_id=m, sender_id=s, hype=h, chat_z=cz, sender_z=None if math.isnan(sz) else sz, scored_at=scored_at)
+            for c, m, s, h, cz, sz in zip(
+                columns["chat_id"].tolist(), columns["message_id"].tolist(), columns["sender_id"].tolist(),
+                hype.tolist(), chat_z.tolist(), sender_z.tolist(),
+            )
+        ]
+        changed = np.flatnonzero((updated.n != stored.n) | (updated.mean != stored.mean) | (updated.m2 != stored.m2))
+        rows_stats = [
+            dict(sender_id=s, n=int(n), mean=mean, m2=m2, updated_at=scored_at)
+            for s, n, mean, m2 in zip(
+                sender_ids[changed].tolist(), updated.n[changed].tolist(), updated.mean[changed].tolist(), updated.m2[changed].tolist(),
+            )
+        ]
+        with Session(self._engine) as sess:
+            copy_upsert(sess, models.MessageHype, rows_hype, coalesce=False) # a rescore may take sender_z back to NULL
+            copy_upsert(sess, models.SenderHypeStats, rows_stats)
+            sess.commit()
+        t_written = time.time()
+        SCORE_SECONDS.labels(step="write").observe(t_written - t_scored)
+        MESSAGES_SCORED.inc(len(columns))
+        logging.info(
+            f"Scored {len(columns)} messages of {len(chat_ids)} chats posted in [{start}, {end}): "
+            f"load {t_loaded - t_start:.2f}s, score {t_scored - t_loaded:.2f}s, write {t_written - t_scored:.2f}s"
+        )
+        return len(columns)
@@ -0,0 +1,279 @@
+"""
+Minimal Prometheus-style instrumentation shared by the Pipeline services.
+
+    FETCHED = metrics.counter("telelog_messages_fetched_total", "Messages received from Telegram", ["session"])
+    FETCHED.labels(session="a").inc()
+    with metrics.histogram("telelog_commit_seconds", "...").time():
+        ...
+
+start_http_server() serves every metric of the process in the text exposition format on
+METRICS_PORT (disabled when unset), so any Prometheus/VictoriaMetrics scraper can read it.
+"""
+from typing import Dict, List, Tuple, Optional, Callable, Iterable
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import logging
+import time
+import math
+import os
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_value(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    if v == -math.inf:
+        return "-Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels.items()]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Timer:
+    def __init__(self, observe: Callable[[float], None]):
+        self._observe = observe
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._observe(time.perf_counter() - self._start)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self._lock:
+            self._value += amount
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        yield name, labels, self._value
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function: Callable[[], float] = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Computes the value at scrape time instead, so hot paths don't have to update it
+        """
+        self._function = function
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        if self._function is not None:
+            try:
+                yield name, labels, self._function()
+            except Exception as e:
+                logging.warning(f"metrics - gauge {name} failed: {e}")
+            return
+        yield name, labels, self._value
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._sum += value
+            self._count += 1
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def time(self) -> _Timer:
+        return _Timer(self.observe)
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        cumulative = 0
+        for bound, c in zip(self._buckets, counts):
+            cumulative += c
+            yield f"{name}_bucket", labels | {"le": _format_value(bound)}, cumulative
+        yield f"{name}_bucket", labels | {"le": "+Inf"}, count
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, count
+
+
+class Metric:
+    type_name: str = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children: Dict[Tuple[str, ...], object] = dict()
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, **labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels.keys())}")
+        key = tuple(str(labels[k]) for k in self.labelnames)
+        child = self._children.get(key, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _unlabeled(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels {self.labelnames} - use .labels()")
+        return self.labels()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, dict(zip(self.labelnames, key))):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._unlabeled().inc(amount)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._unlabeled().set(value)
+
+    def inc(self, amount: float = 1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._unlabeled().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._unlabeled().set_function(function)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def _new_child(self):
+        return _HistogramChild(self._kwargs.get("buckets", None) or DEFAULT_BUCKETS)
+
+    def observe(self, value: float):
+        self._unlabeled().observe(value)
+
+    def time(self) -> _Timer:
+        return self._unlabeled().time()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+        self._lock = threading.Lock()
+
+    def register(self, cls, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered as a different {metric.type_name}")
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+    return registry.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return registry.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Iterable[str] = (), *, buckets: Optional[Tuple[float, ...]] = None) -> Histogram:
+    return registry.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes would flood the logs
+
+
+_server: ThreadingHTTPServer = None
+
+
+def start_http_server(port: Optional[int] = None, addr: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """
+    Serves /metrics from a daemon thread. Port defaults to METRICS_PORT - without it, does nothing
+    """
+    global _server
+    if _server is not None:
+        return _server
+    if port is None:
+        port = int(os.environ.get("METRICS_PORT", 0))
+    if not port:
+        return None
+    _server = ThreadingHTTPServer((addr, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True, name="metrics").start()
+    logging.info(f"Serving metrics on {addr}:{port}/metrics")
+    return _server
@@ -0,0 +1,180 @@
+"""
+Per-session request governor for pyrogram clients.
+
+Every Telegram request of a session goes through a token bucket whose rate is learned AIMD-style:
+each successful request adds a little to the rate, and each FloodWait halves it and blocks the session
+for the requested time. Short waits are slept through and the request retried, longer ones are raised
+so the caller can move the work to another session (see MessageFetch/scheduler.py).
+
+    governor = RateGovernor.get(session_name)
+    chat = await governor.call(app.get_chat, chat_id)
+    async for message in governor.chat_history(app, chat_id, offset_id=offset_id):
+        ...
+
+Pyrogram sleeps through FloodWaits below Client.sleep_threshold by itself, hiding them from the governor -
+create governed clients with load_pyrogram_session(..., sleep_threshold=0).
+"""
+from typing import Dict, Callable, Awaitable, AsyncIterator, Any, Set
+import asyncio
+import logging
+import time
+from pyrogram import Client
+from pyrogram.errors import Flood
+from common import metrics
+
+
+INITIAL_RATE = 5 # requests per second
+MIN_RATE = 0.2
+MAX_RATE = 30
+ADDITIVE_INCREASE = 0.02 # per successful request, so about +1 request/s every 50 requests
+MULTIPLICATIVE_DECREASE = 0.5
+SLEEP_THRESHOLD = 10 # FloodWaits up to this many seconds are waited out and retried
+HISTORY_PAGE_SIZE = 100 # messages per request of get_chat_history / get_dialogs
+
+FLOODWAIT_SECONDS = metrics.counter("telelog_floodwait_seconds_total", "Seconds Telegram asked us to wait", ["session"])
+FLOODWAITS = metrics.counter("telelog_floodwaits_total", "FloodWait responses", ["session"])
+SESSION_RATE = metrics.gauge("telelog_session_rate", "Learned safe request rate (requests/s)", ["session"])
+
+
+class RateGovernor:
+    _instances: Dict[str, "RateGovernor"] = dict()
+
+    def __init__(
+        self,
+        session_name: str,
+        *,
+        rate: float = INITIAL_RATE,
+        min_rate: float = MIN_RATE,
+        max_rate: float = MAX_RATE,
+        increase: float = ADDITIVE_INCREASE,
+        decrease: float = MULTIPLICATIVE_DECREASE,
+        sleep_threshold: float = SLEEP_THRESHOLD,
+    ):
+        self.session_name = session_name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.sleep_threshold = sleep_threshold
+        self._tokens = 1.0
+        self._t_refill = time.monotonic()
+        self._penalized_until = 0.0
+        self._floodwaits = FLOODWAITS.labels(session=session_name)
+        self._floodwait_seconds = FLOODWAIT_SECONDS.labels(session=session_name)
+        SESSION_RATE.labels(session=session_name).set_function(lambda: self.rate)
+
+    @classmethod
+    def get(cls, session_name: str) -> "RateGovernor":
+        """
+        The governor of a session - one per process, shared by everything that uses the session
+        """
+        if session_name not in cls._instances:
+            cls._instances[session_name] = RateGovernor(session_name)
+        return cls._instances[session_name]
+
+    @property
+    def burst(self) -> float:
+        return max(1.0, self.rate)
+
+    @property
+    def penalty_remaining(self) -> float:
+        return max(self._penalized_until - time.monotonic(), 0)
+
+    @property
+    def penalized(self) -> bool:
+        return self.penalty_remaining > 0
+
+    async def acquire(self, cost: float = 1):
+        while True:
+            now = time.monotonic()
+            if now < self._penalized_until:
+                await asyncio.sleep(self._penalized_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._t_refill) * self.rate)
+            self._t_refill = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return
+            await asyncio.sleep((cost - self._tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_floodwait(self, seconds: float):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._tokens = 0
+        self._penalized_until = max(self._penalized_until, time.monotonic() + seconds)
+        self._floodwaits.inc()
+        self._floodwait_seconds.inc(seconds)
+        logging.warning(f"RateGovernor - {self.session_name} got FloodWait of {seconds}s, rate lowered to {self.rate:.2f}/s")
+
+    def _should_retry(self, e: Flood) -> bool:
+        seconds = float(e.value or 0)
+        self.on_floodwait(seconds)
+        return seconds <= self.sleep_threshold
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        await fn(*args, **kwargs) within the rate. Long FloodWaits are raised after they are recorded
+        """
+        while True:
+            await self.acquire()
+            try:
+                result = await fn(*args, **kwargs)
+            except Flood as e:
+                if not self._should_retry(e):
+                    raise
+                continue
+            self.on_success()
+            return result
+
+    async def chat_history(self, app: Client, chat_id: int|str, *, limit: int = 0, **kwargs) -> AsyncIterator[Any]:
+        """
+        app.get_chat_history(chat_id, ...), one token per page. After a short FloodWait it continues below the last message
+        """
+        yielded = 0
+        while True:
+            n = 0
+            await self.acquire()
+            try:
+                async for message in app.get_chat_history(chat_id, limit=limit - yielded if limit else 0, **kwargs):
+                    yield message
+                    yielded += 1
+                    n += 1
+                    if n % HISTORY_PAGE_SIZE == 0:
+                        self.on_success()
+                        await self.acquire()
+                self.on_success()
+                return
+            except Flood as e:
+                if not self._should_retry(e):
+                    raise
+                if n:
+                    kwargs.pop("offset_date", None)
+                    kwargs["offset_id"] = message.id
+
+    async def dialogs(self, app: Client, **kwargs) -> AsyncIterator[Any]:
+        """
+        app.get_dialogs(), one token per page. After a short FloodWait it starts over, skipping dialogs already yielded
+        """
+        seen: Set[int] = set()
+        while True:
+            n = 0
+            await self.acquire()
+            try:
+                async for dialog in app.get_dialogs(**kwargs):
+                    n += 1
+                    if n % HISTORY_PAGE_SIZE == 0:
+                        self.on_success()
+                        await self.acquire()
+                    key = dialog.chat.id if dialog.chat else None
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    yield dialog
+                self.on_success()
+                return
+            except Flood as e:
+                if not self._should_retry(e):
+                    raise
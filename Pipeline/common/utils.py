@@ -63,6 +63,19 @@ def create_postgres_engine():
     return create_engine(f"postgresql://{consts['POSTGRES_USER']}:{consts['POSTGRES_PASSWORD']}@{postgres_host}:{postgres_port}/{consts['POSTGRES_DB']}")
 
 
+def create_async_postgres_engine(*, pool_size: int = None, max_overflow: int = 10):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    import os
+    postgres_host = os.environ.get("POSTGRES_HOST_OVERRIDE", os.environ["POSTGRES_HOST"])
+    postgres_port = os.environ.get("POSTGRES_PORT_OVERRIDE", os.environ["POSTGRES_PORT"])
+    pool_size = pool_size or int(os.environ.get("POSTGRES_POOL_SIZE", 5))
+    return create_async_engine(
+        f"postgresql+asyncpg://{consts['POSTGRES_USER']}:{consts['POSTGRES_PASSWORD']}@{postgres_host}:{postgres_port}/{consts['POSTGRES_DB']}",
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+    )
+
+
 def create_postgres_connection():
     return create_postgres_engine().connect()
 
@@ -81,7 +94,7 @@ def load_embedding_model():
     return model
 
 
-def load_pyrogram_session(session_name: str):
+def load_pyrogram_session(session_name: str, *, sleep_threshold: Optional[int] = None):
     from pyrogram import Client
     import os
     session_string = os.environ[f"TELEGRAM_SESSION_STRING__{session_name}"]
@@ -92,10 +105,11 @@ def load_pyrogram_session(session_name: str):
         "username": os.environ.get(f"TELEGRAM_PROXY_USERNAME__{session_name}", None),
         "password": os.environ.get(f"TELEGRAM_PROXY_PASSWORD__{session_name}", None),
     }.items() if v is not None}
+    kwargs = dict(sleep_threshold=sleep_threshold) if sleep_threshold is not None else dict() # 0 = raise every FloodWait (see common/rate_limit.py)
     if proxy:
-        client = Client("session", session_string=session_string, proxy=proxy)
+        client = Client("session", session_string=session_string, proxy=proxy, **kwargs)
     else:
-        client = Client("session", session_string=session_string)
+        client = Client("session", session_string=session_string, **kwargs)
     return client
 
 
@@ -127,7 +141,7 @@ async def run_async(func: Callable, *, check_interval: float = 1, timeout: float
     else:
         return result[0]
 
-def upsert(sess, model, rows):
+def build_upsert(model, rows):
     table = model.__table__
     stmt = insert(table)
     primary_keys = [key.name for key in inspect(table).primary_key]
@@ -162,4 +176,9 @@ def upsert(sess, model, rows):
         return row
 
     rows = list(filter(None, (handle_foreignkeys_constraints(row) for row in rows)))
+    return stmt, rows
+
+
+def upsert(sess, model, rows):
+    stmt, rows = build_upsert(model, rows)
     return sess.execute(stmt, rows)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+from typing import List
+import logging
+import random
+import time
+import click
+import torch
+from sqlalchemy import text
+from common.utils import create_postgres_engine
+from MessageEmbed.embedder import MessageEmbedder, SentenceEmbedder, HEGEMMA_MODEL, EMBED_TOKEN_BUDGET
+logging.basicConfig(level=logging.INFO)
+
+
+HEBREW_LETTERS = "אבגדהוזחטיכלמנסעפצקרשת"
+
+
+def synthetic_texts(n: int, seed: int = 0) -> List[str]:
+    """
+    Hebrew-looking texts with a long tail of lengths, like message chains
+    """
+    rng = random.Random(seed)
+    def word():
+        return "".join(rng.choice(HEBREW_LETTERS) for _ in range(rng.randint(2, 7)))
+    return [" ".join(word() for _ in range(max(1, int(rng.lognormvariate(3, 1))))) for _ in range(n)]
+
+
+def sampled_texts(n: int) -> List[str]:
+    with create_postgres_engine().connect() as conn:
+        rows = conn.execute(text("SELECT chain FROM message_chain TABLESAMPLE SYSTEM (1) LIMIT :n"), dict(n=n))
+        return [r[0] for r in rows]
+
+
+def embed_fixed(embedder: MessageEmbedder, texts: List[str], batch_size: int):
+    """
+    The batching MessageEmbed used before: fixed batches padded to their longest text, autograd on
+    """
+    for i in range(0, len(texts), batch_size):
+        inputs = embedder.tokenizer(texts[i:i+batch_size], return_tensors="pt", truncation=True, padding=True, max_length=embedder.max_length)
+        embedder.forward(inputs).detach()
+
+
+@click.command()
+@click.option("--model", "models", multiple=True, type=click.Choice(["hegemma", "sentence-transformers"]), default=["hegemma", "sentence-transformers"])
+@click.option("--precision", "precisions", multiple=True, type=click.Choice(["fp32", "bf16", "int8"]), default=["fp32", "bf16", "int8"])
+@click.option("--texts", "n_texts", type=int, default=256)
+@click.option("--from-db", is_flag=True, help="Sample message_chain instead of synthetic texts")
+@click.option("--token-budget", type=int, default=EMBED_TOKEN_BUDGET)
+@click.option("--fixed-batch", type=int, default=128, help="Batch size of the fixed batching baseline (0 = skip it)")
+@click.option("--threads", type=int, default=0, help="torch CPU threads (0 = torch default)")
+def main(models: List[str], precisions: List[str], n_texts: int, from_db: bool, token_budget: int, fixed_batch: int, threads: int):
+    """
+    Texts per second on CPU of MessageEmbed's embedders, per model and precision, with length-bucketed
+    batching and with the fixed batching it replaced
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    texts = sampled_texts(n_texts) if from_db else synthetic_texts(n_texts)
+    logging.info(f"{len(texts)} texts, {sum(len(t) for t in texts) / max(len(texts), 1):.0f} characters on average")
+    for model in models:
+        for precision in precisions:
+            if model == "hegemma":
+                embedder = MessageEmbedder(HEGEMMA_MODEL, precision=precision, token_budget=token_budget, device="cpu")
+            else:
+                embedder = SentenceEmbedder(precision=precision, token_budget=token_budget, device="cpu")
+            embedder.embed(texts[:8]) # warm up
+            t_start = time.time()
+            embedder.embed(texts)
+            bucketed = len(texts) / (time.time() - t_start)
+            result = f"{model} {precision}: bucketed {bucketed:.1f} texts/s"
+            if fixed_batch:
+                t_start = time.time()
+                embed_fixed(embedder, texts, fixed_batch)
+                fixed = len(texts) / (time.time() - t_start)
+                result += f", fixed batches of {fixed_batch} {fixed:.1f} texts/s ({bucketed / fixed:.2f}x)"
+            logging.info(result)
+            del embedder
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+from typing import List, Dict, Any, Tuple
+import logging
+import random
+import time
+import datetime
+import click
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from common.utils import create_postgres_engine, pretty_time
+from common.backend.pg_backend import write_message_items
+import common.backend.models as models
+logging.basicConfig(level=logging.INFO)
+
+
+# synthetic chat ids, far away from real telegram ids so nothing collides even if a run is interrupted
+BENCH_CHAT_ID_BASE = -7_000_000_000_000
+
+
+def make_items(n: int, *, chats: int, reaction_ids: List[int], seed: int = 0) -> Tuple[List[Dict[str, Any]], ...]:
+    rng = random.Random(seed)
+    date = datetime.datetime(2024, 1, 1)
+    items_messages, items_reactions, items_polls, items_chats, items_users = [], [], [], [], []
+    for chat_index in range(chats):
+        items_chats.append(dict(chat_id=BENCH_CHAT_ID_BASE - chat_index, title=f"bench {chat_index}", type="channel", members_count=rng.randint(0, 100000)))
+    for i in range(n):
+        chat_id = BENCH_CHAT_ID_BASE - (i % chats)
+        message_id = i // chats + 1
+        sender_id = BENCH_CHAT_ID_BASE - chats - rng.randint(0, 1000)
+        reactions = {r: rng.randint(1, 500) for r in rng.sample(reaction_ids, k=min(len(reaction_ids), rng.randint(0, 3)))}
+        reactions_vote_count = sum(reactions.values()) if reactions else None
+        is_poll = rng.random() < 0.02
+        options = [rng.randint(0, 300) for _ in range(4)] if is_poll else []
+        items_messages.append(dict(
+            chat_id=chat_id,
+            message_id=message_id,
+            sender_id=sender_id,
+            text="x" * rng.randint(0, 400),
+            date=date + datetime.timedelta(seconds=i),
+            views=rng.randint(0, 100000),
+            forwards=rng.randint(0, 1000),
+            forward_from_chat_id=None,
+            forward_from_message_id=None,
+            reply_to_message_id=message_id - 1 if rng.random() < 0.1 and message_id > 1 else None,
+            poll_vote_count=sum(options) if is_poll else None,
+            reactions_vote_count=reactions_vote_count,
+            media_type="photo" if rng.random() < 0.3 else None,
+            file_id=None,
+            file_unique_id=None,
+        ))
+        for r, c in reactions.items():
+            items_reactions.append(dict(chat_id=chat_id, message_id=message_id, reaction_id=r,
+                                        reaction_votes_norm=c / reactions_vote_count, reaction_votes_abs=c))
+        for option_id, votes in enumerate(options):
+            items_polls.append(dict(chat_id=chat_id, message_id=message_id, poll_option_id=option_id, poll_option_text=f"option {option_id}",
+                                    poll_option_votes_norm=votes / sum(options) if sum(options) else 0, poll_option_votes_abs=votes))
+        if rng.random() < 0.05:
+            items_users.append(dict(sender_id=sender_id, first_name="bench", last_name=None, username=None, is_bot=False))
+    return items_messages, items_reactions, items_polls, items_chats, items_users
+
+
+def batches(items_messages, items_reactions, items_polls, batch_size: int):
+    # keep the child rows of a message in the same batch as the message, like add_messages does
+    reactions_by_message, polls_by_message = dict(), dict()
+    for r in items_reactions:
+        reactions_by_message.setdefault((r["chat_id"], r["message_id"]), []).append(r)
+    for p in items_polls:
+        polls_by_message.setdefault((p["chat_id"], p["message_id"]), []).append(p)
+    for i in range(0, len(items_messages), batch_size):
+        batch = items_messages[i:i+batch_size]
+        keys = [(m["chat_id"], m["message_id"]) for m in batch]
+        yield (
+            batch,
+            [r for k in keys for r in reactions_by_message.get(k, [])],
+            [p for k in keys for p in polls_by_message.get(k, [])],
+        )
+
+
+def run(engine, items, *, copy: bool, batch_size: int) -> Tuple[float, List[float]]:
+    items_messages, items_reactions, items_polls, items_chats, items_users = items
+    batch_times = []
+    with Session(engine) as sess:
+        t_start = time.time()
+        write_message_items(sess, [], [], [], items_chats, items_users, copy=copy)
+        for batch_messages, batch_reactions, batch_polls in batches(items_messages, items_reactions, items_polls, batch_size):
+            t_batch = time.time()
+            write_message_items(sess, batch_messages, batch_reactions, batch_polls, [], [], copy=copy)
+            sess.flush()
+            batch_times.append(time.time() - t_batch)
+        total = time.time() - t_start
+        sess.rollback() # never leave benchmark rows behind
+    return total, batch_times
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("--sizes", type=int, multiple=True, default=[10_000, 100_000, 1_000_000], help="Number of messages per run")
+@click.option("--batch-size", type=int, default=10000, help="Messages per batch, as in MessageQueue")
+@click.option("--chats", type=int, default=50, help="Number of synthetic chats the messages are spread over")
+@click.option("--modes", type=click.Choice(["upsert", "copy"]), multiple=True, default=["upsert", "copy"], help="Ingest paths to compare")
+def main(sizes: List[int], batch_size: int, chats: int, modes: List[str]):
+    engine = create_postgres_engine()
+    with Session(engine) as sess:
+        reaction_ids = [row[0] for row in sess.execute(select(models.EmojiMap.reaction_id).limit(20)).fetchall()]
+    if not reaction_ids:
+        logging.warning("emoji_map is empty - benchmarking without reactions")
+    results = []
+    for n in sizes:
+        logging.info(f"Generating {n} messages")
+        items = make_items(n, chats=chats, reaction_ids=reaction_ids)
+        for mode in modes:
+            logging.info(f"Running {mode} with {n} messages")
+            total, batch_times = run(engine, items, copy=(mode == "copy"), batch_size=batch_size)
+            batch_times.sort()
+            p50 = batch_times[len(batch_times) // 2] if batch_times else 0
+            results.append((n, mode, total, n / total if total else float("inf"), p50))
+            logging.info(f"{mode} {n}: {pretty_time(total)}, {n / total:.0f} msg/s, p50 batch {p50:.3f}s")
+    print(f"{'rows':>10} {'mode':>8} {'total':>14} {'msg/s':>10} {'p50 batch':>10}")
+    for n, mode, total, rate, p50 in results:
+        print(f"{n:>10} {mode:>8} {pretty_time(total):>14} {rate:>10.0f} {p50:>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
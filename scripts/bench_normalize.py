@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+from typing import List
+import logging
+import time
+import click
+from pyrogram.types import Message
+from common.backend.base_backend import clean_dict
+from common.backend.pg_backend import compose_insert_message_dict_query
+from common.backend.normalize import extract_message_items, NormalizePool
+from common.corpus import load_corpus
+logging.basicConfig(level=logging.INFO)
+
+
+def measure(fn, messages: List[Message], repeat: int) -> float:
+    """ returns CPU seconds per message """
+    t_start = time.process_time()
+    for _ in range(repeat):
+        for m in messages:
+            fn(m)
+    return (time.process_time() - t_start) / (repeat * len(messages))
+
+
+@click.group()
+def cli():
+    """
+    Compares the normalizers on a corpus recorded with scripts/replay_ingest.py record
+    """
+    pass
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--repeat", type=int, default=5, help="Passes over the corpus")
+@click.option("--processes", type=int, multiple=True, default=[], help="Also measure NormalizePool wall time with this many processes")
+def run(paths: List[str], repeat: int, processes: List[int]):
+    messages = load_corpus(paths)
+    logging.info(f"Loaded {len(messages)} messages")
+    mismatches = 0
+    for m in messages: # also warms up the emoji map so no DB round trips are measured
+        if compose_insert_message_dict_query(clean_dict(m)) != extract_message_items(m):
+            mismatches += 1
+    if mismatches:
+        logging.warning(f"{mismatches} messages normalize differently between clean_dict and extract_message_items")
+    before = measure(lambda m: compose_insert_message_dict_query(clean_dict(m)), messages, repeat)
+    after = measure(extract_message_items, messages, repeat)
+    print(f"clean_dict + compose_insert_message_dict_query: {before * 1e6:8.1f} us/msg")
+    print(f"extract_message_items:                          {after * 1e6:8.1f} us/msg")
+    print(f"speedup: {before / after:.1f}x")
+    for n in processes:
+        pool = NormalizePool(n)
+        pool.normalize(messages[:n]) # spawn the workers outside the measurement
+        t_start = time.time()
+        for _ in range(repeat):
+            pool.normalize(messages)
+        wall = (time.time() - t_start) / (repeat * len(messages))
+        pool.close()
+        print(f"NormalizePool({n}) wall time:                   {wall * 1e6:8.1f} us/msg")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import logging
+import time
+import click
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from common.utils import create_postgres_engine, upsert
+from common.backend.pg_copy import copy_vectors, encode_copy_vectors
+import common.backend.models as models
+logging.basicConfig(level=logging.INFO)
+
+
+# embedding table -> the table its keys reference, where existing keys are borrowed from
+TABLES = {
+    "message_embeddings": (models.MessageEmbeddings, "SELECT chat_id, message_id FROM messages"),
+    "message_chain_embeddings_hegemmav2": (models.MessageChainEmbeddingsHegemmav2, "SELECT chat_id, last_message_id FROM message_chain"),
+}
+
+
+@click.command()
+@click.option("--table", type=click.Choice(list(TABLES)), default="message_chain_embeddings_hegemmav2")
+@click.option("-n", "--rows", type=int, default=20000)
+@click.option("--orm-rows", type=int, default=1000, help="Rows written with the executemany upsert for comparison (0 = skip)")
+def main(table: str, rows: int, orm_rows: int):
+    """
+    Vectors per second of copy_vectors against the executemany upsert. Writes random embeddings for existing keys
+    (the foreign keys must hold) and rolls everything back
+    """
+    model, select_keys = TABLES[table]
+    dims = model.__table__.c.embedding.type.dim
+    engine = create_postgres_engine()
+    with Session(engine) as sess:
+        keys = np.array(sess.execute(text(f"{select_keys} LIMIT :n"), dict(n=rows)).fetchall(), dtype=np.int64).reshape(-1, 2)
+        embeddings = np.random.default_rng(0).standard_normal((len(keys), dims), dtype=np.float32)
+        logging.info(f"{len(keys)} vectors of {dims} dims into {table}")
+
+        t_start = time.time()
+        payload = encode_copy_vectors(keys, embeddings)
+        t_encoded = time.time()
+        logging.info(f"encode: {len(keys) / (t_encoded - t_start):.0f} vectors/s, {len(payload) / (t_encoded - t_start) / 2**20:.0f} MiB/s")
+
+        t_start = time.time()
+        copy_vectors(sess, model, keys, embeddings)
+        elapsed = time.time() - t_start
+        logging.info(f"copy_vectors: {len(keys) / elapsed:.0f} vectors/s ({elapsed:.2f}s)")
+        sess.rollback()
+
+        if orm_rows:
+            key_columns = [k.name for k in model.__table__.primary_key]
+            values = [dict(zip(key_columns, map(int, k)), embedding=e) for k, e in zip(keys[:orm_rows], embeddings[:orm_rows])]
+            t_start = time.time()
+            upsert(sess, model, values)
+            elapsed = time.time() - t_start
+            logging.info(f"executemany upsert: {len(values) / elapsed:.0f} vectors/s ({elapsed:.2f}s)")
+            sess.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+from typing import List, Dict, Any, Callable, Set
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import itertools
+import resource
+import logging
+import asyncio
+import time
+import click
+from common.utils import load_pyrogram_session, pretty_time
+from common.corpus import CorpusWriter, record_chat, load_corpus, describe_corpus, remap_chats
+logging.basicConfig(level=logging.INFO)
+
+
+BACKENDS = ["postgres", "postgres-queue", "postgres-async", "mongo"]
+
+ReplayDialog = namedtuple("ReplayDialog", ["chat", "top_message"])
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KiB on linux
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class Pacer:
+    """
+    Sleeps just enough to keep the replay at `rate` messages per second (0 = as fast as possible)
+    """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.t_start = time.time()
+        self.n = 0
+
+    def delay(self, n: int = 1) -> float:
+        self.n += n
+        if not self.rate:
+            return 0
+        return max(self.t_start + self.n / self.rate - time.time(), 0)
+
+    def wait(self, n: int = 1):
+        d = self.delay(n)
+        if d:
+            time.sleep(d)
+
+    async def wait_async(self, n: int = 1):
+        d = self.delay(n)
+        if d:
+            await asyncio.sleep(d)
+
+
+def timed(fn: Callable, latencies: List[float]) -> Callable:
+    def wrapper(*args, **kwargs):
+        t_start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - t_start)
+    return wrapper
+
+
+def timed_async(fn: Callable, latencies: List[float]) -> Callable:
+    async def wrapper(*args, **kwargs):
+        t_start = time.time()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - t_start)
+    return wrapper
+
+
+def corpus_user_ids(messages) -> Set[int]:
+    return {m.from_user.id for m in messages if m.from_user is not None}
+
+
+def existing_users(user_ids: Set[int]) -> Set[int]:
+    """
+    Which of user_ids already have a users row - those stay after the replay
+    """
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+    from common.utils import create_postgres_engine
+    import common.backend.models as models
+    engine = create_postgres_engine()
+    try:
+        with Session(engine) as sess:
+            return set(sess.execute(select(models.Users.sender_id).where(models.Users.sender_id.in_(list(user_ids)))).scalars())
+    finally:
+        engine.dispose()
+
+
+def delete_users(user_ids: Set[int]):
+    from sqlalchemy import delete
+    from sqlalchemy.orm import Session
+    from common.utils import create_postgres_engine
+    import common.backend.models as models
+    engine = create_postgres_engine()
+    try:
+        with Session(engine) as sess:
+            sess.execute(delete(models.Users).where(models.Users.sender_id.in_(list(user_ids))))
+            sess.commit()
+    finally:
+        engine.dispose()
+
+
+def replay_postgres(messages, *, batch_size: int, rate: float, chat_ids: List[int]) -> List[float]:
+    """ PostgresBackend.add_messages, one call per batch """
+    from common.backend.pg_backend import PostgresBackend
+    db = PostgresBackend(debug_read_only=True) # no MessageQueue
+    latencies = []
+    add_messages = timed(db.add_messages, latencies)
+    pacer = Pacer(rate)
+    try:
+        for i in range(0, len(messages), batch_size):
+            batch = messages[i:i+batch_size]
+            pacer.wait(len(batch))
+            add_messages(batch)
+        for chat_id in chat_ids:
+            db.delete_channel(chat_id)
+    finally:
+        db.close()
+    return latencies
+
+
+def replay_postgres_queue(messages, *, batch_size: int, rate: float, chat_ids: List[int]) -> List[float]:
+    """ BaseBackendWithQueue.add_message per message, batched by MessageQueue """
+    from common.backend.pg_backend import PostgresBackend
+    db = PostgresBackend(batch_size=batch_size)
+    latencies = []
+    db.write_prepared_messages = timed(db.write_prepared_messages, latencies) # what MessageQueue calls per batch
+    pacer = Pacer(rate)
+    for m in messages:
+        pacer.wait()
+        db.add_message(m)
+    db.close() # stops the queue and waits for every batch to be written
+    db = PostgresBackend(debug_read_only=True)
+    try:
+        for chat_id in chat_ids:
+            db.delete_channel(chat_id)
+    finally:
+        db.close()
+    return latencies
+
+
+def replay_postgres_async(messages, *, batch_size: int, rate: float, chat_ids: List[int]) -> List[float]:
+    """ AsyncPostgresBackend.add_message per message, as MessageFetch/main_multi.py does """
+    from common.backend.pg_async_backend import AsyncPostgresBackend
+    async def run():
+        db = AsyncPostgresBackend(batch_size=batch_size)
+        latencies = []
+        db.write_prepared_messages = timed_async(db.write_prepared_messages, latencies)
+        pacer = Pacer(rate)
+        for m in messages:
+            await pacer.wait_async()
+            await db.add_message(m)
+        await db.wait_for_queue_flush()
+        for chat_id in chat_ids:
+            await db.delete_channel(chat_id)
+        await db.close()
+        return latencies
+    return asyncio.run(run())
+
+
+def replay_mongo(messages, *, batch_size: int, rate: float, chat_ids: List[int]) -> List[float]:
+    """ MongoBackend.add_messages, one call per chat and batch """
+    from common.backend.mongo_backend import MongoBackend
+    db = MongoBackend()
+    latencies = []
+    pacer = Pacer(rate)
+    for chat_id, chat_messages in itertools.groupby(sorted(messages, key=lambda m: m.chat.id), key=lambda m: m.chat.id):
+        chat_messages = list(chat_messages)
+        db._selected_channel = ReplayDialog(chat=chat_messages[0].chat, top_message=None) # MongoBackend only accepts messages of the selected chat
+        for i in range(0, len(chat_messages), batch_size):
+            batch = chat_messages[i:i+batch_size]
+            pacer.wait(len(batch))
+            timed(db.add_messages, latencies)(batch)
+        db._selected_channel = None
+    for chat_id in chat_ids:
+        db.delete_channel(chat_id)
+    return latencies
+
+
+replayers = {
+    "postgres": replay_postgres,
+    "postgres-queue": replay_postgres_queue,
+    "postgres-async": replay_postgres_async,
+    "mongo": replay_mongo,
+}
+
+
+def run_one(paths: List[str], backend: str, batch_size: int, rate: float) -> Dict[str, Any]:
+    """
+    Runs in a fresh process, so peak RSS belongs to this run alone
+    """
+    messages = load_corpus(paths)
+    mapping = remap_chats(messages)
+    # users rows are keyed by the real sender ids - the replay deletes only those it created
+    user_ids = corpus_user_ids(messages) if backend.startswith("postgres") else set()
+    kept_users = existing_users(user_ids) if user_ids else set()
+    rss_loaded = peak_rss_mb()
+    t_start = time.time()
+    latencies = replayers[backend](messages, batch_size=batch_size, rate=rate, chat_ids=list(mapping.values()))
+    total = time.time() - t_start # includes deleting the replayed chats, which is small next to the writes
+    if user_ids - kept_users:
+        delete_users(user_ids - kept_users)
+    return dict(
+        backend=backend,
+        batch_size=batch_size,
+        messages=len(messages),
+        total=total,
+        rate=len(messages) / total if total else float("inf"),
+        batches=len(latencies),
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+        rss_loaded=rss_loaded,
+        rss_peak=peak_rss_mb(),
+    )
+
+
+@click.group()
+def cli():
+    """
+    Records Telegram messages into a corpus and replays it into the backends offline.
+    Replays move the corpus into synthetic chats and delete them afterwards, with the users rows they created.
+    """
+    pass
+
+
+@cli.command()
+@click.option("--session", required=True, help="Session name, as in TELEGRAM_FETCH_WITH")
+@click.option("--chat-id", type=int, multiple=True, required=True, help="Chats to record (pick reaction-heavy, poll and media chats)")
+@click.option("--limit", type=int, default=5000, help="Latest messages per chat")
+@click.option("--polls", type=int, default=200, help="Extra poll messages per chat, found through search")
+@click.option("--media", type=int, default=500, help="Extra photo/video messages per chat, found through search")
+@click.option("--output", default="output/corpus.pkl.gz", help="Output path")
+def record(session: str, chat_id: List[int], limit: int, polls: int, media: int, output: str):
+    async def run():
+        app = load_pyrogram_session(session)
+        await app.start()
+        try:
+            with CorpusWriter(output) as writer:
+                for c in chat_id:
+                    await record_chat(app, writer, c, limit=limit, polls=polls, media=media)
+        finally:
+            await app.stop()
+    asyncio.run(run())
+    stats = describe_corpus(load_corpus(output))
+    logging.info(f"Recorded into {output}: {stats}")
+    for kind in ["reactions", "polls", "media"]:
+        if not stats[kind]:
+            logging.warning(f"The corpus has no {kind} messages - consider recording other chats too")
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True)
+def describe(paths: List[str]):
+    print(describe_corpus(load_corpus(paths)))
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--backend", type=click.Choice(BACKENDS), multiple=True, default=["postgres", "postgres-queue"], help="Ingest paths to replay into")
+@click.option("--batch-size", type=int, multiple=True, default=[1000, 10000], help="Batch sizes to compare")
+@click.option("--rate", type=float, default=0, help="Replay rate in messages per second (0 = unthrottled)")
+def replay(paths: List[str], backend: List[str], batch_size: List[int], rate: float):
+    results = []
+    for b, n in itertools.product(backend, batch_size):
+        logging.info(f"Replaying into {b} with batch size {n}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_one, list(paths), b, n, rate).result()
+        logging.info(f"{b} {n}: {result}")
+        results.append(result)
+    print(f"{'backend':>15} {'batch':>7} {'msgs':>8} {'total':>14} {'msg/s':>9} {'batches':>8} {'p50':>8} {'p99':>8} {'rss':>9} {'peak rss':>9}")
+    for r in results:
+        print(f"{r['backend']:>15} {r['batch_size']:>7} {r['messages']:>8} {pretty_time(r['total']):>14} {r['rate']:>9.0f} {r['batches']:>8} "
+              f"{r['p50']:>7.3f}s {r['p99']:>7.3f}s {r['rss_loaded']:>7.0f}MB {r['rss_peak']:>7.0f}MB")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+import time
+import click
+from common.hype import HypeScorer
+logging.basicConfig(level=logging.INFO)
+
+
+@click.command()
+@click.option("--hours", type=float, default=24, help="Score the messages posted in the last HOURS")
+@click.option("--start", type=click.DateTime(), default=None, help="Score from this date instead (with --end)")
+@click.option("--end", type=click.DateTime(), default=None)
+@click.option("--every", type=float, default=0, help="Rescore the last HOURS every EVERY minutes (0 = once)")
+def main(hours: float, start: datetime.datetime, end: datetime.datetime, every: float):
+    """
+    Computes message_hype for a window of messages and updates sender_hype_stats (see common/hype.py).
+    Rescoring a window is safe - the previous scores are taken out of the sender statistics first
+    """
+    scorer = HypeScorer()
+    while True:
+        if start is not None:
+            window = (start, end or datetime.datetime.now())
+        else:
+            window = (datetime.datetime.now() - datetime.timedelta(hours=hours), datetime.datetime.now())
+        scorer.score_window(*window)
+        if not every:
+            return
+        time.sleep(every * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+from typing import List
+import datetime
+import logging
+import statistics
+import time
+import click
+from sqlalchemy import text
+from common.utils import create_postgres_engine
+from common.backend import vector_index
+logging.basicConfig(level=logging.INFO)
+
+
+@click.group()
+def main():
+    """
+    HNSW indexes of the embedding columns (see common/backend/vector_index.py)
+    """
+
+
+@main.command()
+@click.option("--source", "sources", multiple=True, type=click.Choice(list(vector_index.SOURCES)), help="Default: all")
+@click.option("--workers", type=int, default=2, help="Parallel workers per index build")
+def build(sources: List[str], workers: int):
+    """
+    Builds the missing indexes without blocking writers. Safe to interrupt and rerun
+    """
+    vector_index.build_indexes(create_postgres_engine(), sources or None, workers=workers)
+
+
+def sample_queries(conn, source: str, n: int) -> list:
+    table = vector_index.SOURCES[source].table
+    rows = conn.execute(text(f"SELECT embedding FROM {table} TABLESAMPLE SYSTEM (1) WHERE embedding IS NOT NULL LIMIT :n"), dict(n=n))
+    return [r[0] for r in rows]
+
+
+def percentile(values: List[float], p: int) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+
+@main.command()
+@click.option("--source", type=click.Choice(list(vector_index.SOURCES)), default="messages")
+@click.option("--queries", type=int, default=50, help="Query vectors, sampled from the table itself")
+@click.option("-k", "--limit", type=int, default=10)
+@click.option("--ef-search", default="40,100,200", help="Comma separated values to compare")
+@click.option("--days", type=float, default=0, help="Also filter on the last DAYS of messages (0 = no filter)")
+@click.option("--min-sender-z", type=float, default=None, help="Also filter on the sender hype")
+def bench(source: str, queries: int, limit: int, ef_search: str, days: float, min_sender_z: float):
+    """
+    Recall@k and latency of the ANN search against an exact scan, for every --ef-search
+    """
+    engine = create_postgres_engine()
+    after = datetime.datetime.now() - datetime.timedelta(days=days) if days else None
+    with engine.connect() as conn:
+        embeddings = sample_queries(conn, source, queries)
+        conn.rollback()
+        if not embeddings:
+            logging.info(f"No embeddings in {source}")
+            return
+        logging.info(f"{len(embeddings)} queries on {source}, k={limit}, after={after}, min_sender_z={min_sender_z}")
+
+        def run(embedding, **kwargs):
+            query = vector_index.nearest(source, embedding, limit=limit, after=after, min_sender_z=min_sender_z)
+            t_start = time.perf_counter()
+            rows = vector_index.search(conn, query, **kwargs)
+            elapsed = time.perf_counter() - t_start
+            conn.rollback() # the settings of search() are per transaction
+            return {(r[0], r[1]) for r in rows}, elapsed
+
+        exact = [run(e, exact=True) for e in embeddings]
+        logging.info(f"exact: p50 {percentile([t for _, t in exact], 50)*1000:.1f}ms, p95 {percentile([t for _, t in exact], 95)*1000:.1f}ms")
+        for ef in [int(x) for x in ef_search.split(",")]:
+            ann = [run(e, ef_search=ef) for e in embeddings]
+            recall = [len(found & truth) / max(len(truth), 1) for (found, _), (truth, _) in zip(ann, exact)]
+            latency = [t for _, t in ann]
+            logging.info(
+                f"ef_search={ef}: recall@{limit} {statistics.mean(recall):.3f} (min {min(recall):.2f}), "
+                f"p50 {percentile(latency, 50)*1000:.1f}ms, p95 {percentile(latency, 95)*1000:.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
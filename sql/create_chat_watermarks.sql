@@ -0,0 +1,20 @@
+-- one-off backfill of chat_watermarks for a database created before the table existed
+-- (new writes keep it up to date - see pg_backend.upsert_watermarks)
+INSERT INTO chat_watermarks (chat_id, min_message_id, max_message_id, ongoing_min_message_id, message_count, max_date, last_fetch)
+SELECT
+    m.chat_id,
+    MIN(m.message_id),
+    MAX(m.message_id),
+    MIN(m.message_id) FILTER (WHERE c.top_message_id IS NULL OR m.message_id > c.top_message_id),
+    COUNT(*),
+    MAX(m.date),
+    NULL
+FROM messages m
+LEFT JOIN chats c ON c.chat_id = m.chat_id
+GROUP BY m.chat_id
+ON CONFLICT (chat_id) DO UPDATE SET
+    min_message_id = EXCLUDED.min_message_id,
+    max_message_id = EXCLUDED.max_message_id,
+    ongoing_min_message_id = EXCLUDED.ongoing_min_message_id,
+    message_count = EXCLUDED.message_count,
+    max_date = EXCLUDED.max_date;
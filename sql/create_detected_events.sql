@@ -0,0 +1,16 @@
+-- detected_events for a database created before it existed (see MessageStore/src/postgres.sql)
+-- events of EventDetect/main.py: a cluster of messages (chat_ids[i], message_ids[i]) of the sliding window.
+-- Rewritten while the event grows, and left as it was once its messages leave the window
+CREATE TABLE IF NOT EXISTS detected_events (
+    event_id UUID NOT NULL,
+    source TEXT NOT NULL, -- the embeddings table clustered
+    centroid vector,
+    chat_ids BIGINT[] NOT NULL,
+    message_ids BIGINT[] NOT NULL,
+    size INTEGER NOT NULL,
+    first_at TIMESTAMP,
+    last_at TIMESTAMP,
+    total_hype REAL, -- sum of the hype weights of the members
+    updated_at TIMESTAMP,
+    PRIMARY KEY (event_id)
+);
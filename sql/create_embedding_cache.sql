@@ -0,0 +1,9 @@
+-- embedding_cache for a database created before it existed (see MessageStore/src/postgres.sql)
+-- embeddings by model and text (blake2b-128 of the NFKC, whitespace-collapsed text), see common/embedding_cache.py
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    model TEXT NOT NULL,
+    text_hash BYTEA NOT NULL,
+    embedding vector NOT NULL,
+    created_at TIMESTAMP,
+    PRIMARY KEY (model, text_hash)
+);
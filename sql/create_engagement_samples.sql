@@ -0,0 +1,15 @@
+-- engagement_samples for a database created before the table existed (see MessageStore/src/postgres.sql)
+CREATE TABLE IF NOT EXISTS engagement_samples (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    sampled_at TIMESTAMP NOT NULL,
+    stage SMALLINT NOT NULL,
+    views INTEGER,
+    forwards INTEGER,
+    reactions_vote_count INTEGER,
+    poll_vote_count INTEGER,
+    PRIMARY KEY (chat_id, message_id, sampled_at)
+);
+
+-- MessageRefresh/main.py looks up recent messages by date
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date);
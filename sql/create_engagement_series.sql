@@ -0,0 +1,47 @@
+-- engagement_series and engagement_rollups for a database created before they existed (see MessageStore/src/postgres.sql)
+-- engagement_samples compacted by common/backend/engagement_store.py: one row per message holding its whole
+-- trajectory as delta-encoded arrays (t: seconds after posted_at), so a growth curve is one row instead of a row
+-- per sample and the small deltas compress well once a trajectory gets long.
+-- stage is the highest engagement_samples.stage folded in.
+CREATE TABLE IF NOT EXISTS engagement_series (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    posted_at TIMESTAMP NOT NULL,
+    stage SMALLINT NOT NULL DEFAULT 0,
+    last_sampled_at TIMESTAMP,
+    t INTEGER[] NOT NULL DEFAULT '{}',
+    views INTEGER[] NOT NULL DEFAULT '{}',
+    forwards INTEGER[] NOT NULL DEFAULT '{}',
+    reactions INTEGER[] NOT NULL DEFAULT '{}',
+    PRIMARY KEY (chat_id, message_id, posted_at)
+) PARTITION BY RANGE (posted_at);
+
+DO $$
+BEGIN
+  FOR partition_year IN 2013..2040 LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS engagement_series_%s PARTITION OF engagement_series FOR VALUES FROM (''%s-01-01'') TO (''%s-01-01'')',
+      partition_year,
+      partition_year,
+      partition_year+1
+    );
+  END LOOP;
+END;
+$$;
+
+-- growth of every chat per time bucket, added to while compacting (each sample is counted exactly once).
+-- views/forwards/reactions are the increases since the previous sample of each message, samples the number of them
+CREATE TABLE IF NOT EXISTS engagement_rollups (
+    granularity granularity_type NOT NULL,
+    chat_id BIGINT NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 0,
+    views BIGINT NOT NULL DEFAULT 0,
+    forwards BIGINT NOT NULL DEFAULT 0,
+    reactions BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, chat_id, bucket)
+) PARTITION BY LIST (granularity);
+
+CREATE TABLE IF NOT EXISTS engagement_rollups_1m PARTITION OF engagement_rollups FOR VALUES IN ('1m');
+CREATE TABLE IF NOT EXISTS engagement_rollups_60m PARTITION OF engagement_rollups FOR VALUES IN ('60m');
+CREATE TABLE IF NOT EXISTS engagement_rollups_1d PARTITION OF engagement_rollups FOR VALUES IN ('1d');
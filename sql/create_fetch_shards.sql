@@ -0,0 +1,14 @@
+-- fetch_shards for a database created before the table existed (see MessageStore/src/postgres.sql)
+CREATE TABLE IF NOT EXISTS fetch_shards (
+    chat_id BIGINT NOT NULL,
+    min_id BIGINT NOT NULL,
+    max_id BIGINT NOT NULL,
+    offset_id BIGINT NOT NULL,
+    done BOOLEAN NOT NULL DEFAULT FALSE,
+    session TEXT,
+    updated_at TIMESTAMP DEFAULT now(),
+    PRIMARY KEY (chat_id, min_id)
+);
+
+-- replaced by fetch_shards
+DELETE FROM configurations WHERE project = 'sessionstore' AND key = 'last_write';
@@ -0,0 +1,22 @@
+-- message_hype and sender_hype_stats for a database created before they existed (see MessageStore/src/postgres.sql)
+-- hype scores of common/hype.py. sender_id is messages.sender_id, or the chat for unsigned channel posts
+CREATE TABLE IF NOT EXISTS message_hype (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    sender_id BIGINT NOT NULL,
+    hype REAL NOT NULL,
+    chat_z REAL, -- against the other messages of the chat in the scored window
+    sender_z REAL, -- against the previous messages of the sender (NULL while there are too few)
+    scored_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+
+-- running count, mean and sum of squared deviations (Welford) of the hype of every sender's scored messages
+CREATE TABLE IF NOT EXISTS sender_hype_stats (
+    sender_id BIGINT NOT NULL,
+    n BIGINT NOT NULL CHECK (n >= 0),
+    mean DOUBLE PRECISION NOT NULL,
+    m2 DOUBLE PRECISION NOT NULL CHECK (m2 >= 0),
+    updated_at TIMESTAMP,
+    PRIMARY KEY (sender_id)
+);
@@ -0,0 +1,11 @@
+-- ANN indexes for a database created before they existed (see MessageStore/src/postgres.sql).
+-- halfvec needs pgvector 0.7 and iterative index scans 0.8 - rebuild the postgres image first.
+-- These statements lock writes to the tables while they run; on a live database use
+--     PYTHONPATH=Pipeline python scripts/vector_index.py build
+-- instead, which builds one partition at a time concurrently
+ALTER EXTENSION vector UPDATE;
+
+CREATE INDEX IF NOT EXISTS idx_messages_embedding_hnsw ON messages USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS idx_message_embeddings_embedding_hnsw ON message_embeddings USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS idx_message_chain_embeddings_hegemmav2_embedding_hnsw ON message_chain_embeddings_hegemmav2
+    USING hnsw ((embedding::halfvec(3072)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);